@@ -1,4 +1,4 @@
-from .fdict import fdict, sfdict
+from .fdict import fdict, sfdict, sqlfdict
 from ._version import __version__  # NOQA
 
-__all__ = ['fdict', 'sfdict', '__version__']
+__all__ = ['fdict', 'sfdict', 'sqlfdict', '__version__']
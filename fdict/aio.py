@@ -0,0 +1,250 @@
+# Asyncio interface of fdict, sfdict and sqlfdict (Python >= 3.7)
+#
+# This module is not imported by the fdict package, since it is not compatible
+# with Python 2:
+# from fdict.aio import aiofdict
+
+import asyncio
+import collections
+import concurrent.futures
+import itertools
+
+from .fdict import fdict
+
+
+__all__ = ['aiofdict']
+
+
+class aiofdict(object):
+    '''
+    Asyncio facade of a fdict, usually a sfdict or a sqlfdict, so that reads,
+    writes and syncs of the database (dbm or SQLite I/O and unpickling) do not
+    block the event loop.
+    All the calls to the fdict are made by a dedicated executor with one
+    thread, so that the fdict is only used by one thread at a time, in the
+    order of the requests. Use aiofdict.open() to open a sqlfdict in this
+    thread (a SQLite connection can only be used in the thread that created it,
+    except with threadsafe=True).
+    Concurrent requests are queued, and the queue is run by batches of at most
+    batchsize requests per executor call, where the consecutive gets are
+    fetched with one getmany(), so that many small requests cost one round-trip
+    to the executor. At most maxpending requests can be queued: the next ones
+    wait for a slot (backpressure), in the order they were made.
+    '''
+    def __init__(self, d, executor=None, batchsize=1000, maxpending=10000):
+        '''
+        Parameters
+        ----------
+        d  : fdict
+            The fdict, sfdict or sqlfdict to access asynchronously.
+        executor : concurrent.futures.Executor, optional
+            Executor running the calls to the fdict, it must have
+            only one worker so that the requests are run in order.
+            [default : a new ThreadPoolExecutor with one thread]
+        batchsize : int, optional
+            Maximum number of queued requests run per executor call.
+            [default : 1000]
+        maxpending : int, optional
+            Maximum number of queued requests, the next ones wait.
+            [default : 10000]
+        '''
+        self.d = d
+        self.batchsize = batchsize
+        self.maxpending = maxpending
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            self._ownexecutor = True
+        else:
+            self._ownexecutor = False
+        self._executor = executor
+        # Queue of requests, shared with the facades of nested fdicts so that
+        # all the requests are run in order: (op, arg, future), number of
+        # requests queued or running, and futures of the requests waiting for a
+        # slot
+        self._state = {'queue': collections.deque(), 'runner': None,
+                       'pending': 0, 'waiters': collections.deque()}
+
+    @classmethod
+    async def open(cls, dclass, *args, executor=None, batchsize=1000,
+                   maxpending=10000, **kwargs):
+        '''Create a fdict of class dclass with the supplied arguments in the
+        executor (opening a database, and rebuilding its metadata if needed, is
+        blocking) and return its facade'''
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            ownexecutor = True
+        else:
+            ownexecutor = False
+        loop = asyncio.get_running_loop()
+        d = await loop.run_in_executor(executor,
+                                       lambda: dclass(*args, **kwargs))
+        facade = cls(d, executor=executor, batchsize=batchsize,
+                     maxpending=maxpending)
+        facade._ownexecutor = ownexecutor
+        return facade
+
+    def _wrap(self, value):
+        '''Return the facade of a nested fdict (sharing the executor and the
+        queue of requests), or the value of a leaf as-is'''
+        if isinstance(value, fdict):
+            view = self.__class__.__new__(self.__class__)
+            view.__dict__.update(self.__dict__)
+            view.d = value
+            return view
+        return value
+
+    async def _request(self, op, arg):
+        '''Queue a request and wait for its result. If maxpending requests are
+        already queued, wait for a slot first, behind the other waiting
+        requests, so that the requests are always queued in the order they were
+        made'''
+        state = self._state
+        loop = asyncio.get_running_loop()
+        if state['pending'] >= self.maxpending or state['waiters']:
+            waiter = loop.create_future()
+            state['waiters'].append(waiter)
+            try:
+                # The slot of a finished request is handed over to the waiter,
+                # see _release()
+                await waiter
+            except BaseException:
+                if waiter in state['waiters']:
+                    state['waiters'].remove(waiter)
+                elif not waiter.cancelled():
+                    # Cancelled after being handed a slot, pass it on
+                    self._release()
+                raise
+        else:
+            state['pending'] += 1
+        try:
+            future = loop.create_future()
+            state['queue'].append((op, arg, future))
+            if state['runner'] is None:
+                state['runner'] = asyncio.ensure_future(self._run())
+            return await future
+        finally:
+            self._release()
+
+    def _release(self):
+        '''Free the slot of a finished request: hand it over to the first
+        waiting request, if any'''
+        state = self._state
+        waiters = state['waiters']
+        while waiters:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        state['pending'] -= 1
+
+    async def _run(self):
+        '''Run the queued requests by batches in the executor, until the queue
+        is empty. Requests queued meanwhile are grouped in the next batch'''
+        state = self._state
+        queue = state['queue']
+        loop = asyncio.get_running_loop()
+        try:
+            while queue:
+                size = min(len(queue), self.batchsize)
+                batch = [queue.popleft() for _ in range(size)]
+                try:
+                    results = await loop.run_in_executor(
+                        self._executor, self._execute,
+                        [(op, arg) for op, arg, _ in batch])
+                except Exception as exc:
+                    results = [(False, exc)] * len(batch)
+                for (_, _, future), (ok, result) in zip(batch, results):
+                    if not future.done():
+                        if ok:
+                            future.set_result(result)
+                        else:
+                            future.set_exception(result)
+        finally:
+            state['runner'] = None
+
+    def _execute(self, batch):
+        '''Run a batch of requests in the executor thread, in order, the
+        consecutive gets on the same (nested) fdict being fetched with one
+        getmany(). Return the list of (True, result) or (False, exception)'''
+        def groupkey(request):
+            # Group the consecutive gets by the fdict they are made on
+            op, arg = request
+            return op, (id(arg[0]) if op == 'get' else None)
+
+        results = []
+        for (op, _), group in itertools.groupby(batch, key=groupkey):
+            args = [arg for _, arg in group]
+            if op == 'get' and len(args) > 1:
+                try:
+                    values = args[0][0].getmany([key for _, key in args])
+                    results.extend((True, value) for value in values)
+                    continue
+                except Exception:
+                    # Fetch them one by one to get the error of each request
+                    pass
+            for arg in args:
+                try:
+                    if op == 'get':
+                        target, key = arg
+                        results.append((True, target[key]))
+                    elif op == 'set':
+                        target, key, value = arg
+                        target[key] = value
+                        results.append((True, None))
+                    elif op == 'del':
+                        target, key = arg
+                        del target[key]
+                        results.append((True, None))
+                    else:
+                        results.append((True, arg()))
+                except Exception as exc:
+                    results.append((False, exc))
+        return results
+
+    async def aget(self, key):
+        '''Get an item given the key, like getitem: the value of a leaf, or the
+        facade of a nested fdict for a node'''
+        return self._wrap(await self._request('get', (self.d, key)))
+
+    async def aset(self, key, value):
+        '''Set an item given the key, like setitem'''
+        await self._request('set', (self.d, key, value))
+
+    async def adel(self, key):
+        '''Delete an item given the key, like delitem'''
+        await self._request('del', (self.d, key))
+
+    async def acall(self, func, *args, **kwargs):
+        '''Call func(*args, **kwargs) in the executor, in order with the other
+        requests, eg, d.acall(d.d.update, items)'''
+        return await self._request('call', lambda: func(*args, **kwargs))
+
+    async def aitems(self, chunksize=1000, **kwargs):
+        '''Walk the items under the current node like viewitems() (with the
+        same arguments), by fetching chunks of chunksize items in the
+        executor'''
+        d = self.d
+        items = iter(d.viewitems(**kwargs))
+        while True:
+            chunk = await self._request(
+                'call', lambda: list(itertools.islice(items, chunksize)))
+            if not chunk:
+                return
+            for item in chunk:
+                yield item
+
+    async def async_sync(self):
+        '''Commit pending changes to file (sfdict and sqlfdict), see
+        sfdict.sync()'''
+        sync = getattr(self.d, 'sync', None)
+        if sync is not None:
+            return await self._request('call', sync)
+
+    async def aclose(self, delete=False):
+        '''Close the database (sfdict and sqlfdict), then shut down the
+        executor if it was created by the facade'''
+        close = getattr(self.d, 'close', None)
+        if close is not None:
+            await self._request('call', lambda: close(delete=delete))
+        if self._ownexecutor:
+            self._executor.shutdown(wait=False)
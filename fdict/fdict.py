@@ -24,12 +24,27 @@
 # THE SOFTWARE.
 #
 
+import array
+import base64
+import binascii
+import bisect
+import codecs
 import collections
+import functools
+import heapq
+import io
 import itertools
+import json
+import marshal
+import multiprocessing
 import os
+import pickle
+import re
 import shelve
 import sys
 import tempfile
+import threading
+import time
 
 from pickle import HIGHEST_PROTOCOL as PICKLE_HIGHEST_PROTOCOL
 from types import GeneratorType
@@ -39,11 +54,1185 @@ PY3 = (sys.version_info >= (3,0))
 
 if PY3:  # pragma: no cover
     _zip = zip
+    _range = range
+    _basestring = str
+    _unicode = str
+    _unichr = chr
 else:
     _zip = itertools.izip
+    _range = xrange  # NOQA
+    _basestring = basestring
+    _unicode = unicode
+    _unichr = unichr
 
+try:
+    from collections import OrderedDict as _OrderedDict
+except ImportError:  # pragma: no cover
+    # Py2.6: no LRU cache for sfdict, shelve writeback cache is used instead
+    _OrderedDict = None
 
-__all__ = ['fdict', 'sfdict']
+try:
+    from collections.abc import Mapping as _Mapping, MutableMapping as _MutableMapping
+except ImportError:  # pragma: no cover
+    # Py2
+    from collections import Mapping as _Mapping, MutableMapping as _MutableMapping
+
+try:
+    from threading import get_ident as _get_ident
+except ImportError:  # pragma: no cover
+    # Py2
+    from thread import get_ident as _get_ident
+
+try:
+    # Typecode of the 64 bits integer columns (see to_columns())
+    array.array('q')
+    _INT64_TYPECODE = 'q'
+except ValueError:  # pragma: no cover
+    # Py2: no long long typecode, long is 64 bits on most 64 bits platforms
+    _INT64_TYPECODE = 'l'
+
+
+
+__all__ = ['fdict', 'sfdict', 'sqlfdict']
+
+
+class sortedkeys(object):
+    '''
+    Sorted index of the (string) keys of a flattened dict, used to find all the leaves under a node without walking the whole dict.
+    Keys are stored in a list of sorted chunks (like a B+tree with only one level of inner nodes), so that an insertion or a deletion only moves the items of one chunk, whereas looking up a prefix is a bisect over the chunks' maxes and then inside the chunk: O(log n + m) where m is the number of matched keys.
+    Non-string keys (which can only happen at root level) cannot be under any node nor be sorted with the others, so they are only kept aside in the set others.
+    '''
+    def __init__(self, keys=None, load=1000):
+        self._load = load
+        self._lists = []
+        self._maxes = []
+        self._len = 0
+        self.others = set()
+        if keys is not None:
+            self.update(keys)
+
+    def _rebuild(self, keys):
+        '''Rebuild all chunks from a sorted list of unique keys'''
+        load = self._load
+        self._lists = [keys[i:i+load] for i in range(0, len(keys), load)]
+        self._maxes = [sub[-1] for sub in self._lists]
+        self._len = len(keys)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for sub in self._lists:
+            for k in sub:
+                yield k
+
+    def __contains__(self, key):
+        maxes = self._maxes
+        pos = bisect.bisect_left(maxes, key)
+        if pos == len(maxes):
+            return False
+        sub = self._lists[pos]
+        return sub[bisect.bisect_left(sub, key)] == key
+
+    def copy(self):
+        new = self.__class__(load=self._load)
+        new._lists = [sub[:] for sub in self._lists]
+        new._maxes = self._maxes[:]
+        new._len = self._len
+        new.others = self.others.copy()
+        return new
+
+    def add(self, key):
+        '''Add a key (do nothing if it is already indexed)'''
+        if not isinstance(key, _basestring):
+            self.others.add(key)
+            return
+        maxes = self._maxes
+        lists = self._lists
+        if not maxes:
+            lists.append([key])
+            maxes.append(key)
+            self._len = 1
+            return
+        pos = bisect.bisect_left(maxes, key)
+        if pos == len(maxes):
+            # Bigger than any key, append to the last chunk
+            pos -= 1
+            sub = lists[pos]
+            sub.append(key)
+            maxes[pos] = key
+        else:
+            sub = lists[pos]
+            i = bisect.bisect_left(sub, key)
+            if sub[i] == key:
+                return
+            sub.insert(i, key)
+        self._len += 1
+        # Split the chunk if it grew too big, to keep insertions cheap
+        load = self._load
+        if len(sub) > 2*load:
+            half = sub[load:]
+            del sub[load:]
+            maxes[pos] = sub[-1]
+            lists.insert(pos+1, half)
+            maxes.insert(pos+1, half[-1])
+
+    def update(self, keys):
+        '''Add several keys at once. If there are a lot of keys compared to the size of the index, it is faster to merge and rebuild everything at once'''
+        keys = list(keys)
+        if not all(isinstance(k, _basestring) for k in keys):
+            self.others.update(k for k in keys if not isinstance(k, _basestring))
+            keys = [k for k in keys if isinstance(k, _basestring)]
+        if len(keys) * 8 > self._len:
+            keys.extend(self)
+            self._rebuild(sorted(set(keys)))
+        else:
+            for k in keys:
+                self.add(k)
+
+    def discard(self, key):
+        '''Remove a key if it is indexed'''
+        if not isinstance(key, _basestring):
+            self.others.discard(key)
+            return
+        maxes = self._maxes
+        pos = bisect.bisect_left(maxes, key)
+        if pos == len(maxes):
+            return
+        sub = self._lists[pos]
+        i = bisect.bisect_left(sub, key)
+        if sub[i] != key:
+            return
+        del sub[i]
+        self._len -= 1
+        if not sub:
+            del self._lists[pos]
+            del maxes[pos]
+        elif i == len(sub):
+            maxes[pos] = sub[-1]
+
+    def ceiling(self, key):
+        '''Return the smallest indexed key greater than or equal to key, or None. O(log n)'''
+        maxes = self._maxes
+        pos = bisect.bisect_left(maxes, key)
+        if pos == len(maxes):
+            return None
+        sub = self._lists[pos]
+        return sub[bisect.bisect_left(sub, key)]
+
+    def _iterfrom(self, start=None, inclusive=True):
+        '''Walk the keys from start (included, or excluded if not inclusive) in sorted order, None for no bound.
+        Each chunk is copied and the next one is found again by bisecting past the last key yielded, so that the caller can add or delete keys while iterating (chunks can be split, merged or removed meanwhile).'''
+        while True:
+            maxes = self._maxes
+            if start is None:
+                pos, i = 0, 0
+                if not maxes:
+                    return
+            else:
+                bisect_start = bisect.bisect_left if inclusive else bisect.bisect_right
+                pos = bisect_start(maxes, start)
+                if pos == len(maxes):
+                    return
+                i = bisect_start(self._lists[pos], start)
+            chunk = self._lists[pos][i:]  # never empty, the max of the chunk is past start
+            for k in chunk:
+                yield k
+            start, inclusive = chunk[-1], False
+
+    def irange(self, start=None, stop=None, inclusive=True):
+        '''Walk the keys from start (included, or excluded if not inclusive) to stop (excluded) in sorted order, None for no bound. O(log n + m)'''
+        for k in self._iterfrom(start, inclusive):
+            if stop is not None and k >= stop:
+                return
+            yield k
+
+    def iterprefix(self, prefix):
+        '''Walk all keys starting with prefix, in sorted order. O(log n + m)'''
+        for k in self._iterfrom(prefix):
+            if not k.startswith(prefix):
+                return
+            yield k
+
+
+class keytrie(object):
+    '''
+    Trie of the keys of a flattened dict, where each node is a dict of relative key segments pointing either to a sub-node (another dict) or to None for a leaf.
+    Used by the trie mode to store the nodes structure outside of the internal dict, in a more compact way than the fastview mode's sets of full paths, and to walk only the branch of a node.
+    There can be no conflict between a leaf and a node: adding a key returns the keys of the leaves it replaced.
+    '''
+    def __init__(self, keys=None, delimiter='/'):
+        self.root = {}
+        self.delimiter = delimiter
+        if keys is not None:
+            for k in keys:
+                self.add(k)
+
+    def _split(self, key):
+        '''Split a full key into its segments (non-string keys are root-level leaves)'''
+        if isinstance(key, _basestring):
+            return key.split(self.delimiter)
+        else:
+            return [key]
+
+    def _join(self, segments):
+        return segments[0] if len(segments) == 1 else self.delimiter.join(segments)
+
+    def getnode(self, path):
+        '''Get the trie node (a dict of segments) for a node path (without the ending delimiter), or None if there is no such node'''
+        node = self.root
+        if path == '':
+            return node
+        for seg in self._split(path):
+            node = node.get(seg)
+            if not node:
+                # Inexistent node or leaf
+                return None
+        return node
+
+    def add(self, key):
+        '''Add the full key of a leaf, and return the list of full keys of the leaves it replaces (a leaf parent, or all leaves under a node with the same key)'''
+        segments = self._split(key)
+        displaced = []
+        node = self.root
+        for i in range(len(segments)-1):
+            seg = segments[i]
+            child = node.get(seg)
+            if child is None:
+                if seg in node:
+                    # A leaf is in the way, it becomes a node
+                    displaced.append(self._join(segments[:i+1]))
+                child = node[seg] = {}
+            node = child
+        last = segments[-1]
+        old = node.get(last)
+        if old:
+            # A node is replaced by a leaf, all its leaves are replaced
+            displaced.extend(k for k, isnode in self.iterbranch(old, self._join(segments) + self.delimiter) if not isnode)
+        node[last] = None
+        return displaced
+
+    def _walk_parents(self, segments):
+        '''Get the list of (node, segment) from the root down to the parent of the last segment, or None if the path does not exist'''
+        parents = []
+        node = self.root
+        for seg in segments[:-1]:
+            parents.append((node, seg))
+            node = node.get(seg)
+            if not node:
+                return None
+        parents.append((node, segments[-1]))
+        return parents
+
+    def _prune(self, parents):
+        '''Delete the last segment and remove the nodes that became empty up to the root'''
+        for node, seg in reversed(parents):
+            del node[seg]
+            if node:
+                break
+
+    def remove(self, key):
+        '''Remove the full key of a leaf, return True if it was found'''
+        parents = self._walk_parents(self._split(key))
+        if parents is None:
+            return False
+        node, last = parents[-1]
+        if last in node and node[last] is None:
+            self._prune(parents)
+            return True
+        return False
+
+    def removenode(self, path):
+        '''Remove a node and return the list of full keys of all the leaves under it'''
+        segments = self._split(path)
+        parents = self._walk_parents(segments)
+        if parents is None:
+            return []
+        node, last = parents[-1]
+        sub = node.get(last)
+        if not sub:
+            return []
+        leaves = [k for k, isnode in self.iterbranch(sub, path + self.delimiter) if not isnode]
+        self._prune(parents)
+        return leaves
+
+    def iterbranch(self, node, prefix=''):
+        '''Walk all the descendants of a trie node, yielding (key, isnode) with keys prefixed by prefix and nodes ending with the delimiter'''
+        delimiter = self.delimiter
+        stack = [(node, prefix)]
+        while stack:
+            node, prefix = stack.pop()
+            for seg, child in list(node.items()):
+                key = prefix + seg if prefix else seg
+                if child is None:
+                    yield key, False
+                else:
+                    key += delimiter
+                    yield key, True
+                    stack.append((child, key))
+
+
+class jsonstream(object):
+    '''
+    Incremental parser of a stream of JSON objects (a JSON document, or JSON Lines with one object per line), yielding the (flattened key, value) of each leaf as soon as it is parsed, so that the document never needs to fit in memory.
+    Objects are walked with a stack of the prefixes of the open objects, keys are joined with the delimiter, and any other value (including arrays) is a leaf decoded with the standard json module. The file is read by chunks, and a token truncated at the end of the buffer is decoded again once the buffer has at least doubled, so that a big token is decoded O(log n) times instead of once per chunk.
+    '''
+    _ws = re.compile(r'[ \t\n\r]*')
+    _valueend = frozenset(' \t\n\r,}')
+
+    def __init__(self, fp, sep='/', chunksize=65536):
+        self.fp = fp
+        self.sep = sep
+        self.chunksize = chunksize
+        self.buf = u''
+        self.pos = 0
+        self.eof = False
+        self.bytesread = 0
+        self.objects = 0  # number of top-level objects
+        self._raw_decode = json.JSONDecoder().raw_decode
+        self._textdecoder = codecs.getincrementaldecoder('utf-8')()
+
+    def _read(self, minsize=0):
+        '''Read the next chunk, or more chunks until at least minsize characters are buffered after the current position. Return False at the end of the file'''
+        if self.eof:
+            return False
+        chunks = [self.buf[self.pos:]]
+        size = len(chunks[0])
+        while True:
+            chunk = self.fp.read(self.chunksize)
+            if not chunk:
+                self.eof = True
+                break
+            self.bytesread += len(chunk)
+            if isinstance(chunk, bytes):
+                # Binary file: decode incrementally, a multi-bytes character can be split between two chunks
+                chunk = self._textdecoder.decode(chunk)
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= minsize:
+                break
+        if len(chunks) == 1:
+            return False
+        self.buf = u''.join(chunks)
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        '''Skip whitespaces and return the next character, or an empty string at the end of the file'''
+        while True:
+            self.pos = self._ws.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf) or not self._read():
+                return self.buf[self.pos:self.pos+1]
+
+    def _scan(self, decode, quoted=False):
+        '''Decode the token at the current position with decode(buf, pos) -> (value, end), reading more data if the token is truncated'''
+        while True:
+            try:
+                value, end = decode(self.buf, self.pos)
+            except ValueError:
+                # Truncated token (or invalid JSON): retry once the buffered data has doubled, to avoid decoding a big token again after every chunk
+                if self._read(2 * (len(self.buf) - self.pos)):
+                    continue
+                raise
+            if not quoted and (end >= len(self.buf) or self.buf[end] not in self._valueend) and self._read():
+                # The value is not followed by a delimiter, it might be truncated (eg, a number cut in its fraction)
+                continue
+            self.pos = end
+            return value
+
+    def _error(self, expected):
+        raise ValueError('Invalid JSON: expected %s at character %i of the current chunk' % (expected, self.pos))
+
+    def __iter__(self):
+        sep = self.sep
+        scanstring = json.decoder.scanstring
+        scankey = lambda buf, pos: scanstring(buf, pos+1)
+        raw_decode = self._raw_decode
+        while True:
+            c = self._peek()
+            if not c:
+                return
+            if c != '{':
+                self._error('an object')
+            self.pos += 1
+            self.objects += 1
+            stack = ['']  # prefixes of the open objects
+            needcomma = False
+            while stack:
+                c = self._peek()
+                if c == '}':
+                    # End of the current object
+                    self.pos += 1
+                    stack.pop()
+                    needcomma = True
+                    continue
+                if needcomma:
+                    if c != ',':
+                        self._error("',' or '}'")
+                    self.pos += 1
+                    c = self._peek()
+                if c != '"':
+                    self._error('a key')
+                key = self._scan(scankey, quoted=True)
+                if self._peek() != ':':
+                    self._error("':'")
+                self.pos += 1
+                fullkey = stack[-1] + key
+                if self._peek() == '{':
+                    # Nested object, its keys will be prefixed
+                    self.pos += 1
+                    stack.append(fullkey + sep)
+                    needcomma = False
+                else:
+                    # Leaf
+                    yield fullkey, self._scan(raw_decode)
+                    needcomma = True
+
+
+class rwlock(object):
+    '''
+    Reentrant reader-writer lock: any number of threads can hold it for reading at the same time, whereas a writer holds it alone.
+    Waiting writers have priority over new readers so that they are not starved, but the threads already holding the lock can always reacquire it (eg, nested calls or a lazy iterator left open). The writer can also acquire it for reading, and a reader can upgrade to writing once the other readers are gone, unless another reader is already waiting to upgrade (both would wait for each other), which raises a RuntimeError.
+    '''
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = {}  # thread id -> number of read acquisitions
+        self._writer = None  # thread id of the writer
+        self._writes = 0  # number of write acquisitions of the writer
+        self._waiting = 0  # number of waiting writers
+        self._upgrading = None  # thread id of the reader waiting to upgrade
+
+    def acquire_read(self):
+        '''Acquire the lock for reading, and return the thread id to pass to release_read() if it is released from another thread (eg, a generator garbage collected)'''
+        me = _get_ident()
+        with self._cond:
+            if self._writer != me and not me in self._readers:
+                while self._writer is not None or self._waiting:
+                    self._cond.wait()
+            self._readers[me] = self._readers.get(me, 0) + 1
+        return me
+
+    def release_read(self, ident=None):
+        if ident is None:
+            ident = _get_ident()
+        with self._cond:
+            n = self._readers[ident] - 1
+            if n:
+                self._readers[ident] = n
+            else:
+                del self._readers[ident]
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        me = _get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._writes += 1
+                return
+            upgrade = me in self._readers
+            if upgrade:
+                if self._upgrading is not None:
+                    raise RuntimeError('Deadlock: two threads reading the fdict (eg, iterating) are trying to modify it')
+                self._upgrading = me
+            self._waiting += 1
+            try:
+                while self._writer is not None or len(self._readers) > (1 if upgrade else 0):
+                    self._cond.wait()
+            finally:
+                self._waiting -= 1
+                if upgrade:
+                    self._upgrading = None
+            self._writer = me
+            self._writes = 1
+
+    def release_write(self):
+        with self._cond:
+            self._writes -= 1
+            if not self._writes:
+                self._writer = None
+                self._cond.notify_all()
+
+
+def _readlocked(method):
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        lock = self._lock
+        lock.acquire_read()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            lock.release_read()
+    return locked
+
+def _writelocked(method):
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        lock = self._lock
+        lock.acquire_write()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            lock.release_write()
+    return locked
+
+def _iterlocked(method):
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        lock = self._lock
+        ident = lock.acquire_read()
+        try:
+            for item in method(self, *args, **kwargs):
+                yield item
+        finally:
+            lock.release_read(ident)
+    return locked
+
+_lockedclasses = {}
+
+def _lockedclass(cls):
+    '''Get the subclass of cls whose methods are locked by the rwlock of the instance (in its _lock attribute), as listed in the class attributes _readmethods, _writemethods and _itermethods (methods returning a lazy iterator, which holds the lock for reading until it is exhausted or closed).
+    The threadsafe mode switches the class of the instance to this subclass, so that the default mode does not pay for the locking.'''
+    if cls.__dict__.get('_lockedbase') is not None:
+        # Already locked
+        return cls
+    lcls = _lockedclasses.get(cls)
+    if lcls is None:
+        attrs = {'_lockedbase': cls, '__module__': cls.__module__, '__doc__': cls.__doc__}
+        for names, wrapper in ((cls._readmethods, _readlocked), (cls._writemethods, _writelocked), (cls._itermethods, _iterlocked)):
+            for name in names:
+                attrs[name] = wrapper(getattr(cls, name))
+        lcls = _lockedclasses[cls] = type(cls.__name__, (cls,), attrs)
+    return lcls
+
+
+def _dbm_sharing(db):
+    '''How the changes to a dbm database opened for writing are made visible to the other processes opening it for reading: 'sync' if its sync() writes everything to its files (dumb dbm), 'reopen' if it must be closed and reopened (ndbm and Berkeley DB, which have no sync()), or None if it cannot be opened by readers meanwhile (gdbm, whose writer holds an exclusive lock, and unknown backends)'''
+    module = db.__class__.__module__
+    if module in ('dbm.dumb', 'dumbdbm'):
+        return 'sync'
+    elif module in ('_dbm', 'dbm', 'bsddb', 'dbhash'):
+        return 'reopen'
+    return None
+
+
+class lrushelf(shelve.Shelf, object):  # object makes it a new-style class on Python 2, where Shelf is old-style (needed by _lockedclass)
+    '''
+    Shelf with a bounded LRU cache of unpickled values, to replace shelve's writeback cache which keeps every accessed value in memory until sync() (so that walking a whole database loads it entirely in memory).
+    Like with writeback, values can be modified in place (eg, list.append): mutable values are written back to the database when they are evicted from the cache and at every sync(), but only if they changed, which is detected by comparing the size and hash of their pickle with the ones stored or loaded. Immutable values (numbers, strings, None) are never written back. Assignments are written through to the database immediately.
+    The cache is limited by a number of entries and/or a number of bytes (measured as the size of the pickled values). Hits, misses, evictions and written back values are counted.
+    Values can also be serialized with another codec than pickle (marshal, or raw bytes and strings), and compressed with zlib or lzma if they are big enough. Pickled values are stored as-is, so a database using only pickle is readable by shelve, whereas other codecs are prefixed by a tag byte (which cannot be the first byte of a pickle). The codec is recorded in a header stored in the database under a reserved key, which is hidden from the keys, and is reused when reopening.
+    '''
+    _immutable = (int, float, complex, bool, type(None), bytes, _basestring) + ((long,) if not PY3 else ())  # NOQA
+    codecs = ('pickle', 'marshal', 'raw')
+    compressions = ('zlib', 'lzma')
+    headerkey = '\x00fdict'  # reserved key of the header, cannot be built from a normal nested dict
+    # Tag bytes of the values that are not stored as pickles (pickles with protocol >= 2 start with \x80)
+    _TAG_BYTES, _TAG_UNICODE, _TAG_MARSHAL, _TAG_ZLIB, _TAG_LZMA = b'\x01', b'\x02', b'\x03', b'\x04', b'\x05'
+    # Methods locked in threadsafe mode (see _lockedclass): even reads update the cache (and write back evicted values), so all are exclusive. The keys are listed at once under the lock by _listkeys(), so that iterators do not hold the lock
+    _readmethods = ()
+    _writemethods = ('__getitem__', 'getmany', 'get', '__setitem__', '__delitem__', '__contains__', 'has_key', '__len__', '_listkeys', 'get_header', 'set_header', 'sync', 'reopen', 'close', 'stats')
+    _itermethods = ()
+
+    def __init__(self, dict, protocol=None, cachesize=10000, cachebytes=None, writeback=True, codec=None, compression=None, compressthreshold=None, keyencoding='utf-8', readonly=False):
+        # Call the parent constructor explicitly (Shelf is an old-style class on Python 2), always without shelve's writeback since we manage the cache
+        if PY3:  # pragma: no cover
+            shelve.Shelf.__init__(self, dict, protocol, False, keyencoding)
+        else:
+            shelve.Shelf.__init__(self, dict, protocol, False)
+            self.keyencoding = keyencoding
+        self.cache = _OrderedDict()  # key -> (value, size, digest), from least to most recently used. digest is None for immutable values.
+        self.usecache = writeback and cachesize != 0 and cachebytes != 0  # a cache of size 0 is no cache, not an unbounded one
+        self.cachesize = cachesize
+        self.cachebytes = cachebytes
+        self.cachedbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.writebacks = 0
+        self.writebackbytes = 0
+        # Codec: use the supplied parameters, else the ones recorded in the database header, else the defaults
+        header = self.get_header()
+        self.codec = codec or header.get('codec', 'pickle')
+        self.compression = compression if compression is not None else header.get('compression', False)
+        self.compressthreshold = compressthreshold if compressthreshold is not None else header.get('compressthreshold', 512)
+        if self.codec not in self.codecs:
+            raise ValueError('Unknown codec %s, must be one of %s' % (self.codec, ', '.join(self.codecs)))
+        if self.compression == 'zlib':
+            import zlib
+            self._compress, self._compresstag = zlib.compress, self._TAG_ZLIB
+        elif self.compression == 'lzma':
+            import lzma
+            self._compress, self._compresstag = lzma.compress, self._TAG_LZMA
+        elif self.compression:
+            raise ValueError('Unknown compression %s, must be one of %s' % (self.compression, ', '.join(self.compressions)))
+        # The marshal format is not stable across Python versions: values stored with marshal can only be read with the same version
+        marshalversion = header.get('marshalversion', marshal.version)
+        if marshalversion != marshal.version:
+            self.dict.close()
+            raise ValueError('The values of the database were serialized with marshal version %i, they cannot be read with marshal version %i: reopen it with the Python version that built it' % (marshalversion, marshal.version))
+        if not readonly:
+            header.update(version=1, codec=self.codec, compression=self.compression, compressthreshold=self.compressthreshold)
+            if self.codec == 'marshal':
+                header['marshalversion'] = marshal.version
+            self.set_header(header)
+
+    def get_header(self):
+        '''Return the header stored in the database, or an empty dict'''
+        try:
+            return pickle.loads(self.dict[self._dbkey(self.headerkey)])
+        except KeyError:
+            return {}
+
+    def set_header(self, header):
+        '''Store the header in the database'''
+        self.dict[self._dbkey(self.headerkey)] = pickle.dumps(header, self._protocol)
+
+    def _encode(self, value):
+        '''Serialize a value with the codec and compress it if it is big enough'''
+        codec = self.codec
+        if codec == 'raw' and isinstance(value, bytes):
+            data = self._TAG_BYTES + value
+        elif codec == 'raw' and isinstance(value, _unicode):
+            data = self._TAG_UNICODE + value.encode('utf-8')
+        elif codec == 'marshal':
+            try:
+                data = self._TAG_MARSHAL + marshal.dumps(value)
+            except ValueError:
+                # Type not supported by marshal, use pickle
+                data = pickle.dumps(value, self._protocol)
+        else:
+            data = pickle.dumps(value, self._protocol)
+        if self.compression and len(data) >= self.compressthreshold:
+            compressed = self._compresstag + self._compress(data)
+            if len(compressed) < len(data):
+                data = compressed
+        return data
+
+    def _decode(self, data):
+        '''Deserialize a value, the codec is given by the tag byte so that values stored with any codec can be read'''
+        tag = data[:1]
+        if tag == self._TAG_ZLIB:
+            import zlib
+            return self._decode(zlib.decompress(data[1:]))
+        elif tag == self._TAG_LZMA:
+            import lzma
+            return self._decode(lzma.decompress(data[1:]))
+        elif tag == self._TAG_BYTES:
+            return data[1:]
+        elif tag == self._TAG_UNICODE:
+            return data[1:].decode('utf-8')
+        elif tag == self._TAG_MARSHAL:
+            return marshal.loads(data[1:])
+        else:
+            return pickle.loads(data)
+
+    def _dbkey(self, key):
+        # dbm keys are bytes, also on Python 2 where unicode keys (eg, decoded from JSON) are not accepted
+        return key.encode(self.keyencoding) if isinstance(key, _unicode) else key
+
+    def _writeback(self, key, value, size, digest):
+        '''Write back a cached value only if its pickle changed. Return the new size and digest, and the number of bytes written'''
+        data = self._encode(value)
+        if len(data) == size and hash(data) == digest:
+            return size, digest, 0
+        self.dict[self._dbkey(key)] = data
+        self.writebacks += 1
+        self.writebackbytes += len(data)
+        return len(data), hash(data), len(data)
+
+    def _cache_add(self, key, value, data):
+        cache = self.cache
+        old = cache.pop(key, None)
+        if old is not None:
+            self.cachedbytes -= old[1]
+        cache[key] = (value, len(data), None if isinstance(value, self._immutable) else hash(data))
+        self.cachedbytes += len(data)
+        # Evict the least recently used entries (but always keep the last one)
+        while len(cache) > 1 and ((self.cachesize and len(cache) > self.cachesize) or (self.cachebytes and self.cachedbytes > self.cachebytes)):
+            k, (v, vsize, digest) = cache.popitem(last=False)
+            self.cachedbytes -= vsize
+            self.evictions += 1
+            if digest is not None:
+                # The value might have been modified in place, write it back if it changed
+                self._writeback(k, v, vsize, digest)
+
+    def __getitem__(self, key):
+        cache = self.cache
+        try:
+            entry = cache.pop(key)
+        except KeyError:
+            self.misses += 1
+            data = self.dict[self._dbkey(key)]
+            value = self._decode(data)
+            if self.usecache:
+                self._cache_add(key, value, data)
+            return value
+        # Hit: move the entry to the most recently used position
+        self.hits += 1
+        cache[key] = entry
+        return entry[0]
+
+    def getmany(self, keys):
+        '''Return a dict of the values of the stored keys: the cached values are taken first, then the other keys are read from the database in sorted order, and are decoded and cached in one pass'''
+        cache = self.cache
+        found = {}
+        missing = []
+        for key in keys:
+            entry = cache.pop(key, None)
+            if entry is None:
+                missing.append(key)
+            else:
+                cache[key] = entry  # move to the most recently used position
+                found[key] = entry[0]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        db = self.dict
+        dbkey = self._dbkey
+        decode = self._decode
+        usecache = self.usecache
+        headerkey = self.headerkey
+        missing = [(dbkey(key), key) for key in sorted(set(missing)) if key != headerkey]
+        for k, key in missing:
+            try:
+                data = db[k]
+            except KeyError:
+                continue
+            value = found[key] = decode(data)
+            if usecache:
+                self._cache_add(key, value, data)
+        return found
+
+    def __setitem__(self, key, value):
+        if not isinstance(key, (bytes, _basestring)):
+            # Most dbm backends refuse them, but dbm.sqlite3 (Python >= 3.13) would silently store them as another type
+            raise TypeError('sfdict keys must be strings, not %r' % (key,))
+        data = self._encode(value)
+        self.dict[self._dbkey(key)] = data
+        if self.usecache:
+            self._cache_add(key, value, data)
+
+    def __delitem__(self, key):
+        if key == self.headerkey:
+            raise KeyError(key)
+        del self.dict[self._dbkey(key)]
+        entry = self.cache.pop(key, None)
+        if entry is not None:
+            self.cachedbytes -= entry[1]
+
+    def _listkeys(self):
+        '''List the keys of the database, without the header'''
+        headerkey = self._dbkey(self.headerkey)
+        keyencoding = self.keyencoding
+        return [(k.decode(keyencoding) if PY3 else k) for k in self.dict.keys() if k != headerkey]
+
+    def __iter__(self):
+        return iter(self._listkeys())
+
+    if not PY3:
+        def keys(self):
+            return list(self.__iter__())
+
+    def __len__(self):
+        return len(self.dict) - (self._dbkey(self.headerkey) in self.dict)
+
+    def __contains__(self, key):
+        return key != self.headerkey and self._dbkey(key) in self.dict
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def sync(self):
+        '''Write back the mutable values in cache that were modified in place, and sync the database. The cache is kept.
+        Return the number of keys and bytes that were written back.'''
+        cache = self.cache
+        nkeys = nbytes = 0
+        for key, (value, size, digest) in list(cache.items()):
+            if digest is not None:
+                newsize, newdigest, written = self._writeback(key, value, size, digest)
+                if written:
+                    cache[key] = (value, newsize, newdigest)
+                    self.cachedbytes += newsize - size
+                    nkeys += 1
+                    nbytes += written
+        if hasattr(self.dict, 'sync'):
+            self.dict.sync()
+        return {'keys': nkeys, 'bytes': nbytes}
+
+    def reopen(self, opener):
+        '''Close the database then replace it with the one returned by opener(), eg, to flush a dbm backend that has no sync(). The cache is kept.'''
+        self.dict.close()
+        self.dict = opener()
+
+    def close(self):
+        shelve.Shelf.close(self)
+        self.cache = _OrderedDict()
+        self.cachedbytes = 0
+
+    def stats(self):
+        '''Return the cache counters'''
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'entries': len(self.cache), 'bytes': self.cachedbytes,
+                'writebacks': self.writebacks, 'writebackbytes': self.writebackbytes}
+
+
+class shardedshelf(_MutableMapping):
+    '''
+    Dict-like object partitioning the keys across several shelves (shards), to be used as the internal dict of a sharded sfdict.
+    A key is stored in the shard given by a stable hash (crc32) of its first level segments, ie, of the path of its ancestor at this nesting level, so that with level=1 every top-level node and its whole subtree (leaves and nodes metadata) are stored in the same shard. Iterating walks all the shards one after the other, except for the keys under a node deep enough to be in only one shard (see prefixkeys()), and sync() and close() run on all the shards in parallel threads.
+    The number of shards and the level are recorded in the header of the first shard, which holds the header of the database, and must be the same when reopening.
+    '''
+    def __init__(self, shards, delimiter='/', level=1, readonly=False):
+        self.shards = shards
+        self.delimiter = delimiter
+        self.level = level
+        header = self.get_header()
+        sharding = header.get('sharding')
+        if sharding is None and not readonly:
+            header['sharding'] = {'shards': len(shards), 'level': level}
+            self.set_header(header)
+        elif sharding is not None and (sharding['shards'], sharding['level']) != (len(shards), level):
+            # Close the shards first, else an unclosed dbm can overwrite the index of the database later on
+            for shard in shards:
+                shard.close()
+            raise ValueError('The database was built with %i shards at level %i, it cannot be reopened with %i shards at level %i' % (sharding['shards'], sharding['level'], len(shards), level))
+
+    def _shard(self, key):
+        '''Get the shard of a key, from the hash of its first level segments'''
+        if not isinstance(key, _basestring):
+            key = str(key)
+        delimiter = self.delimiter
+        pos = -1
+        for _ in _range(self.level):
+            pos = key.find(delimiter, pos+1)
+            if pos == -1:
+                break
+        prefix = key if pos == -1 else key[:pos]
+        if isinstance(prefix, _unicode):
+            prefix = prefix.encode('utf-8')
+        return self.shards[(binascii.crc32(prefix) & 0xffffffff) % len(self.shards)]
+
+    def _group(self, keys):
+        '''Group keys by shard, return a list of (shard, keys)'''
+        groups = {}
+        shard = self._shard
+        for k in keys:
+            s = shard(k)
+            groups.setdefault(id(s), (s, []))[1].append(k)
+        return list(groups.values())
+
+    def __getitem__(self, key):
+        return self._shard(key)[key]
+
+    def __setitem__(self, key, value):
+        self._shard(key)[key] = value
+
+    def __delitem__(self, key):
+        del self._shard(key)[key]
+
+    def __contains__(self, key):
+        return key in self._shard(key)
+
+    def get(self, key, default=None):
+        return self._shard(key).get(key, default)
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(iter(shard) for shard in self.shards)
+
+    if not PY3:
+        def keys(self):
+            return list(self.__iter__())
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def prefixkeys(self, prefix):
+        '''Walk the keys of the shards that can hold keys starting with prefix: only one shard if the prefix is the path of a node at the sharding level or deeper (eg, 'users/' with level=1), else all the shards. The keys are not filtered'''
+        if prefix.count(self.delimiter) >= self.level:
+            return iter(self._shard(prefix))
+        return self.__iter__()
+
+    def getmany(self, keys):
+        '''Get many keys at once, with one getmany() per shard, return a dict of the keys found'''
+        found = {}
+        for shard, ks in self._group(keys):
+            getmany = getattr(shard, 'getmany', None)
+            if getmany is not None:
+                found.update(getmany(ks))
+            else:  # pragma: no cover
+                found.update((k, shard[k]) for k in ks if k in shard)
+        return found
+
+    def update(self, other=(), **kwargs):
+        '''Store many items at once, grouped by shard'''
+        if isinstance(other, _Mapping):
+            other = other.items()
+        groups = {}
+        shard = self._shard
+        for k, v in itertools.chain(other, kwargs.items()):
+            s = shard(k)
+            groups.setdefault(id(s), (s, []))[1].append((k, v))
+        for s, items in groups.values():
+            s.update(items)
+
+    def get_header(self):
+        '''Return the header of the database, stored in the first shard'''
+        return self.shards[0].get_header()
+
+    def set_header(self, header):
+        self.shards[0].set_header(header)
+
+    def _parallel(self, method):
+        '''Call a method of all the shards in parallel threads (the I/O of each shard is done in its own file), or one after the other if the dbm backend is bound to its thread, and return the list of results'''
+        if len(self.shards) == 1 or any(getattr(shard, 'dict', None).__class__.__module__ == 'dbm.sqlite3' for shard in self.shards):
+            # dbm.sqlite3 (the default dbm from Python 3.13) can only be used in the thread that opened it
+            return [getattr(shard, method)() for shard in self.shards]
+        results = [None] * len(self.shards)
+        errors = []
+        def run(i, shard):
+            try:
+                results[i] = getattr(shard, method)()
+            except Exception as exc:  # pragma: no cover
+                errors.append(exc)
+        threads = [threading.Thread(target=run, args=(i, shard)) for i, shard in enumerate(self.shards)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:  # pragma: no cover
+            raise errors[0]
+        return results
+
+    def sync(self):
+        '''Sync all the shards in parallel, return the total number of keys and bytes written back (see lrushelf.sync())'''
+        total = {'keys': 0, 'bytes': 0}
+        for res in self._parallel('sync'):
+            if isinstance(res, dict):
+                for k in total:
+                    total[k] += res.get(k, 0)
+        return total
+
+    def close(self):
+        self._parallel('close')
+
+    def stats(self):
+        '''Return the cache counters summed over all the shards'''
+        total = {}
+        for shard in self.shards:
+            for k, v in shard.stats().items():
+                total[k] = total.get(k, 0) + v
+        return total
+
+
+class sqlshelf(_MutableMapping):
+    '''
+    Persistent dict-like object storing pickled values in a SQLite database, to be used as the internal dict of sqlfdict.
+    Items are stored in a table clustered on the key (WITHOUT ROWID), so that keys are kept sorted on disk: all the keys under a node can then be fetched or deleted with a range query (key >= prefix AND key < upper bound) in O(log n + m), instead of walking the whole database like with shelve.
+    Writes are grouped in a transaction, which is committed on sync() or close().
+    Keys must be strings, like with shelve: a TypeError is raised when storing any other key (eg, an int), which SQLite would else silently store as TEXT (1 would come back as '1').
+    '''
+    def __init__(self, filename, protocol=PICKLE_HIGHEST_PROTOCOL, threadsafe=False, readonly=False):
+        import sqlite3
+        self.filename = filename
+        self.protocol = protocol
+        self._binary = sqlite3.Binary
+        # The connection can be shared by threads if the writes are serialized by the caller (eg, sqlfdict in threadsafe mode), SQLite serializes the calls. The cache of prepared statements is shared by the threads too, and concurrent readers can then reset each other's statements, so it is disabled
+        connkwargs = {'check_same_thread': False, 'cached_statements': 0} if threadsafe else {}
+        if readonly:
+            # Read-only connection to an existing database
+            if PY3:  # pragma: no cover
+                from urllib.request import pathname2url
+                self.conn = sqlite3.connect('file:%s?mode=ro' % pathname2url(os.path.abspath(filename)), uri=True, **connkwargs)
+            else:
+                # No URI filenames, the tables are not created anyway
+                self.conn = sqlite3.connect(filename, **connkwargs)
+            return
+        self.conn = sqlite3.connect(filename, **connkwargs)
+        try:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS fdict (key TEXT PRIMARY KEY NOT NULL, value BLOB) WITHOUT ROWID')
+        except sqlite3.OperationalError:  # pragma: no cover
+            # SQLite < 3.8.2: no clustered table, the primary key is then a separate sorted index
+            self.conn.execute('CREATE TABLE IF NOT EXISTS fdict (key TEXT PRIMARY KEY NOT NULL, value BLOB)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS fdict_header (key TEXT PRIMARY KEY NOT NULL, value BLOB)')
+        self.conn.commit()
+
+    def get_header(self):
+        '''Return the header stored in the database, or an empty dict'''
+        row = self.conn.execute("SELECT value FROM fdict_header WHERE key = 'header'").fetchone()
+        return self._loads(row[0]) if row is not None else {}
+
+    def set_header(self, header):
+        '''Store the header in the database (committed with the current transaction)'''
+        self.conn.execute("INSERT OR REPLACE INTO fdict_header VALUES ('header', ?)", (self._dumps(header),))
+
+    def _dumps(self, value):
+        return self._binary(pickle.dumps(value, self.protocol))
+
+    @staticmethod
+    def _loads(value):
+        return pickle.loads(bytes(value))
+
+    @staticmethod
+    def _checkkey(key):
+        '''Return key if it is a string, else raise a TypeError'''
+        if not isinstance(key, _basestring):
+            raise TypeError('sqlfdict keys must be strings, not %r' % (key,))
+        return key
+
+    @staticmethod
+    def _upperbound(prefix):
+        '''Smallest string greater than all the strings starting with prefix'''
+        return prefix[:-1] + _unichr(ord(prefix[-1])+1)
+
+    def __getitem__(self, key):
+        if not isinstance(key, _basestring):
+            # Never stored, but SQLite would match 1 with '1'
+            raise KeyError(key)
+        row = self.conn.execute('SELECT value FROM fdict WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return self._loads(row[0])
+
+    def getmany(self, keys, chunksize=500):
+        '''Return a dict of the values of the stored keys, fetched in sorted order with one query per chunk of keys (SQLite limits the number of parameters of a query)'''
+        loads = self._loads
+        found = {}
+        keys = sorted(set(k for k in keys if isinstance(k, _basestring)))
+        for i in _range(0, len(keys), chunksize):
+            chunk = keys[i:i+chunksize]
+            for k, v in self.conn.execute('SELECT key, value FROM fdict WHERE key IN (%s)' % ','.join('?' * len(chunk)), chunk):
+                found[k] = loads(v)
+        return found
+
+    def __setitem__(self, key, value):
+        self.conn.execute('INSERT OR REPLACE INTO fdict VALUES (?, ?)', (self._checkkey(key), self._dumps(value)))
+
+    def __delitem__(self, key):
+        if not isinstance(key, _basestring) or not self.conn.execute('DELETE FROM fdict WHERE key = ?', (key,)).rowcount:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return isinstance(key, _basestring) and self.conn.execute('SELECT 1 FROM fdict WHERE key = ?', (key,)).fetchone() is not None
+
+    def __iter__(self):
+        for row in self.conn.execute('SELECT key FROM fdict ORDER BY key'):
+            yield row[0]
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM fdict').fetchone()[0]
+
+    def iteritems(self):
+        loads = self._loads
+        for k, v in self.conn.execute('SELECT key, value FROM fdict ORDER BY key'):
+            yield k, loads(v)
+
+    def itervalues(self):
+        loads = self._loads
+        for row in self.conn.execute('SELECT value FROM fdict ORDER BY key'):
+            yield loads(row[0])
+
+    iterkeys = __iter__
+    if PY3:  # pragma: no cover
+        # Walk the table only once instead of one query per key
+        items = iteritems
+        values = itervalues
+
+    def update(self, other=(), **kwargs):
+        '''Store all items at once with a single prepared statement'''
+        if isinstance(other, dict):
+            other = fdict._getitermethods(other)[2]()
+        elif hasattr(other, 'keys'):
+            other = ((k, other[k]) for k in other.keys())
+        dumps = self._dumps
+        checkkey = self._checkkey
+        self.conn.executemany('INSERT OR REPLACE INTO fdict VALUES (?, ?)', ((checkkey(k), dumps(v)) for k, v in itertools.chain(other, kwargs.items())))
+
+    def iterprefix(self, prefix):
+        '''Walk all keys starting with prefix, in sorted order, with a range query. O(log n + m)'''
+        if not prefix:
+            return iter(self)
+        return (row[0] for row in self.conn.execute('SELECT key FROM fdict WHERE key >= ? AND key < ? ORDER BY key', (prefix, self._upperbound(prefix))))
+
+    def iterprefixitems(self, prefix):
+        '''Walk all items which key starts with prefix, in sorted order, with a range query. O(log n + m)'''
+        if not prefix:
+            return self.iteritems()
+        loads = self._loads
+        return ((k, loads(v)) for k, v in self.conn.execute('SELECT key, value FROM fdict WHERE key >= ? AND key < ? ORDER BY key', (prefix, self._upperbound(prefix))))
+
+    def ceiling(self, key):
+        '''Return the smallest key greater than or equal to key, or None. O(log n)'''
+        row = self.conn.execute('SELECT key FROM fdict WHERE key >= ? ORDER BY key LIMIT 1', (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def irange(self, start=None, stop=None, inclusive=True):
+        '''Walk the keys from start (included, or excluded if not inclusive) to stop (excluded) in sorted order with a range query, None for no bound. O(log n + m)'''
+        where, args = [], []
+        if start is not None:
+            where.append('key >= ?' if inclusive else 'key > ?')
+            args.append(start)
+        if stop is not None:
+            where.append('key < ?')
+            args.append(stop)
+        query = 'SELECT key FROM fdict%s ORDER BY key' % (' WHERE ' + ' AND '.join(where) if where else '')
+        return (row[0] for row in self.conn.execute(query, args))
+
+    def iterafter(self, key=None, limit=-1):
+        '''Return the list of the (at most limit) keys following key, in sorted order (from the first key if key is None). The query is finished when returning, so the database can then be modified'''
+        if key is None:
+            return [row[0] for row in self.conn.execute('SELECT key FROM fdict ORDER BY key LIMIT ?', (limit,))]
+        return [row[0] for row in self.conn.execute('SELECT key FROM fdict WHERE key > ? ORDER BY key LIMIT ?', (key, limit))]
+
+    def delprefix(self, prefix):
+        '''Delete all items which key starts with prefix with one range query, and return the number of deleted items'''
+        return self.conn.execute('DELETE FROM fdict WHERE key >= ? AND key < ?', (prefix, self._upperbound(prefix))).rowcount
+
+    def sync(self):
+        '''Commit the current transaction'''
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+def _getvalues(d, keys):
+    '''Get the values of a list of keys from an internal dict, in one batch if it supports it (see lrushelf.getmany() and sqlshelf.getmany())'''
+    getmany = getattr(d, 'getmany', None)
+    if getmany is not None:
+        found = getmany(keys)
+        return [found[k] for k in keys]
+    return [d[k] for k in keys]
+
+def _mapreduce_partial(d, keys, mapper, reducer, lprefix):
+    '''Map the leaves of a list of full keys then reduce them, return (True, result), or (False, None) if there is no key'''
+    mapped = (mapper(k[lprefix:] if lprefix else k, v) for k, v in _zip(keys, _getvalues(d, keys)))
+    try:
+        result = next(mapped)
+    except StopIteration:
+        return False, None
+    for value in mapped:
+        result = reducer(result, value)
+    return True, result
+
+_mapreduce_state = {}  # internal dict, mapper, reducer and prefix length of the map_reduce() in the current worker process
+
+def _mapreduce_init(spec, mapper, reducer, lprefix):
+    '''Initialize a map_reduce() worker process: open a read-only handle to the database, or use the snapshot of the internal dict'''
+    kind, arg = spec
+    if kind == 'db':
+        dclass, kwargs = arg
+        d = dclass(**kwargs).d
+    else:
+        d = arg
+    _mapreduce_state.update(d=d, mapper=mapper, reducer=reducer, lprefix=lprefix)
+
+def _mapreduce_task(keys):
+    '''Map and reduce a partition of leaves in a worker process'''
+    state = _mapreduce_state
+    return _mapreduce_partial(state['d'], keys, state['mapper'], state['reducer'], state['lprefix'])
 
 
 class fdict(dict):
@@ -53,8 +1242,22 @@ class fdict(dict):
     Main limitation: an entry can be both a singleton and a nested fdict: when an item is a singleton, you can setitem to replace to a nested dict, but if it is a nested dict and you setitem it to a singleton, both will coexist. Except for fastview mode, there is no way to know if a nested dict exists unless you walk through all items, which would be too consuming for a simple setitem. In this case, a getitem will always return the singleton, but nested leaves can always be accessed via items() or by direct access (eg, x['a/b/c']).
 
     Fastview mode: remove conflicts issue and allow for fast O(m) contains(), delete() and view*() (such as vieitems()) where m in the number of subitems, instead of O(n) where n was the total number of elements in the fdict(). Downside is setitem() being O(m) too because of nodes metadata building, and memory/storage overhead, since we store all nodes and leaves lists in order to allow for fast lookup.
+
+    Sorted index: keep a sorted list of all keys next to the internal dict, so that all operations on nodes (view*() with a rootpath, contains() and delete()) cost O(log n + m) by bisecting instead of O(n). Downside is that setitem() costs O(log n) and the index is kept in memory.
+
+    Trie mode: like fastview mode, remove conflicts issue and allow for fast O(m) contains(), delete() and view*(), but nodes are stored in a trie of relative key segments kept in memory next to the internal dict, instead of sets of full paths stored inside the internal dict.
+
+    Threadsafe mode: all methods are locked by a reader-writer lock shared with the nested fdicts, so that readers do not block each other, whereas modifications (including their metadata updates, subtree deletions and update()) are atomic. Lazy iterators (view*(), glob(), etc) hold the lock for reading until they are exhausted or closed, so that they never see a concurrent modification.
     '''
-    def __init__(self, d=None, rootpath='', delimiter='/', fastview=False, nodel=False, **kwargs):
+    # Methods locked in threadsafe mode (see _lockedclass)
+    _readmethods = ('__getitem__', '__contains__', '__len__', '__eq__', '__ne__', '__repr__', '__str__', 'getmany', 'to_array', 'to_columns', 'page',
+                    'copy', 'to_dict', 'extract', 'to_dict_nested', 'export_json', 'firstkey', 'firstitem', 'firstvalue', 'map_reduce') + (() if PY3 else ('keys', 'values', 'items'))
+    _writemethods = ('__setitem__', '__delitem__', 'update', 'update_iter', 'load_json', 'setmany', 'from_array', 'pop', 'popitem')
+    _itermethods = ('viewkeys', 'viewvalues', 'viewitems', 'iterkeys', 'itervalues', 'iteritems', 'viewkeys_restrict', 'viewvalues_restrict', 'viewitems_restrict',
+                    'irange', 'irangeitems', 'glob', 'match', 'iter_columns') + (('keys', 'values', 'items') if PY3 else ())
+    _lock = None  # reader-writer lock shared with nested fdicts in threadsafe mode
+
+    def __init__(self, d=None, rootpath='', delimiter='/', fastview=False, nodel=False, sortedindex=False, trie=False, counting=False, viewcache=1000, threadsafe=False, **kwargs):
         '''
         Parameters
         ----------
@@ -69,7 +1272,7 @@ class fdict(dict):
             [default : '/']
         fastview  : bool, optional
             Activates fastview mode, which makes setitem slower
-            in O(m*l) instead of O(1), but makes view* methods
+            in O(m+l) instead of O(1), but makes view* methods
             (viewitem, viewkeys, viewvalues) as fast as dict's.
             [default : False]
         nodel  : bool, optional
@@ -80,6 +1283,39 @@ class fdict(dict):
             reopen the database with a normal fdict if you want
             the ability to delitem.
             [default : False]
+        sortedindex  : bool, optional
+            Maintains a sorted index of all keys, which makes
+            view* methods, contains and delitem on nodes
+            in O(log n + m) instead of O(n), where m is the
+            number of items under the node. Setitem becomes O(log n).
+            Also used internally to pass the index to nested fdicts.
+            [default : False]
+        trie  : bool, optional
+            Activates trie mode, which like fastview mode makes
+            view* methods, contains and delitem on nodes in O(m),
+            and replaces nodes and leaves without conflicts, but
+            stores the nodes as a trie of relative key segments
+            in memory instead of sets of full keys in the internal dict.
+            Also used internally to pass the trie to nested fdicts.
+            [default : False]
+        counting  : bool, optional
+            Maintains the number of leaves under each node,
+            which makes len() O(1) on any node in any mode.
+            Setitem and delitem become O(m) where m is the
+            number of parents of the leaf.
+            [default : False]
+        viewcache  : int, optional
+            Maximum number of nested fdicts (returned by getitem
+            on nodes) to cache and reuse, so that chained accesses
+            like ``x['a']['b']['c']`` do not build new objects
+            each time. 0 or None to disable.
+            [default : 1000]
+        threadsafe  : bool, optional
+            Lock all methods with a reader-writer lock, so that
+            the fdict can be shared by threads: any number of
+            readers, or one writer at a time. Modifying it while
+            iterating in the same thread waits for the other readers.
+            [default : False]
         Returns
         -------
         out  : dict-like object.
@@ -87,9 +1323,18 @@ class fdict(dict):
         # Init self parameters
         self.rootpath = rootpath
         self.delimiter = delimiter
+        self._rootprefix = (rootpath, rootpath+delimiter if rootpath else '')  # cache of the prefix of all full keys under rootpath
         self.fastview = fastview
         self.nodel = nodel
         self.kwargs = kwargs  # store all kwargs for easy subclassing
+        # Cache of nested fdicts, shared with all nested fdicts
+        self._viewcache = {} if viewcache else None
+        self._viewcachesize = viewcache
+        # Sorted index of keys and trie of nodes, shared with nested fdicts just like the internal dict
+        self.index = sortedindex if isinstance(sortedindex, sortedkeys) else None
+        self.trie = trie if isinstance(trie, keytrie) else None
+        # Number of leaves under each node (root is '', other nodes end with the delimiter), shared with nested fdicts
+        self.counts = None
 
         if d is not None:
             if rootpath:
@@ -121,6 +1366,22 @@ class fdict(dict):
 
         # Call compatibility layer
         self._viewkeys, self._viewvalues, self._viewitems = self._getitermethods(self.d)
+        # Does the internal dict keep its keys sorted and support prefix queries (eg, sqlshelf)?
+        self._ordered = callable(getattr(self.d, 'iterprefix', None))
+        # Out-of-core dicts (eg, shelve) deserialize values on access, so we filter keys before fetching values
+        self._keyfirst = not isinstance(self.d, dict)
+
+        if sortedindex and self.index is None:
+            # Build the index once all items and metadata are stored
+            self.index = sortedkeys(self._viewkeys())
+        if trie and self.trie is None:
+            self.trie = keytrie(self._viewkeys(), delimiter=delimiter)
+        if counting:
+            self._build_counts()
+
+        if threadsafe:
+            self._lock = rwlock()
+            self.__class__ = _lockedclass(self.__class__)
 
     @staticmethod
     def _getitermethods(d):
@@ -206,74 +1467,210 @@ class fdict(dict):
 
         v0.1.0 by bfontaine, MIT license
         """
-        flat = {}
-        dicts = [("", d)]
-
-        while dicts:
-            prefix, d = dicts.pop()
-            for k, v in d.items():
-                k_s = str(k)
-                if isinstance(v, collections.Mapping):
-                    dicts.append(("%s%s%s" % (prefix, k_s, sep), v))
+        return dict(fdict.flatkeys_iter(d, sep=sep))
+
+    @staticmethod
+    def flatkeys_iter(d, sep="/", prefix=""):
+        '''Flatten a dictionary lazily: same as flatkeys() but yields the (flattened key, value) of each leaf instead of building a flat copy.
+        Nested dicts are walked depth-first with a stack of iterators, so that only the path from the root to the current node is kept in memory.'''
+        stack = [(prefix, iter(d.iteritems() if hasattr(d, 'iteritems') else d.items()))]
+        while stack:
+            prefix, items = stack[-1]
+            for k, v in items:
+                # Root-level keys keep their type, nested keys are joined so they must be converted to strings (only if they are not already)
+                k_s = k if isinstance(k, _basestring) else str(k)
+                if isinstance(v, _Mapping):
+                    # Walk the nested dict first, we will resume this one afterwards
+                    stack.append((prefix + k_s + sep, iter(v.iteritems() if hasattr(v, 'iteritems') else v.items())))
+                    break
                 else:
-                    k_ = prefix + k_s if prefix else k
-                    flat[k_] = v
-        return flat
+                    yield (prefix + k_s if prefix else k), v
+            else:
+                # All items of this dict were walked
+                stack.pop()
 
     def _build_path(self, key=''):
-        '''Build full path of current key given the rootpath'''
-        # TODO: replace internal keys by mutableobjects instead of strings, it wil make appending much faster!
+        '''Build full path of current key given the rootpath. The prefix (rootpath + delimiter) is cached so that only one concatenation is needed, and root-level keys keep their type (eg, ints)'''
         rootpath = self.rootpath
-        return "%s%s%s" % (rootpath, self.delimiter, key) if rootpath else key
+        if not rootpath:
+            return key
+        cached_rootpath, prefix = self._rootprefix
+        if rootpath is not cached_rootpath:
+            # rootpath was changed, update the cached prefix
+            prefix = rootpath + self.delimiter
+            self._rootprefix = (rootpath, prefix)
+        return prefix + key if isinstance(key, _basestring) else prefix + str(key)
+
+    def _keys_added(self, fullkeys):
+        '''Update the sorted index and the trie (if any) with full keys that were just stored in the internal dict'''
+        trie = self.trie
+        if trie is not None:
+            fullkeys = list(fullkeys)
+            displaced = []
+            for k in fullkeys:
+                displaced.extend(trie.add(k))
+            if displaced:
+                # Trie mode: a new leaf replaces the conflicting leaves
+                for k in displaced:
+                    self.d.__delitem__(k)
+                self._keys_removed(displaced, trie=False)
+        if self.index is not None:
+            self.index.update(fullkeys)
+
+    def _keys_removed(self, fullkeys, trie=True):
+        '''Update the sorted index and the trie (if any) with full keys that were just removed from the internal dict'''
+        index = self.index
+        if index is not None:
+            for k in fullkeys:
+                index.discard(k)
+        if trie and self.trie is not None:
+            for k in fullkeys:
+                self.trie.remove(k)
+        if self.counts is not None:
+            self._count_keys(fullkeys, -1)
+
+    def _build_counts(self):
+        '''Count from scratch the number of leaves under each node. Only for counting mode.'''
+        self.counts = {'': 0}
+        self._count_keys(self._viewkeys())
+
+    def _count_keys(self, fullkeys, inc=1):
+        '''Add inc to the leaves counters of the root and of all parents of each full key. Nodes metadata are skipped, and callers must only supply leaves that were not already stored (or that were really removed). Only for counting mode.'''
+        counts = self.counts
+        delimiter = self.delimiter
+        total = 0
+        for k in fullkeys:
+            if isinstance(k, _basestring):
+                if k[-1:] == delimiter:
+                    # Node metadata (fastview or nodel mode), not a leaf
+                    continue
+                for parent in self._get_all_parent_nodes(k, delimiter):
+                    c = counts.get(parent, 0) + inc
+                    if c:
+                        counts[parent] = c
+                    else:
+                        del counts[parent]
+            total += inc
+        counts[''] += total
+
+    def _iterprefix(self, pattern):
+        '''Walk all full keys starting with pattern (ie, all keys under the node pattern). O(log n + m) with the sorted index or an ordered internal dict, else O(n)'''
+        if self.index is not None:
+            return self.index.iterprefix(pattern)
+        elif self._ordered:
+            # The internal dict is sorted, let it do a range query
+            return self.d.iterprefix(pattern)
+        else:
+            return (k for k in self._prefixkeys(pattern) if isinstance(k, _basestring) and k.startswith(pattern))  # root-level keys that are not strings are under no node
+
+    def _prefixkeys(self, pattern):
+        '''Walk the keys of the internal dict that can start with pattern: all of them, except with a sharded database where only the shard of the node pattern is walked when it is deep enough'''
+        prefixkeys = getattr(self.d, 'prefixkeys', None)
+        return prefixkeys(pattern) if prefixkeys is not None else self._viewkeys()
+
+    def _nonstringkeys(self):
+        '''Get the keys of the leaves under the current node that are not strings (eg, ints), which can only be at root level, sorted if they can be compared. O(1) with the sorted index which keeps them aside, O(n) else, whereas out-of-core dicts only store string keys'''
+        if self.rootpath or self._keyfirst:
+            return []
+        if self.index is not None:
+            keys = list(self.index.others)
+        else:
+            keys = [k for k in self._viewkeys() if not isinstance(k, _basestring)]
+        try:
+            keys.sort()
+        except TypeError:  # pragma: no cover
+            # Keys of different types on Python 3, keep the order
+            pass
+        return keys
+
+    def _iterprefixitems(self, pattern):
+        '''Walk all full items which key starts with pattern. O(log n + m) with the sorted index or an ordered internal dict, else O(n)'''
+        if self._ordered:
+            # The internal dict is sorted, let it do a range query
+            return self.d.iterprefixitems(pattern)
+        elif self.index is not None:
+            d = self.d
+            return ((k, d.__getitem__(k)) for k in self.index.iterprefix(pattern))
+        elif self._keyfirst:
+            # Out-of-core dict: filter on the keys first, so that only the matching values get deserialized
+            d = self.d
+            return ((k, d.__getitem__(k)) for k in self._prefixkeys(pattern) if k.startswith(pattern))
+        else:
+            return ((k, v) for k,v in self._viewitems() if isinstance(k, _basestring) and k.startswith(pattern))
 
     def _build_metadata(self, fullkeys=None):
         '''Build metadata to make viewitem and other methods using item resolution faster.
         Provided a list of full keys, this method will build parent nodes to point all the way down to the leaves.
         If no list is provided, metadata will be rebuilt for the whole dict.
+        Metadata is built in bulk in O(l+m) where l is the number of leaves and m the number of distinct parent nodes: all the children of each node are first gathered in a temporary dict, and the walk up to the root stops as soon as a node was already visited or already exists (its own parents were then already processed), then the sets of children are merged into the internal dict with only one access per node.
         Only for fastview mode.'''
 
         if fullkeys is None:
             fullkeys = list(self._generickeys(self.d))  # need to make a copy else RuntimeError because dict size will change
 
         delimiter = self.delimiter
+        d = self.d
+        # Gather the direct children of each parent node
+        nodes = {}
+        existing = set()
         for fullkey in fullkeys:
-            if not fullkey[-1:] == delimiter:
-                # Create additional entries for each parent at every depths of the current leaf
-                parents = self._get_all_parent_nodes(fullkey, self.delimiter)
-
+            if isinstance(fullkey, _basestring) and not fullkey[-1:] == delimiter:
                 # First parent stores the direct path to the leaf
                 # Then we recursively add the path to the nested parent in all super parents.
                 lastparent = fullkey
-                for parent in parents:
-                    if parent in self.d:
-                        # There is already a parent entry, we add to the set
-                        self.d.__getitem__(parent).add(lastparent)
-                    else:
-                        # Else we create a set and add this child
-                        self.d.__setitem__(parent, set([lastparent]))
+                for parent in self._get_all_parent_nodes(fullkey, delimiter):
+                    if parent in nodes:
+                        # Parent node already visited, so all its own parents were already processed
+                        nodes[parent].add(lastparent)
+                        break
+                    nodes[parent] = set([lastparent])
+                    if parent in d:
+                        # Parent node already stored, so it is already linked to its own parents
+                        existing.add(parent)
+                        break
                     lastparent = parent
 
+        # Merge with the nodes in the internal dict
+        newnodes = []
+        for parent, children in self._genericitems(nodes):
+            if parent in existing:
+                # There is already a parent entry, we merge the sets (and reassign so that out-of-core dicts without writeback also store the change)
+                pset = d.__getitem__(parent)
+                pset.update(children)
+                d.__setitem__(parent, pset)
+            else:
+                # Else we just store the set of children
+                d.__setitem__(parent, children)
+                newnodes.append(parent)
+        self._keys_added(newnodes)
+
     def _build_metadata_nodel(self, fullkeys=None):
         '''Build metadata to make contains faster.
         Provided a list of full keys, this method will build parent nodes to point all the way down to the leaves.
         If no list is provided, metadata will be rebuilt for the whole dict.
+        Each distinct parent node is visited only once.
         Only for nodel mode.'''
 
         if fullkeys is None:
             fullkeys = list(self._generickeys(self.d))  # need to make a copy else RuntimeError because dict size will change
 
         delimiter = self.delimiter
+        d = self.d
+        visited = set()
+        newnodes = []
         for fullkey in fullkeys:
-            if not fullkey[-1:] == delimiter:
+            if isinstance(fullkey, _basestring) and not fullkey[-1:] == delimiter:
                 # Create additional entries for each parent at every depths of the current leaf
-                parents = self._get_all_parent_nodes(fullkey, self.delimiter)
-
-                # First parent stores the direct path to the leaf
-                # Then we recursively add the path to the nested parent in all super parents.
-                for parent in parents:
-                    if not parent in self.d:
+                for parent in self._get_all_parent_nodes(fullkey, delimiter):
+                    if parent in visited:
+                        # Parent node already visited, so all its own parents were already processed
+                        break
+                    visited.add(parent)
+                    if not parent in d:
                         # If parent not in dict, we create it
-                        self.d.__setitem__(parent, None)
+                        d.__setitem__(parent, None)
+                        newnodes.append(parent)
+        self._keys_added(newnodes)
 
     def __getitem__(self, key):
         '''Get an item given the key. O(1) in any case: if the item is a leaf, direct access, else if it is a node, a new fdict will be returned with a different rootpath but sharing the same internal dict.'''
@@ -282,11 +1679,218 @@ class fdict(dict):
         if fullkey in self.d: # Leaf: return the value (leaf direct access test is why we do `in self.d` and not `in self`)
             return self.d.__getitem__(fullkey)
         else: # Node: return a new full fdict based on the old one but with a different rootpath to limit the results by default (this is the magic that allows compatibility with the syntax d['item1']['item2'])
-            return self.__class__(d=self.d, rootpath=fullkey, delimiter=self.delimiter, fastview=self.fastview, nodel=self.nodel, **self.kwargs)
+            return self._get_view(fullkey)
+
+    def _get_view(self, rootpath):
+        '''Get a nested fdict with a different rootpath but sharing the same internal dict (and all other parameters).
+        The nested fdict is a shallow clone of the current one (so that subclasses do not parse again their parameters), and is cached to be reused by the next accesses to the same node, unless its rootpath was changed meanwhile: a new one then replaces it.'''
+        cache = self._viewcache
+        if cache is not None:
+            view = cache.get(rootpath)
+            if view is not None and view.d is self.d and view.rootpath == rootpath:
+                return view
+        view = self.__class__.__new__(self.__class__)
+        view.__dict__.update(self.__dict__)
+        view.rootpath = rootpath
+        view._rootprefix = (rootpath, rootpath+self.delimiter)
+        if cache is not None:
+            if len(cache) >= self._viewcachesize:
+                cache.clear()
+            cache[rootpath] = view
+        return view
+
+    def _evict_views(self, rootpath):
+        '''Remove from the cache the nested fdicts of a deleted node and of its subnodes'''
+        cache = self._viewcache
+        if cache:
+            pattern = rootpath+self.delimiter
+            for k in [k for k in cache if k == rootpath or k.startswith(pattern)]:
+                del cache[k]
+
+    def getmany(self, keys):
+        '''Get many items at once, returned as a list in the same order as keys: like getitem, the value of a leaf, or a nested fdict for a node.
+        The paths are built in bulk, then the leaves are fetched in one pass by the internal dict if it supports it (sorted reads and one decoding pass with sfdict, one query per chunk of keys with sqlfdict).'''
+        if self.rootpath:
+            build_path = self._build_path
+            fullkeys = [build_path(k) for k in keys]
+        else:
+            fullkeys = list(keys)
+        d = self.d
+        getmany = getattr(d, 'getmany', None)
+        if getmany is not None:
+            found = getmany([k for k in fullkeys if isinstance(k, _basestring)])
+        else:
+            found = dict((k, d.__getitem__(k)) for k in fullkeys if k in d)
+        get_view = self._get_view
+        return [found[k] if k in found else get_view(k) for k in fullkeys]
+
+    def setmany(self, items):
+        '''Set many items at once, given as a dict or an iterable of (key, value) pairs (values can be nested dicts), like update(). The leaves are sorted by key for the locality of on-disk writes, then stored in one batch, so that the metadata (fastview or nodel), sorted index, trie and counters are updated once for all the items. Return the number of leaves stored.'''
+        if isinstance(items, _Mapping):
+            items = self._getitermethods(items)[2]()
+        delimiter = self.delimiter
+        flatkeys_iter = self.flatkeys_iter
+        leaves = list(itertools.chain.from_iterable((flatkeys_iter({k: v}, sep=delimiter) if isinstance(v, _Mapping) else ((k, v),)) for k, v in items))
+        try:
+            leaves.sort(key=lambda item: item[0])
+        except TypeError:  # pragma: no cover
+            # Keys of different types on Python 3, keep the order
+            pass
+        if leaves:
+            self._bulk_set(leaves)
+        return len(leaves)
+
+    def to_array(self, keys=None, dtype=float, return_keys=False):
+        '''Get the values of many numeric leaves under the current node as a contiguous 1-dimensional numpy array (numpy is only imported when calling this method).
+        keys are the keys of the leaves relative to the current node, by default all the leaves under the node in sorted key order (see irange(), which is O(log n + m) with the sorted index or sqlfdict). The values are fetched in one batch with getmany(), then copied in one pass into an array preallocated with the given dtype. Each leaf is a separate object in the internal dict, so the values are still copied one by one, there is no zero-copy view on the leaves.
+        If return_keys is True, return a tuple (keys, array).'''
+        import numpy
+        if keys is None:
+            keys = list(self.irange())
+        else:
+            keys = list(keys)
+        array = numpy.fromiter(self.getmany(keys), dtype=dtype, count=len(keys))
+        return (keys, array) if return_keys else array
+
+    def from_array(self, prefix, array, keys=None):
+        '''Store the values of a 1-dimensional array (numpy array or any sequence) as leaves under the node prefix (relative to the current node, '' for the current node), in one batch with setmany().
+        keys are the keys of the leaves relative to the prefix node, by default the indices zero-padded to the same width, so that to_array() returns the values in the same order. Return the number of leaves stored.'''
+        if getattr(array, 'ndim', 1) != 1:
+            raise ValueError('Only 1-dimensional arrays can be stored, got %i dimensions' % array.ndim)
+        # Convert to Python scalars in one pass (also avoids pickling numpy scalars)
+        values = array.tolist() if hasattr(array, 'tolist') else list(array)
+        if keys is None:
+            width = len(str(len(values)-1)) if values else 1
+            keys = ('%0*i' % (width, i) for i in _range(len(values)))
+        prefix = prefix+self.delimiter if prefix else ''
+        return self.setmany([(prefix+k if isinstance(k, _basestring) else prefix+str(k), v) for k, v in _zip(keys, values)])
+
+    @staticmethod
+    def _column_array(values, numpy=None):
+        '''Convert a column of values to a numpy array if numpy is supplied, else to a Python array if all values are floats or all are integers, else keep the list'''
+        if numpy is not None:
+            return numpy.array(values)
+        if values:
+            typ = type(values[0])
+            if typ in (float, int) and all(type(v) is typ for v in values):
+                try:
+                    return array.array('d' if typ is float else _INT64_TYPECODE, values)
+                except (ValueError, OverflowError):  # pragma: no cover
+                    # Integers too big
+                    pass
+        return values
+
+    def iter_columns(self, fields=None, chunksize=10000, use_numpy=None):
+        '''Walk the records under the current node (eg, users/<id>/{name,age,score}) as columns, by chunks of chunksize records, yielding (rowkeys, columns) where rowkeys is the list of records keys and columns a dict of field -> array of values.
+        The leaves are walked once in sorted key order (see export_json() for the complexity), so that the leaves of each record are contiguous, and only the current chunk is kept in memory. A field is the rest of the key after the record key (eg, 'stats/latency'), and leaves directly under the current node (including the root-level keys that are not strings, eg, ints) are not records so they are skipped.
+        fields is the list of fields to extract, by default all the fields found so far, in the order they were found. Missing values are None. Columns are numpy arrays if use_numpy is True, or None (default) and numpy is installed, else Python arrays for columns of only floats or only integers, and lists for the others.
+        chunksize None yields all the records in one chunk, a ValueError is raised if it is less than 1.'''
+        if chunksize is not None and chunksize < 1:
+            raise ValueError('iter_columns() chunksize must be at least 1 or None, got %r' % (chunksize,))
+        numpy = None
+        if use_numpy or use_numpy is None:
+            try:
+                import numpy
+            except ImportError:
+                if use_numpy:
+                    raise
+        delimiter = self.delimiter
+        ldelimiter = len(delimiter)
+        wanted = set(fields) if fields is not None else None
+        order = list(fields) if fields is not None else []  # fields in the order of the columns
+        rowkeys = []
+        columns = dict((f, []) for f in order)
+        row = None
+        for k, v in self._iterleaves_sorted():
+            pos = k.find(delimiter) if isinstance(k, _basestring) else -1
+            if pos == -1:
+                # Leaf directly under the node, not a record
+                continue
+            rowkey = k[:pos]
+            if rowkey != row:
+                # New record: pad the columns of the fields missing in the previous record
+                n = len(rowkeys)
+                for col in columns.values():
+                    if len(col) < n:
+                        col.append(None)
+                if chunksize and n >= chunksize:
+                    yield rowkeys, dict((f, self._column_array(columns[f], numpy)) for f in order)
+                    rowkeys = []
+                    columns = dict((f, []) for f in order)
+                row = rowkey
+                rowkeys.append(rowkey)
+            field = k[pos+ldelimiter:]
+            if wanted is not None and not field in wanted:
+                continue
+            col = columns.get(field)
+            if col is None:
+                # New field, missing in the previous records of the chunk
+                col = columns[field] = [None] * (len(rowkeys)-1)
+                order.append(field)
+            col.append(v)
+        n = len(rowkeys)
+        for col in columns.values():
+            if len(col) < n:
+                col.append(None)
+        if rowkeys or (row is None and fields is not None):
+            yield rowkeys, dict((f, self._column_array(columns[f], numpy)) for f in order)
+
+    def _mapreduce_spec(self):
+        '''How the worker processes of map_reduce() access the internal dict: a snapshot (copy-on-write with fork), or None to map the leaves in the current process'''
+        return ('snapshot', self.d)
+
+    def map_reduce(self, mapper, reducer, initial=None, workers=None, chunksize=10000, fullpath=False):
+        '''Map every leaf under the current node with mapper(key, value), then combine the results with reducer(result1, result2), in parallel in worker processes, like functools.reduce(reducer, (mapper(k, v) for k, v in self.viewitems()), initial) (initial is used only if it is not None).
+        The keys are walked in sorted order (see irange()) and split into partitions of chunksize leaves, ie, by key range, so that a subtree is processed by as few workers as possible. Each worker maps and reduces the partitions it gets, then the partial results are reduced in key order by the calling process, so reducer must be associative. workers is the number of processes (by default the number of CPUs), if 1 or less, everything is done in the current process.
+        With sfdict and sqlfdict, the database is synced (and reopened if the dbm backend has no sync(), eg, ndbm) then each worker opens its own read-only handle, except with gdbm which cannot be read while it is open for writing, so the leaves are mapped in the current process, whereas with fdict, the workers get a snapshot of the internal dict (shared copy-on-write where processes are forked, else pickled once per worker). With the spawn start method (Windows), mapper and reducer must be picklable, eg, module-level functions. A ValueError is raised if chunksize is less than 1.'''
+        if chunksize < 1:
+            raise ValueError('map_reduce() chunksize must be at least 1, got %r' % (chunksize,))
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        prefix = self._build_path('') if self.rootpath else ''
+        lprefix = len(prefix) if not fullpath else 0
+        keys = iter(self._irangekeys())
+        tasks = iter(lambda: list(itertools.islice(keys, chunksize)), [])
+        if not prefix and not self._keyfirst:
+            # Root-level keys that are not strings (eg, ints) cannot be sorted with the others
+            tasks = itertools.chain(tasks, [[k for k in self._viewkeys() if not isinstance(k, _basestring)]])
+        spec = self._mapreduce_spec() if workers > 1 else None
+        if spec is None:
+            d = self.d
+            partials = (_mapreduce_partial(d, task, mapper, reducer, lprefix) for task in tasks)
+            pool = None
+        else:
+            pool = multiprocessing.Pool(workers, initializer=_mapreduce_init, initargs=(spec, mapper, reducer, lprefix))
+            def submit():
+                # The partitions are submitted from this thread (the internal dict may not be usable from another one, eg, SQLite), and at most 2 per worker are pending, so that the keys are not all read in memory ahead
+                pending = collections.deque()
+                for task in tasks:
+                    pending.append(pool.apply_async(_mapreduce_task, (task,)))
+                    if len(pending) >= 2 * workers:
+                        yield pending.popleft().get()
+                while pending:
+                    yield pending.popleft().get()
+            partials = submit()
+        try:
+            result, started = initial, initial is not None
+            for found, partial in partials:
+                if found:
+                    result = reducer(result, partial) if started else partial
+                    started = True
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        return result
+
+    def to_columns(self, fields=None, use_numpy=None):
+        '''Get the records under the current node (eg, users/<id>/{name,age,score}) as columns in one pass, without building the nested dict: return (rowkeys, columns) where columns is a dict of field -> array of values. See iter_columns()'''
+        for rowkeys, columns in self.iter_columns(fields, chunksize=None, use_numpy=use_numpy):
+            return rowkeys, columns
+        return [], {}
 
     def __setitem__(self, key, value):
-        '''Set an item given the key. Supports for direct setting of nested elements without prior dict(), eg, x['a/b/c'] = 1. O(1) to set the item. If fastview mode, O(m*l) because of metadata building where m is the number of parents of current leaf, and l the number of leaves (if provided a nested dict).'''
-        # TODO: fastview mode can setitem buildmetadata in O(2*(l+m)) linear time instead of O(l*m) quadratic time by first walking nodes and leafs of input dict and finally just merge the nodes sets with self.d, so we walk each parent only once, instead of walking each leaf and then each parent of each leaf repetitively.
+        '''Set an item given the key. Supports for direct setting of nested elements without prior dict(), eg, x['a/b/c'] = 1. O(1) to set the item. If fastview mode, O(m+l) because of metadata building where m is the number of parents of current leaf, and l the number of leaves (if provided a nested dict).'''
         # Build the fullkey
         fullkey = self._build_path(key)
 
@@ -296,10 +1900,11 @@ class fdict(dict):
 
             # First we need to delete the previous value if it was a singleton or a node
             # (so we also need to delete all subitems recursively if it was a node)
-            if not self.fastview:
+            if not self.fastview and self.trie is None:
                 if fullkey in self.d:
                     # With non-fastview fdict, can only delete singleton, not nodes
-                    self.d.__delitem__(key)
+                    self.d.__delitem__(fullkey)
+                    self._keys_removed([fullkey])
             else:
                 if fullkey in self:
                     self.__delitem__(key)
@@ -312,19 +1917,12 @@ class fdict(dict):
                 # else not empty dict, we will merge using update
                 # merge d2 with self.d
                 if isinstance(value, self.__class__):
-                    # If it is the same class as this, we merge
+                    # If it is the same class as this, we merge (update() also takes care of the metadata)
                     d2 = self.__class__({key: value})
                     self.update(d2)
                 else:
-                    # If this is just a normal dict, we flatten it and merge
-                    d2 = self.flatkeys({self._build_path(key): value}, sep=self.delimiter)
-                    self.d.update(d2)
-                # update metadata
-                if self.fastview:
-                    self._build_metadata(self._generickeys(d2))
-                # update metadata with nodel mode: just create empty nodes to signal the existence
-                elif self.nodel:
-                    self._build_metadata_nodel(self._generickeys(d2))
+                    # If this is just a normal dict, we stream its leaves by batches (update_iter also takes care of the metadata)
+                    self.update_iter({key: value})
         else:
             # if the value is not a dict, we consider it a singleton/leaf, and we just build the full key and store the value as is
             if self.fastview:
@@ -335,7 +1933,7 @@ class fdict(dict):
                     # If this key was a nested dict before, we need to delete it recursively (with all subelements) and also delete pointer from parent node
                     self.__delitem__(key)
                 # This key did not exist before but a parent is a singleton
-                parents = self._get_all_parent_nodes(fullkey)
+                parents = self._get_all_parent_nodes(fullkey, self.delimiter)
                 for parent in parents:
                     parentleaf = parent[:len(parent)-1]
                     if parentleaf in self.d:
@@ -346,7 +1944,10 @@ class fdict(dict):
                 # update metadata with nodel mode: just an create empty node to signal its existence
                 self._build_metadata_nodel([fullkey])
             # and finally add the singleton as a leaf
+            if self.counts is not None and not fullkey in self.d:
+                self._count_keys([fullkey])
             self.d.__setitem__(fullkey, value)
+            self._keys_added([fullkey])
 
     def __delitem__(self, key, fullpath=False):
         '''Delete an item in the internal dict, O(1) for any leaf, O(n) for a nested dict'''
@@ -361,20 +1962,34 @@ class fdict(dict):
         else:
             fullkey = key
 
-        if fullkey in self.d:
+        if self.trie is not None and not fullkey in self.d:
+            # Trie mode: walk the trie down to the node and delete all its leaves
+            self._evict_views(fullkey)
+            keystodel = self.trie.removenode(fullkey)
+            if not keystodel:
+                raise KeyError(key)
+            for k in keystodel:
+                self.d.__delitem__(k)
+            self._keys_removed(keystodel, trie=False)
+            return
+        elif fullkey in self.d:
             # Key is a leaf, we can directly delete it
             if self.fastview:
                 # Remove current node from its parent node's set()
                 parentnode = self._get_parent_node(fullkey, self.delimiter)
                 if parentnode: # if the node is not 1st-level (because then the parent is the root, it's then a fdict, not a set)
-                    self.d.__getitem__(parentnode).remove(fullkey)
-                    if not self.d.__getitem__(parentnode):
+                    pset = self.d.__getitem__(parentnode)
+                    pset.remove(fullkey)
+                    self.d.__setitem__(parentnode, pset)  # reassign for out-of-core dicts without writeback
+                    if not pset:
                         # if the set is now empty, just delete the node (to signal that there is nothing below now)
                         self.__delitem__(parentnode, fullpath=True)  # recursive delete because the node is referenced by its parent
             # Delete the item!
+            self._keys_removed([fullkey])
             return self.d.__delitem__(fullkey)
         else:
             # Else there is no direct match, but might be a nested dict, we have to walk through all the dict
+            self._evict_views(fullkey)
             dirkey = fullkey+self.delimiter
             flagdel = False
             if self.fastview:
@@ -383,21 +1998,29 @@ class fdict(dict):
                 keystodel = [k for k in self.viewkeys(fullpath=True, nodes=True, rootpath=fullkey)]
                 # We can already delete the current node key
                 self.d.__delitem__(dirkey)
+                self._keys_removed([dirkey])
                 flagdel = True
                 # Remove current node from its parent node's set()
                 parentnode = self._get_parent_node(fullkey, self.delimiter)
                 if parentnode: # if the node is not 1st-level (because then the parent is the root, it's then a fdict, not a set)
-                    self.d.__getitem__(parentnode).remove(dirkey)  # delete current node metadata
-                    if not self.d.__getitem__(parentnode):
+                    pset = self.d.__getitem__(parentnode)
+                    pset.remove(dirkey)  # delete current node metadata
+                    self.d.__setitem__(parentnode, pset)  # reassign for out-of-core dicts without writeback
+                    if not pset:
                         # if the set is now empty, just delete the node (to signal that there is nothing below now)
                         self.__delitem__(parentnode[:len(parentnode)-1], fullpath=True)  # recursive delete because the node is referenced by its parent
             else:
-                # Walk through all items in the dict and delete the nodes or nested elements starting from the supplied node (if any)
-                keystodel = [k for k in self._viewkeys() if k.startswith(dirkey)]  # TODO: try to optimize with a generator instead of a list, but with viewkeys the dict is changing at the same time so we get runtime error!
+                # Walk through all items in the dict (or only the matching ones with the sorted index) and delete the nodes or nested elements starting from the supplied node (if any)
+                keystodel = list(self._iterprefix(dirkey))  # TODO: try to optimize with a generator instead of a list, but with viewkeys the dict is changing at the same time so we get runtime error!
 
             # Delete all matched keys
-            for k in keystodel:
-                self.d.__delitem__(k)
+            if self._ordered and not self.fastview and keystodel:
+                # The internal dict is sorted, delete the whole node with one range query
+                self.d.delprefix(dirkey)
+            else:
+                for k in keystodel:
+                    self.d.__delitem__(k)
+            self._keys_removed(keystodel)
 
             # Check if we deleted at least one key, else raise a KeyError exception
             if not keystodel and not flagdel:
@@ -413,13 +2036,21 @@ class fdict(dict):
             return True
         else:
             dirkey = fullkey+self.delimiter
-            if self.fastview or self.nodel:
+            if self.trie is not None:
+                # Trie mode: walk the trie down to the node in O(depth)
+                return self.trie.getnode(fullkey) is not None
+            elif self.fastview or self.nodel:
                 # Fastview mode: nodes are stored so we can directly check in O(1)
                 return self.d.__contains__(dirkey)
+            elif self.index is not None or self._ordered:
+                # Sorted index or ordered internal dict: bisect to the first key under the node, if any
+                for _ in self._iterprefix(dirkey):
+                    return True
+                return False
             else:
                 # Key might be a node, but we have to check all items
                 for k in self.viewkeys(fullpath=True):
-                    if k.startswith(dirkey):
+                    if isinstance(k, _basestring) and k.startswith(dirkey):
                         return True
                 return False
 
@@ -432,7 +2063,11 @@ class fdict(dict):
         delimiter = self.delimiter
         if not rootpath:
             # No rootpath, we do not have to do filtering based on rootpath, this simplifies a lot (and speed-up)
-            if self.fastview or self.nodel:
+            if self.trie is not None and nodes:
+                # Trie mode: nodes are only in the trie
+                for k, _ in self.trie.iterbranch(self.trie.root):
+                    yield k
+            elif self.fastview or self.nodel:
                 # Fastview mode or nodel mode: filter out nodes except if nodes=True
                 for k in self._viewkeys():
                     if nodes or not k[-1:] == delimiter:
@@ -444,7 +2079,14 @@ class fdict(dict):
         else:
             pattern = rootpath+delimiter
             lpattern = len(pattern) if not fullpath else 0 # return the shortened path or fullpath?
-            if self.fastview:
+            if self.trie is not None:
+                # Trie mode: walk only the branch of the node, relative keys are directly built from the trie segments
+                node = self.trie.getnode(rootpath)
+                if node is not None:
+                    for k, isnode in self.trie.iterbranch(node, pattern if fullpath else ''):
+                        if nodes or not isnode:
+                            yield k
+            elif self.fastview:
                 # Fastview mode
                 if pattern in self.d:
                     children = set()
@@ -462,10 +2104,10 @@ class fdict(dict):
             elif self.nodel:
                 # Nodel mode: take care of nodes (ending with the delimiter) depending on nodes=False or True
                 plen = len(pattern)  # if nodes, need to check if the current node is not the rootpath!
-                for k in (k[lpattern:] for k in self._viewkeys() if k.startswith(pattern) and ((nodes and len(k) != plen) or not k[-1:] == delimiter)):
+                for k in (k[lpattern:] for k in self._iterprefix(pattern) if ((nodes and len(k) != plen) or not k[-1:] == delimiter)):
                     yield k
             else:
-                for k in (k[lpattern:] for k in self._viewkeys() if k.startswith(pattern)):
+                for k in (k[lpattern:] for k in self._iterprefix(pattern)):
                     yield k
 
     def viewitems(self, fullpath=False, nodes=False, rootpath=None):
@@ -476,11 +2118,23 @@ class fdict(dict):
         delimiter = self.delimiter
         if not rootpath:
             # Return all items (because no rootpath, so no filter)
-            if self.fastview or self.nodel:
+            if self.trie is not None and nodes:
+                # Trie mode: nodes are only in the trie, they have no value
+                d = self.d
+                for k, isnode in self.trie.iterbranch(self.trie.root):
+                    yield k, (None if isnode else d.__getitem__(k))
+            elif self.fastview or self.nodel:
                 # Fastview mode, filter out nodes (ie, keys ending with delimiter) to keep only leaves
-                for k,v in self._viewitems():
-                    if not k[-1:] == delimiter or nodes:
-                        yield k,v
+                if self._keyfirst:
+                    # Out-of-core dict: filter on the keys first to avoid deserializing the nodes
+                    d = self.d
+                    for k in self._viewkeys():
+                        if not k[-1:] == delimiter or nodes:
+                            yield k, d.__getitem__(k)
+                else:
+                    for k,v in self._viewitems():
+                        if not k[-1:] == delimiter or nodes:
+                            yield k,v
             else:
                 # No fastview, just return the internal dict's items
                 for k,v in self._viewitems():
@@ -490,7 +2144,18 @@ class fdict(dict):
             # Prepare the pattern (the rootpath + delimiter) to filter items keys
             pattern = rootpath+self.delimiter
             lpattern = len(pattern) if not fullpath else 0 # return the shortened path or fullpath?
-            if self.fastview:
+            if self.trie is not None:
+                # Trie mode: walk only the branch of the node, nodes have no value
+                node = self.trie.getnode(rootpath)
+                if node is not None:
+                    d = self.d
+                    for k, isnode in self.trie.iterbranch(node, pattern):
+                        if isnode:
+                            if nodes:
+                                yield k[lpattern:], None
+                        else:
+                            yield k[lpattern:], d.__getitem__(k)
+            elif self.fastview:
                 # Fastview mode, get the list of items directly from the current entry, and walk recursively all children to get down to the leaves
                 if pattern in self.d:
                     children = set()
@@ -508,11 +2173,11 @@ class fdict(dict):
             elif self.nodel:
                 # Nodel mode: take care of nodes (ending with the delimiter) depending on nodes=False or True
                 plen = len(pattern)  # if nodes, need to check if the current node is not the rootpath!
-                for k in ((k[lpattern:], v) for k,v in self._viewitems() if k.startswith(pattern) and ((nodes and len(k) != plen) or not k[-1:] == delimiter)):
+                for k in ((k[lpattern:], v) for k,v in self._iterprefixitems(pattern) if ((nodes and len(k) != plen) or not k[-1:] == delimiter)):
                     yield k
             else:
                 # No fastview, just walk through all items and filter out the ones that are not in the current rootpath
-                for k,v in ((k[lpattern:], v) for k,v in self._viewitems() if k.startswith(pattern)):
+                for k,v in ((k[lpattern:], v) for k,v in self._iterprefixitems(pattern)):
                     yield k,v
 
     def viewvalues(self, fullpath=False, nodes=False, rootpath=None):
@@ -522,17 +2187,30 @@ class fdict(dict):
 
         delimiter = self.delimiter
         if not rootpath:
-            if self.fastview or self.nodel:
-                for k,v in self._viewitems():
-                    if not k[-1:] == delimiter or nodes:
-                        yield v
+            if self.trie is not None and nodes:
+                for _, v in self.viewitems(nodes=True):
+                    yield v
+            elif self.fastview or self.nodel:
+                if self._keyfirst:
+                    # Out-of-core dict: filter on the keys first to avoid deserializing the nodes
+                    d = self.d
+                    for k in self._viewkeys():
+                        if not k[-1:] == delimiter or nodes:
+                            yield d.__getitem__(k)
+                else:
+                    for k,v in self._viewitems():
+                        if not k[-1:] == delimiter or nodes:
+                            yield v
             else:
                 for v in self._viewvalues():
                     yield v
         else:
             pattern = rootpath+self.delimiter
             lpattern = len(pattern) if not fullpath else 0 # return the shortened path or fullpath? useful only if nodes=True
-            if self.fastview:
+            if self.trie is not None:
+                for _, v in self.viewitems(nodes=nodes, rootpath=rootpath):
+                    yield v
+            elif self.fastview:
                 # Fastview mode
                 if pattern in self.d:
                     children = set()
@@ -550,10 +2228,10 @@ class fdict(dict):
             elif self.nodel:
                 # Nodel mode: take care of nodes (ending with the delimiter) depending on nodes=False or True
                 plen = len(pattern)
-                for v in (v for k,v in self._viewitems() if k.startswith(pattern) and ((nodes and len(k) != plen) or not k[-1:] == delimiter)):
+                for v in (v for k,v in self._iterprefixitems(pattern) if ((nodes and len(k) != plen) or not k[-1:] == delimiter)):
                     yield v
             else:
-                for v in (v for k,v in self._viewitems() if k.startswith(pattern)):
+                for v in (v for k,v in self._iterprefixitems(pattern)):
                     yield v
 
     iterkeys = viewkeys
@@ -571,50 +2249,84 @@ class fdict(dict):
         def items(self, *args, **kwargs):
             return list(self.viewitems(*args, **kwargs))
 
-    def viewkeys_restrict(self, *args, **kwargs):
-        '''Show only the direct children of current node'''
-        # Restrict to only direct children
+    def _iterchildren(self, rootpath=''):
+        '''Walk the direct children of the node rootpath, each exactly once, yielding (fullkey, isnode) where nodes are returned without the ending delimiter.
+        O(m) where m is the number of children with the trie or in fastview mode (except for the root node), O(m log n) with the sorted index or a sorted internal dict, by seeking directly past the keys of each child node. Else all the keys under the node are walked.
+        Root-level keys that are not strings (eg, ints) are leaves of the root node, returned last with the sorted index.'''
         delimiter = self.delimiter
-        if kwargs.get('fullpath', None):
-            rootpath = self.rootpath
+        pattern = rootpath+delimiter if rootpath else ''
+        lpattern = len(pattern)
+        d = self.d
+        if self.trie is not None:
+            # Trie mode: the children are the segments of the trie node
+            node = self.trie.getnode(rootpath)
+            if node:
+                for seg, child in list(node.items()):
+                    yield (pattern+seg if pattern else seg), child is not None
+        elif self.fastview and pattern:
+            # Fastview mode: the children are stored in the node entry (there is no entry for the root)
+            if pattern in d:
+                for child in list(d.__getitem__(pattern)):
+                    if child[-1:] == delimiter:
+                        yield child[:-1], True
+                    else:
+                        yield child, False
+        elif self.index is not None or self._ordered:
+            # Sorted keys: seek the first key of each child, then jump past all the keys under this child if it is a node
+            ceiling = self.index.ceiling if self.index is not None else d.ceiling
+            upperbound = sqlshelf._upperbound
+            leaves = set()  # a leaf and a node can have the same key without fastview, getitem returns the leaf (other leaves can sort between them, eg, 'a', 'a!b', 'a/c')
+            key = ceiling(pattern)
+            while key is not None and key.startswith(pattern):
+                pos = key.find(delimiter, lpattern)
+                if pos == -1:
+                    if key != pattern:  # skip the entry of the node itself (fastview or nodel metadata)
+                        yield key, False
+                        leaves.add(key)
+                    key = ceiling(key+'\x00')  # smallest string greater than key
+                else:
+                    child = key[:pos]
+                    if not child in leaves:
+                        yield child, True
+                    key = ceiling(upperbound(key[:pos+len(delimiter)]))
+            if not pattern:
+                # Root-level leaves that are not strings, which are not in the sorted keys
+                for key in self._nonstringkeys():
+                    yield key, False
         else:
-            rootpath = None
-        lastparent = None
-        for k in self.viewkeys(*args, **kwargs):
-            # Get the root parent node of the current leaf/node (or use the same if it is already the direct child)
-            root_parent = self._get_root_parent_node(k, delimiter, rootpath)
-            if not root_parent:
-                # Stripped key is empty, so there is no parent, the key is already root, it is a leaf
-                yield k
-            elif root_parent != lastparent:
-                # Else there is a root parent node
-                # Avoid duplication, do not return twice the same parent node
-                yield root_parent
-                lastparent = root_parent
+            # No index: walk all the keys under the node, leaves are unique and the nodes already returned are remembered
+            seen = set()
+            for key in (self._iterprefix(pattern) if pattern else self._viewkeys()):
+                if not isinstance(key, _basestring):
+                    # Root-level non-string leaf
+                    yield key, False
+                    continue
+                pos = key.find(delimiter, lpattern)
+                if pos == -1:
+                    if key != pattern:  # skip the entry of the node itself (nodel metadata)
+                        yield key, False
+                elif key[:pos] not in seen:
+                    child = key[:pos]
+                    seen.add(child)
+                    if not child in d:  # a leaf and a node can have the same key without fastview, getitem returns the leaf
+                        yield child, True
+
+    def viewkeys_restrict(self, fullpath=False, rootpath=None):
+        '''Show only the direct children of current node (leaves and nodes), each once. Fast with a child index (trie, fastview, sorted index or sqlfdict), but in the default mode all the keys under the node are walked, ie, the whole dict for the root node. See _iterchildren() for complexity'''
+        if not rootpath:
+            rootpath = self.rootpath
+        lpattern = len(rootpath)+len(self.delimiter) if rootpath and not fullpath else 0
+        for fullkey, _ in self._iterchildren(rootpath):
+            yield fullkey[lpattern:] if lpattern else fullkey
 
-    def viewitems_restrict(self, *args, **kwargs):
-        '''Show only the direct children of current node'''
-        # Restrict to only direct children
-        delimiter = self.delimiter
-        if kwargs.get('fullpath', None):
+    def viewitems_restrict(self, fullpath=False, rootpath=None):
+        '''Show only the direct children of current node, each once, with the value of leaves and a sub fdict for nodes. Like viewkeys_restrict(), all the keys under the node are walked in the default mode. See _iterchildren() for complexity'''
+        if not rootpath:
             rootpath = self.rootpath
-            fullpath = kwargs['fullpath']
-        else:
-            rootpath = None
-            fullpath = False
-        lastparent = None
-        lpattern = len(self.rootpath)+len(self.delimiter)
-        for k, v in self.viewitems(*args, **kwargs):
-            # Get the root parent node of the current leaf/node (or use the same if it is already the direct child)
-            root_parent = self._get_root_parent_node(k, delimiter, rootpath)
-            if not root_parent:
-                # Stripped key is empty, so there is no parent, the key is already root, it is a leaf
-                yield k, v
-            elif root_parent != lastparent:
-                # Else there is a root parent node, return a sub fdict
-                # Avoid duplication, do not return twice the same parent node
-                yield root_parent, self.__getitem__(root_parent[lpattern:] if fullpath else root_parent)  # strip the rootpath if fullpath=True before using getitem (else the value will not be found
-                lastparent = root_parent
+        lpattern = len(rootpath)+len(self.delimiter) if rootpath and not fullpath else 0
+        d = self.d
+        for fullkey, isnode in self._iterchildren(rootpath):
+            yield (fullkey[lpattern:] if lpattern else fullkey), (self._get_view(fullkey) if isnode else d.__getitem__(fullkey))
 
     def viewvalues_restrict(self, *args, **kwargs):
         '''Show only the direct children of current node'''
@@ -634,41 +2346,426 @@ class fdict(dict):
         '''Get the first value of the next direct child'''
         return next(self.viewvalues_restrict(*args, **kwargs))
 
+    def _irangekeys(self, start=None, stop=None, inclusive=True, limit=None):
+        '''Walk the full keys of the leaves under the current node in sorted order, from the full key start (included, or excluded if not inclusive) to the full key stop (excluded), at most limit keys.
+        O(log n + m) with the sorted index or a sorted internal dict. Else the keys under the node are filtered then sorted in O(m log m), or the limit smallest ones are selected with a heap in O(m log limit).'''
+        delimiter = self.delimiter
+        prefix = self._build_path('') if self.rootpath else ''
+        if start is None or start < prefix:
+            start, inclusive = prefix, True
+        if prefix and (stop is None or stop > sqlshelf._upperbound(prefix)):
+            stop = sqlshelf._upperbound(prefix)
+        if self.index is not None or self._ordered:
+            keys = (self.index if self.index is not None else self.d).irange(start, stop, inclusive)
+            keys = (k for k in keys if not k[-1:] == delimiter)  # skip the node metadata
+        else:
+            keys = (k for k in (self._iterprefix(prefix) if prefix else self._viewkeys())
+                    if isinstance(k, _basestring) and not k[-1:] == delimiter and (k >= start if inclusive else k > start) and (stop is None or k < stop))
+            keys = heapq.nsmallest(limit, keys) if limit is not None else sorted(keys)
+        return itertools.islice(keys, limit) if limit is not None else keys
+
+    def _check_sortable(self, method):
+        '''Raise a TypeError if there are root-level keys that are not strings (eg, ints) under the current node, since they cannot be ordered with the string keys. O(1) with the sorted index or an out-of-core dict, else O(n)'''
+        for key in self._nonstringkeys():
+            raise self._nonstringkey_error(key, method)
+
+    def irange(self, start=None, stop=None, limit=None, fullpath=False):
+        '''Walk the keys of the leaves under the current node in sorted order, from start (included) to stop (excluded), which are keys relative to the current node (None for no bound), at most limit keys.
+        O(log n + m) with the sorted index or sqlfdict, else all the keys under the node are filtered then sorted (or the limit smallest ones are selected with a heap).
+        Only string keys can be ordered: a TypeError is raised if the node is the root and has keys that are not strings (eg, ints).'''
+        self._check_sortable('irange')
+        prefix = self._build_path('') if self.rootpath else ''
+        lprefix = len(prefix) if not fullpath else 0
+        keys = self._irangekeys(prefix+start if start is not None else None, prefix+stop if stop is not None else None, limit=limit)
+        return (k[lprefix:] for k in keys) if lprefix else keys
+
+    def irangeitems(self, start=None, stop=None, limit=None, fullpath=False):
+        '''Walk the items of the leaves under the current node in sorted key order. See irange()'''
+        self._check_sortable('irangeitems')
+        prefix = self._build_path('') if self.rootpath else ''
+        lprefix = len(prefix) if not fullpath else 0
+        d = self.d
+        for k in self._irangekeys(prefix+start if start is not None else None, prefix+stop if stop is not None else None, limit=limit):
+            yield (k[lprefix:] if lprefix else k), d.__getitem__(k)
+
+    def page(self, limit=100, cursor=None, start=None, stop=None, fullpath=False):
+        '''Return a page of at most limit items of the leaves under the current node in sorted key order (optionally from start to stop, see irange()), and the cursor of the next page, or None if this was the last page.
+        Pass the cursor to get the next page: it is an opaque string holding the last key returned, so each page costs O(log n + limit) with the sorted index or sqlfdict (the pages stay consistent if items are added or deleted meanwhile). Like irange(), a TypeError is raised if there are root-level keys that are not strings. A ValueError is raised if limit is less than 1.'''
+        if limit < 1:
+            raise ValueError('page() limit must be at least 1, got %r' % (limit,))
+        self._check_sortable('page')
+        prefix = self._build_path('') if self.rootpath else ''
+        if cursor is not None:
+            fullstart, inclusive = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'), False
+        else:
+            fullstart, inclusive = (prefix+start if start is not None else None), True
+        keys = list(self._irangekeys(fullstart, prefix+stop if stop is not None else None, inclusive, limit=limit+1))
+        nextcursor = None
+        if keys and len(keys) > limit:
+            # There is at least one more item
+            keys = keys[:limit]
+            nextcursor = base64.urlsafe_b64encode(keys[-1].encode('utf-8')).decode('ascii')
+        lprefix = len(prefix) if not fullpath else 0
+        d = self.d
+        return [((k[lprefix:] if lprefix else k), d.__getitem__(k)) for k in keys], nextcursor
+
+    @staticmethod
+    def _nonstringkey_error(key, method):
+        '''Error of the path queries, which only work on string keys, when they meet a root-level key that is not a string (eg, an int)'''
+        return TypeError('%s() only supports string keys, the root node has the key %r' % (method, key))
+
+    @staticmethod
+    def _glob_translate(seg, anychar='.'):
+        '''Translate a glob segment with wildcards ('*', '?', '[abc]', '[!abc]') into a regex, where anychar is the regex of any character allowed in a segment'''
+        regex = []
+        i, n = 0, len(seg)
+        while i < n:
+            c = seg[i]
+            i += 1
+            if c == '*':
+                regex.append(anychar+'*')
+            elif c == '?':
+                regex.append(anychar)
+            elif c == '[':
+                # Character class, the first character can be a ] or a ! for negation
+                j = i
+                if j < n and seg[j] == '!':
+                    j += 1
+                if j < n and seg[j] == ']':
+                    j += 1
+                j = seg.find(']', j)
+                if j == -1:
+                    # No closing bracket, literal [
+                    regex.append('\\[')
+                else:
+                    cls = seg[i:j].replace('\\', '\\\\')
+                    if cls[:1] == '!':
+                        # Negated class: also exclude the characters that are not allowed in a segment
+                        cls = '^' + cls[1:] + (anychar[2:-1] if anychar[:2] == '[^' else '')
+                    elif cls[:1] == '^':
+                        cls = '\\' + cls
+                    regex.append('[%s]' % cls)
+                    i = j+1
+            else:
+                regex.append(re.escape(c))
+        return ''.join(regex)
+
+    @staticmethod
+    def _compile_glob(pattern, delimiter='/'):
+        '''Split a glob pattern into its segments: None for '**' (any number of nested levels), a compiled regex for a segment with wildcards, or the segment itself if it is literal'''
+        segs = []
+        for seg in pattern.split(delimiter):
+            if seg == '**':
+                segs.append(None)
+            elif not any(c in seg for c in '*?['):
+                segs.append(seg)
+            else:
+                segs.append(re.compile(fdict._glob_translate(seg) + '\\Z', re.S))
+        return segs
+
+    @staticmethod
+    def _glob_match(segs, parts):
+        '''Test if a list of key segments matches the compiled glob segments. A trailing '**' matches one or more levels, else '**' matches zero or more levels'''
+        if not segs:
+            return not parts
+        seg = segs[0]
+        if seg is None:
+            if len(segs) == 1:
+                return len(parts) >= 1
+            return any(fdict._glob_match(segs[1:], parts[i:]) for i in _range(len(parts)+1))
+        if not parts:
+            return False
+        if (seg == parts[0]) if isinstance(seg, _basestring) else seg.match(parts[0]):
+            return fdict._glob_match(segs[1:], parts[1:])
+        return False
+
+    def _isnode(self, fullkey):
+        '''Test if there is a node at fullkey (given without the ending delimiter). O(1) with the trie, fastview or nodel, O(log n) with the sorted index or a sorted internal dict, else O(n)'''
+        pattern = fullkey+self.delimiter
+        if self.trie is not None:
+            return bool(self.trie.getnode(fullkey))
+        elif self.fastview or self.nodel:
+            return pattern in self.d
+        elif self.index is not None or self._ordered:
+            key = (self.index if self.index is not None else self.d).ceiling(pattern)
+            return key is not None and key.startswith(pattern)
+        else:
+            return any(True for _ in self._iterprefix(pattern))
+
+    def _glob_walk(self, nodepath, segs):
+        '''Walk the children of nodepath matching the compiled glob segments, descending only in the matching nodes, and yield (fullkey, isnode)'''
+        delimiter = self.delimiter
+        seg = segs[0]
+        rest = segs[1:]
+        if seg is None:
+            # '**': zero level, then one more level keeping the '**'
+            if rest:
+                for res in self._glob_walk(nodepath, rest):
+                    yield res
+            for child, isnode in self._iterchildren(nodepath):
+                if not isinstance(child, _basestring):
+                    raise self._nonstringkey_error(child, 'glob')
+                if not rest:
+                    # Trailing '**': everything under the node
+                    yield child, isnode
+                if isnode:
+                    for res in self._glob_walk(child, segs):
+                        yield res
+        elif isinstance(seg, _basestring):
+            # Literal segment: direct lookup
+            child = nodepath+delimiter+seg if nodepath else seg
+            if rest:
+                if self._isnode(child):
+                    for res in self._glob_walk(child, rest):
+                        yield res
+            elif child in self.d:
+                yield child, False
+            elif self._isnode(child):
+                yield child, True
+        else:
+            # Wildcards: test the name of each direct child
+            lpattern = len(nodepath)+len(delimiter) if nodepath else 0
+            for child, isnode in self._iterchildren(nodepath):
+                if not isinstance(child, _basestring):
+                    raise self._nonstringkey_error(child, 'glob')
+                if seg.match(child[lpattern:]):
+                    if not rest:
+                        yield child, isnode
+                    elif isnode:
+                        for res in self._glob_walk(child, rest):
+                            yield res
+
+    def _iterglob(self, pattern):
+        '''Walk the full keys of the leaves and nodes matching the glob pattern (relative to the current node), yielding (fullkey, isnode).
+        With a child index (trie, fastview, sorted index or sorted internal dict), only the branches matching the pattern are walked, using direct lookups for literal segments. Else, the keys under the literal beginning of the pattern are walked once and matched segment by segment.'''
+        if not pattern:
+            # An empty pattern matches no key, whatever the mode (the trie would else return its root node)
+            return
+        delimiter = self.delimiter
+        segs = self._compile_glob(pattern, delimiter)
+        # Start from the node of the literal segments at the beginning of the pattern
+        nodepath = self.rootpath
+        i = 0
+        while i < len(segs)-1 and isinstance(segs[i], _basestring):
+            nodepath = nodepath+delimiter+segs[i] if nodepath else segs[i]
+            i += 1
+        segs = segs[i:]
+
+        if isinstance(segs[0], _basestring) or self.trie is not None or (self.fastview and nodepath) or self.index is not None or self._ordered:
+            # Prune the branches that do not match
+            seen = set() if segs.count(None) > 1 else None  # several '**' can match the same key in several ways
+            for fullkey, isnode in self._glob_walk(nodepath, segs):
+                if seen is not None:
+                    if fullkey in seen:
+                        continue
+                    seen.add(fullkey)
+                yield fullkey, isnode
+        else:
+            # No child index: match all the keys under the node, and the nodes on their path
+            prefix = nodepath+delimiter if nodepath else ''
+            lprefix = len(prefix)
+            if not None in segs and len(delimiter) == 1:
+                # Without '**', the whole pattern is one regex matching the keys of the leaves, or the beginning of the keys under the matching nodes
+                notdelim = '[^%s]' % re.escape(delimiter)
+                regex = re.escape(delimiter).join(re.escape(seg) if isinstance(seg, _basestring) else self._glob_translate(pat, notdelim) for seg, pat in _zip(segs, pattern.split(delimiter)[-len(segs):]))
+                regex = re.compile('%s(?:\\Z|(?=%s))' % (regex, re.escape(delimiter)), re.S)
+                seen = set()  # nodes already returned
+                for key in (self._iterprefix(prefix) if prefix else self._viewkeys()):
+                    if not isinstance(key, _basestring):
+                        raise self._nonstringkey_error(key, 'glob')
+                    if key[-1:] == delimiter:
+                        # Node metadata
+                        continue
+                    m = regex.match(key, lprefix)
+                    if m is not None:
+                        end = m.end()
+                        if end == len(key):
+                            yield key, False
+                        elif not key[:end] in seen:
+                            seen.add(key[:end])
+                            yield key[:end], True
+                return
+            match = self._glob_match
+            nseg = len(segs)
+            globstar = None in segs
+            seen = set()  # nodes already returned
+            for key in (self._iterprefix(prefix) if prefix else self._viewkeys()):
+                if not isinstance(key, _basestring):
+                    raise self._nonstringkey_error(key, 'glob')
+                if key[-1:] == delimiter:
+                    # Node metadata
+                    continue
+                parts = key[lprefix:].split(delimiter)
+                if match(segs, parts):
+                    yield key, False
+                # Nodes on the path of this leaf: at any depth with '**', else at the depth of the pattern
+                for depth in (_range(1, len(parts)) if globstar else ([nseg] if nseg < len(parts) else [])):
+                    node = prefix+delimiter.join(parts[:depth])
+                    if not node in seen and match(segs, parts[:depth]):
+                        seen.add(node)
+                        yield node, True
+
+    def glob(self, pattern, fullpath=False):
+        '''Walk the keys of the leaves and nodes matching a glob pattern relative to the current node, eg, 'users/*/stats/latency'. Segments can contain wildcards like fnmatch ('*', '?', '[abc]', '[!abc]'), and a '**' segment matches any number of nested levels (eg, 'users/**/latency'). Nodes are returned without the ending delimiter.
+        With the trie, fastview (except at the root), the sorted index or sqlfdict, only the matching branches are walked, else all the keys under the literal beginning of the pattern are matched.
+        Patterns only match string keys: a TypeError is raised when a root-level key that is not a string (eg, an int) would have to be matched against a wildcard or '**' segment.'''
+        lpattern = len(self.rootpath)+len(self.delimiter) if self.rootpath and not fullpath else 0
+        for fullkey, _ in self._iterglob(pattern):
+            yield fullkey[lpattern:] if lpattern else fullkey
+
+    def match(self, pattern, fullpath=False):
+        '''Walk the items matching a glob pattern relative to the current node, with the value of leaves and a sub fdict for nodes. See glob()'''
+        lpattern = len(self.rootpath)+len(self.delimiter) if self.rootpath and not fullpath else 0
+        d = self.d
+        for fullkey, isnode in self._iterglob(pattern):
+            yield (fullkey[lpattern:] if lpattern else fullkey), (self._get_view(fullkey) if isnode else d.__getitem__(fullkey))
+
     def update(self, d2):
         if isinstance(d2, self.__class__):
             # Same class, we walk d2 but we cut d2 rootpath (fullpath=False) since we will rebase on our own self.d dict
             d2items = d2.viewitems(fullpath=False, nodes=False)  # ensure we do not add nodes, we need to rebuild anyway
             d2keys = d2.viewkeys(fullpath=False, nodes=False)  # duplicate for reuse
+            if self.fastview:
+                # Fastview mode: store the leaves by batches, which replaces the leaves and nodes they conflict with like setitem
+                self.update_iter(d2items)
+                return None
         elif isinstance(d2, dict):
-            # normal dict supplied
-            d2 = self.flatkeys(d2, sep=self.delimiter) # first, flatten the dict keys
-            d2items = self._genericitems(d2)
-            d2keys = self._generickeys(d2)
+            # normal dict supplied, stream its leaves by batches instead of flattening it entirely in memory
+            self.update_iter(d2)
+            return None
         else:
             raise ValueError('Supplied argument is not a dict.')
 
+        if self.counts is not None:
+            # Counting mode: count only the leaves that are not already stored, so we need to check before merging
+            d2keys = [self._build_path(k) for k in d2keys]
+            self._count_keys([k for k in d2keys if not k in self.d])
+
         # Update our dict with d2 leaves
         if self.rootpath:
             # There is a rootpath, so user is selecting a sub dict (eg, d['item1']), so we need to reconstruct d2 with the full key path rebased on self.d before merging
             rtncode = self.d.update((self._build_path(k), v) for k,v in d2items)
         else:
             # No rootpath, we can update directly because both dicts are comparable
-            if isinstance(d2, self.__class__):
-                rtncode = self.d.update(d2items)
-            else:
-                rtncode = self.d.update(d2items)
+            rtncode = self.d.update(d2items)
+
+        if self.counts is not None:
+            # Full keys were already built
+            self._keys_added(d2keys)
+        elif self.index is not None or self.trie is not None:
+            # Need to walk the keys twice, to update the index or the trie and the metadata
+            d2keys = [self._build_path(k) for k in d2keys]
+            self._keys_added(d2keys)
+        else:
+            d2keys = (self._build_path(k) for k in d2keys)
 
         # Fastview mode: we have to take care of nodes, since they are set(), they will get replaced and we might lose some pointers as they will all be replaced by d2's pointers, so we have to merge them separately
         # The only solution is to skip d2 nodes altogether and rebuild the metadata for each new leaf added. This is faster than trying to merge separately each d2 set with self.d, because anyway we also have to rebuild for d2 root nodes (which might not be self.d root nodes particularly if rootpath is set)
         if self.fastview:
-            self._build_metadata(self._build_path(k) for k in d2keys)
+            self._build_metadata(d2keys)
         elif self.nodel:
-            self._build_metadata_nodel(self._build_path(k) for k in d2keys)
+            self._build_metadata_nodel(d2keys)
 
         return rtncode
 
+    def update_iter(self, d2, batchsize=10000):
+        '''Update with a nested dict, or an iterable of (key, value) pairs (values can be nested dicts), without flattening it entirely in memory: leaves are flattened lazily and stored by batches of batchsize leaves, and the metadata (fastview or nodel), sorted index, trie and counters are updated after each batch. Peak memory is thus bounded by the batch size (with an out-of-core dict like sfdict), whatever the size of the input. Return the number of leaves stored. A ValueError is raised if batchsize is less than 1.'''
+        if batchsize < 1:
+            raise ValueError('update_iter() batchsize must be at least 1, got %r' % (batchsize,))
+        delimiter = self.delimiter
+        if isinstance(d2, _Mapping):
+            leaves = self.flatkeys_iter(d2, sep=delimiter)
+        else:
+            flatkeys_iter = self.flatkeys_iter
+            leaves = itertools.chain.from_iterable((flatkeys_iter({k: v}, sep=delimiter) if isinstance(v, _Mapping) else ((k, v),)) for k, v in d2)
+        count = 0
+        while True:
+            batch = list(itertools.islice(leaves, batchsize))
+            if not batch:
+                break
+            self._bulk_set(batch)
+            count += len(batch)
+        return count
+
+    def load_json(self, fp, batchsize=10000, chunksize=65536):
+        '''Import a JSON document, or a JSON Lines file (the objects of all lines are merged), without loading it in memory: the file is parsed incrementally and the leaves are stored by batches of batchsize leaves with update_iter().
+        fp can be a filename or a file object (text or binary). Objects are merged into the current node, arrays are stored as leaves.
+        Return a dict of statistics: number of leaves and top-level objects, bytes read, seconds, leaves per second, and the peak memory of the process (maxrss in KB, None if not available).'''
+        closefp = False
+        if isinstance(fp, _basestring):
+            fp = open(fp, 'rb')
+            closefp = True
+        try:
+            start = time.time()
+            stream = jsonstream(fp, sep=self.delimiter, chunksize=chunksize)
+            leaves = self.update_iter(stream, batchsize=batchsize)
+            seconds = time.time() - start
+        finally:
+            if closefp:
+                fp.close()
+        try:
+            import resource
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            if sys.platform == 'darwin':  # pragma: no cover
+                maxrss //= 1024  # bytes on macOS
+        except ImportError:  # pragma: no cover
+            maxrss = None
+        return {'leaves': leaves, 'objects': stream.objects, 'bytes': stream.bytesread, 'seconds': seconds,
+                'leaves_per_sec': leaves / seconds if seconds else None, 'maxrss': maxrss}
+
+    def _bulk_set(self, items):
+        '''Store a batch of leaves, given as a list of (key, value) with keys relative to the rootpath and non-dict values. The internal dict is updated at once, then the metadata, sorted index, trie and counters are updated once for the whole batch.'''
+        if self.rootpath:
+            build_path = self._build_path
+            items = [(build_path(k), v) for k, v in items]
+        if self.fastview:
+            # Fastview mode: keep the invariant of __setitem__, a key cannot be both a leaf and a node
+            items = self._resolve_conflicts(items)
+        fullkeys = [k for k, _ in items]
+        if self.counts is not None:
+            # Counting mode: count only the leaves that are not already stored, so we need to check before merging
+            d = self.d
+            self._count_keys(set(k for k in fullkeys if not k in d))
+        self.d.update(items)
+        self._keys_added(fullkeys)
+        if self.fastview:
+            self._build_metadata(fullkeys)
+        elif self.nodel:
+            self._build_metadata_nodel(fullkeys)
+
+    def _resolve_conflicts(self, items):
+        '''Fastview mode: resolve the leaf/node conflicts of a batch of leaves (with full keys) as if they were set one by one with __setitem__(). Inside the batch, the last leaf wins over any earlier leaf which is its parent or its child. Then the stored nested dicts at the path of a new leaf, and the stored leaves at the path of a parent node of a new leaf, are deleted. O(n*m) where n is the number of leaves in the batch and m the number of parents per leaf, like the metadata building. Return the filtered list of items.'''
+        delimiter = self.delimiter
+        get_all_parent_nodes = self._get_all_parent_nodes
+        # Walk the batch backward so that the last leaf wins
+        kept = set()
+        keptnodes = set()
+        resolved = []
+        for item in reversed(items):
+            fullkey = item[0]
+            if fullkey in kept or fullkey+delimiter in keptnodes:
+                continue
+            parents = list(get_all_parent_nodes(fullkey, delimiter))
+            if any(parent[:-1] in kept for parent in parents):
+                continue
+            kept.add(fullkey)
+            keptnodes.update(parents)
+            resolved.append(item)
+        resolved.reverse()
+        # Delete the stored items that conflict with the batch
+        d = self.d
+        delitem = self.__delitem__
+        for fullkey in kept:
+            if fullkey+delimiter in d:
+                delitem(fullkey, fullpath=True)
+        for parent in keptnodes:
+            parentleaf = parent[:-1]
+            if parentleaf in d:
+                delitem(parentleaf, fullpath=True)
+        return resolved
+
     def copy(self):
-        fcopy = self.__class__(d=self.d.copy(), rootpath=self.rootpath, delimiter=self.delimiter, fastview=self.fastview, nodel=self.nodel, **self.kwargs)
+        fcopy = self.__class__(d=self.d.copy(), rootpath=self.rootpath, delimiter=self.delimiter, fastview=self.fastview, nodel=self.nodel, sortedindex=(self.index.copy() if self.index is not None else False), trie=(self.trie is not None), counting=(self.counts is not None), viewcache=self._viewcachesize, threadsafe=(self._lock is not None), **self.kwargs)
         if self.fastview:
             # Fastview mode: we need to ensure we have copies of every sets used for nodes, else the nodes will reference (delitem included) the same items in both the original and the copied fdict!
             for k in fcopy._viewkeys():
@@ -687,7 +2784,10 @@ class fdict(dict):
         return next(counter)
 
     def __len__(self):
-        if not self.rootpath and (not self.fastview and not self.nodel):
+        if self.counts is not None:
+            # Counting mode: the number of leaves under each node is maintained, O(1)
+            return self.counts.get(self._build_path(''), 0)
+        elif not self.rootpath and (not self.fastview and not self.nodel):
             return self.d.__len__()
         else:
             # If there is a rootpath, we have to limit the length to the subelements
@@ -756,6 +2856,7 @@ class fdict(dict):
             # Leaf
             if not self.fastview:
                 res = self.d.pop(fullkey)
+                self._keys_removed([fullkey])
             else:
                 res = self.d.__getitem__(fullkey)
                 self.__delitem__(fullkey, fullpath=True)  # need to rebuild the metadata
@@ -776,7 +2877,9 @@ class fdict(dict):
 
     def popitem(self):
         if not self.fastview:
-            return self.d.popitem()
+            k, v = self.d.popitem()
+            self._keys_removed([k])
+            return k, v
         else:
             try:
                 k, v = next(self.viewitems(fullpath=False, nodes=False))
@@ -795,9 +2898,9 @@ class fdict(dict):
         And also for subdicts (like sfdict) which might store in a file, so we don't want to start mixing up different paths in the same file, but we would like to extract to a fdict with same parameters as the original, so keeping full path is the only way to do so coherently.
         '''
         if fullpath:
-            d2 = self.__class__(d=self.items(fullpath=True, nodes=False), rootpath=self.rootpath, delimiter=self.delimiter, fastview=self.fastview, nodel=self.nodel, **self.kwargs)
+            d2 = self.__class__(d=self.items(fullpath=True, nodes=False), rootpath=self.rootpath, delimiter=self.delimiter, fastview=self.fastview, nodel=self.nodel, sortedindex=(self.index is not None), trie=(self.trie is not None), counting=(self.counts is not None), viewcache=self._viewcachesize, threadsafe=(self._lock is not None), **self.kwargs)
         else:
-            d2 = self.__class__(d=self.items(fullpath=False, nodes=False), rootpath='', delimiter=self.delimiter, fastview=self.fastview, nodel=self.nodel) # , **self.kwargs)  # if not fullpath for keys, then we do not propagate kwargs because it might implicate propagating filename saving and mixing up keys. For fdict, this does not make a difference, but it might for subclassed dicts. Override this function if you want to ensure that an extract has all same parameters as original when fullpath=False in your subclassed dict.
+            d2 = self.__class__(d=self.items(fullpath=False, nodes=False), rootpath='', delimiter=self.delimiter, fastview=self.fastview, nodel=self.nodel, sortedindex=(self.index is not None), trie=(self.trie is not None), counting=(self.counts is not None), viewcache=self._viewcachesize, threadsafe=(self._lock is not None)) # , **self.kwargs)  # if not fullpath for keys, then we do not propagate kwargs because it might implicate propagating filename saving and mixing up keys. For fdict, this does not make a difference, but it might for subclassed dicts. Override this function if you want to ensure that an extract has all same parameters as original when fullpath=False in your subclassed dict.
         if d2.fastview:
             d2._build_metadata()
         return d2
@@ -824,12 +2927,97 @@ class fdict(dict):
             d2sub[k] = v
         return d2
 
+    def _iterleaves_sorted(self):
+        '''Walk all leaves (relative key, value) under the current node, sorted by key, so that the leaves of any node are contiguous. Streamed from an ordered internal dict or the sorted index, else only the keys are sorted in memory.
+        The root-level keys that are not strings (eg, ints) cannot be sorted with the others, they are walked last (see _nonstringkeys()), like with map_reduce().'''
+        delimiter = self.delimiter
+        pattern = self._build_path('') if self.rootpath else ''
+        lpattern = len(pattern)
+        d = self.d
+        if self._ordered:
+            return ((k[lpattern:], v) for k, v in d.iterprefixitems(pattern) if not k[-1:] == delimiter)
+        elif self.index is not None:
+            leaves = ((k[lpattern:], d.__getitem__(k)) for k in self.index.iterprefix(pattern) if not k[-1:] == delimiter)
+        else:
+            leaves = ((k[lpattern:], d.__getitem__(k)) for k in sorted(k for k in self.viewkeys(fullpath=True) if isinstance(k, _basestring)))
+        if lpattern:
+            return leaves
+        return itertools.chain(leaves, ((k, d.__getitem__(k)) for k in self._nonstringkeys()))
+
+    def export_json(self, fp, jsonlines=False, **kwargs):
+        '''Write the current node as a nested JSON document, or as JSON Lines with one line per direct child if jsonlines=True, without building the nested dict: the leaves are walked in sorted order and only the stack of the currently open objects is kept in memory.
+        fp can be a filename or a text file object. Additional keyword arguments are passed to json.dumps() to serialize the leaves (eg, default=str). Root-level keys that are not strings (eg, ints) are converted with str() and written after the others. Return the number of leaves written.'''
+        closefp = False
+        if isinstance(fp, _basestring):
+            fp = open(fp, 'w')
+            closefp = True
+        try:
+            write = fp.write
+            if not PY3 and isinstance(fp, io.TextIOBase):
+                # Py2: io text streams (eg, io.StringIO or io.open()) only accept unicode, whereas json.dumps() returns str
+                fpwrite = write
+                write = lambda s: fpwrite(s.decode('utf-8') if isinstance(s, bytes) else s)
+            dumps = json.dumps
+            delimiter = self.delimiter
+            stack = []  # keys of the open objects, from the top-level down
+            first = True  # no member was written yet in the current object
+            n = 0
+            if not jsonlines:
+                write('{')
+            for k, v in self._iterleaves_sorted():
+                # Root-level keys that are not strings (eg, ints) are converted to strings, like json.dumps() does
+                parts = k.split(delimiter) if isinstance(k, _basestring) else [str(k)]
+                # Find the deepest open object that is a parent of this leaf
+                depth = 0
+                maxdepth = min(len(stack), len(parts) - 1)
+                while depth < maxdepth and stack[depth] == parts[depth]:
+                    depth += 1
+                if depth < len(stack):
+                    # Close the other objects, they have no more leaves since keys are sorted
+                    write('}' * (len(stack) - depth))
+                    del stack[depth:]
+                    first = False
+                if jsonlines and not stack:
+                    # New direct child, on its own line
+                    if n:
+                        write('}\n')
+                    write('{')
+                    first = True
+                if not first:
+                    write(', ')
+                # Open the missing parent objects, then write the leaf
+                for part in parts[depth:-1]:
+                    write(dumps(part))
+                    write(': {')
+                    stack.append(part)
+                write(dumps(parts[-1]))
+                write(': ')
+                write(dumps(v, **kwargs))
+                first = False
+                n += 1
+            write('}' * len(stack))
+            if not jsonlines:
+                write('}')
+            elif n:
+                write('}\n')
+        finally:
+            if closefp:
+                fp.close()
+        return n
+
 
 class sfdict(fdict):
     '''
     A nested dict with flattened internal representation, combined with shelve to allow for efficient storage and memory allocation of huge nested dictionnaries.
     If you change leaf items (eg, list.append), do not forget to sync() to commit changes to disk and empty memory cache because else this class has no way to know if leaf items were changed!
     '''
+    _tmpsuffix = '.shelve'  # suffix of the temporary file when no filename is supplied
+    _metadatabatchsize = 100000  # number of leaves processed between two checkpoints of a metadata rebuild
+    _metastate = None  # shared by the root and its views: {'clean': bool} if the database has a metadata header to keep up to date
+    _countsloaded = False  # were the leaves counters loaded from the database header in counting mode?
+    _readmethods = tuple(m for m in fdict._readmethods if m != 'map_reduce') + ('get_cache_stats',)
+    _writemethods = fdict._writemethods + ('sync', 'close', 'map_reduce')  # map_reduce() syncs the database first
+
     def __init__(self, *args, **kwargs):
         '''
         Parameters
@@ -845,7 +3033,7 @@ class sfdict(fdict):
             [default : '/']
         fastview  : bool, optional
             Activates fastview mode, which makes setitem slower
-            in O(m*l) instead of O(1), but makes view* methods
+            in O(m+l) instead of O(1), but makes view* methods
             (viewitem, viewkeys, viewvalues) as fast as dict's.
             [default : False]
         nodel  : bool, optional
@@ -856,6 +3044,34 @@ class sfdict(fdict):
             reopen the database with a normal fdict if you want
             the ability to delitem.
             [default : False]
+        sortedindex  : bool, optional
+            Maintains a sorted index of all keys, which makes
+            view* methods, contains and delitem on nodes
+            in O(log n + m) instead of O(n), where m is the
+            number of items under the node. Setitem becomes O(log n).
+            The index is kept in memory and rebuilt when reopening.
+            [default : False]
+        trie  : bool, optional
+            Activates trie mode, which like fastview mode makes
+            view* methods, contains and delitem on nodes in O(m),
+            and replaces nodes and leaves without conflicts, but
+            stores the nodes as a trie of relative key segments
+            in memory instead of sets of full keys in the shelve.
+            The trie is rebuilt when reopening.
+            [default : False]
+        counting  : bool, optional
+            Maintains the number of leaves under each node,
+            which makes len() O(1) on any node in any mode.
+            The counters are kept in memory, stored in the database
+            header at every sync() and reloaded when reopening (they
+            are recounted if the database was not synced after the
+            last change, or was changed without counting mode).
+            [default : False]
+        threadsafe  : bool, optional
+            Lock all methods with a reader-writer lock, so that
+            the sfdict can be shared by threads (accesses to the
+            shelve itself are serialized by another lock).
+            [default : False]
         filename : str, optional
             Path and filename where to store the database.
             [default : random temporary file]
@@ -871,10 +3087,37 @@ class sfdict(fdict):
             manually at regular intervals.
             [default : False]
         writeback : bool, optional
-            Activates shelve writeback option. If False, only assignments
-            will allow committing changes of leaf collections. See shelve
-            documentation.
+            Keep accessed values in a cache, so that changes of leaf
+            collections (eg, list.append) are committed at the next sync()
+            or when they are evicted from the cache. If False, only
+            assignments will allow committing changes of leaf collections.
             [default : True]
+        cachesize : int, optional
+            Maximum number of values in the writeback cache, the least
+            recently used values are evicted (and written back) first.
+            None for an unbounded cache like shelve's writeback, 0 for
+            no cache (like writeback=False).
+            [default : 10000]
+        cachebytes : int, optional
+            Maximum size of the writeback cache in bytes (size of the
+            pickled values). None for no limit, 0 for no cache.
+            [default : None]
+        codec : str, optional
+            Serializer of the values: 'pickle', 'marshal' (faster
+            for builtin types, others are pickled, but the database
+            can only be reopened with the same marshal version, ie,
+            Python version), or 'raw' (bytes and strings are stored
+            as-is, others are pickled).
+            None to use the codec of the database when reopening.
+            [default : None, 'pickle' for a new database]
+        compression : str, optional
+            Compress the values bigger than compressthreshold
+            with 'zlib' or 'lzma'. False to disable.
+            None to use the compression of the database when reopening.
+            [default : None, no compression for a new database]
+        compressthreshold : int, optional
+            Minimum size in bytes of the serialized values to compress.
+            [default : None, 512 for a new database]
         forcedumbdbm : bool, optional
             Force the use of the Dumb DBM implementation to manage
             the on-disk database (should not be used unless you get an
@@ -882,6 +3125,26 @@ class sfdict(fdict):
             can be found on your system). Dumb DBM should work on
             any platform, it is native to Python.
             [default : False]
+        readonly : bool, optional
+            Open an existing database in read-only mode, eg, to read
+            it from several processes at once. Its nodes metadata
+            must be consistent with the mode (fastview or nodel),
+            since it cannot be rebuilt. Values are not cached.
+            [default : False]
+        shards : int, optional
+            Partition the database across this number of files
+            (filename.0, filename.1, ...), by a stable hash of the
+            first shardlevel segments of the keys, so that every node
+            at this level and its whole subtree are in the same file.
+            The views of a node at this level or deeper only walk one
+            shard, and sync() and close() run on all the shards in
+            parallel. The database must be reopened with the same
+            shards and shardlevel. None or 1 to use only one file.
+            [default : None]
+        shardlevel : int, optional
+            Nesting level of the nodes which subtrees are kept in the
+            same shard (1 for the top-level nodes).
+            [default : 1]
         Returns
         -------
         out  : dict-like object.
@@ -892,7 +3155,7 @@ class sfdict(fdict):
             #del kwargs['filename'] # do not del for auto management of internal sub calls to sfdict
         else:
             # No filename was supplied, create a temporary file
-            file = tempfile.NamedTemporaryFile(mode='w+b', delete=False, suffix='.shelve')
+            file = tempfile.NamedTemporaryFile(mode='w+b', delete=False, suffix=self._tmpsuffix)
             self.filename = file.name
             file.close()
             # always remove temporary file before opening the db (else we get an error because the file has an unrecognized db format)
@@ -910,38 +3173,60 @@ class sfdict(fdict):
         else:
             self.writeback = True
 
+        if 'cachesize' in kwargs:
+            # Maximum number of entries in the writeback LRU cache
+            self.cachesize = kwargs['cachesize']
+        else:
+            self.cachesize = 10000
+
+        if 'cachebytes' in kwargs:
+            # Maximum size in bytes of the writeback LRU cache
+            self.cachebytes = kwargs['cachebytes']
+        else:
+            self.cachebytes = None
+
+        # Codec of the values, stored in the database header (None means using the header's)
+        self.codec = kwargs.get('codec', None)
+        self.compression = kwargs.get('compression', None)
+        self.compressthreshold = kwargs.get('compressthreshold', None)
+
         if 'forcedumbdbm' in kwargs:
             # Force the use of dumbdbm, a generic implementation available on all platforms (but slow)?
             self.forcedumbdbm = kwargs['forcedumbdbm']
         else:
             self.forcedumbdbm = False
 
+        # Read-only database, without cache since values cannot be written back
+        self.readonly = kwargs.get('readonly', False)
+        if self.readonly:
+            self.writeback = False
+
+        # Number of files the database is partitioned across, and nesting level of the keys prefix used to pick the shard
+        self.shards = kwargs.get('shards', None)
+        self.shardlevel = kwargs.get('shardlevel', 1)
+
+        # A supplied nested dict is streamed into the database once it is opened, instead of being first flattened in memory by the parent class
+        args = list(args)
+        streamd = args[0] if args else kwargs.get('d', None)
+        rootpath = args[1] if len(args) > 1 else kwargs.get('rootpath', '')
+        if not rootpath and isinstance(streamd, _Mapping) and not isinstance(streamd, fdict):
+            if args:
+                args[0] = None
+            else:
+                kwargs['d'] = None
+        else:
+            # Internal call or fdict supplied, the parent class handles it
+            streamd = None
+
         # Initialize parent class
         super(sfdict, self).__init__(*args, **kwargs)
 
         # Initialize the out-of-core shelve database file
         if not self.rootpath: # If rootpath, this is an internal call, we just reuse the input dict
             # Else it is an external call, we reuse the provided dict but we make a copy and store in another file, or there is no provided dict and we create a new one
-            try:
-                if self.forcedumbdbm:
-                    # Force the use of dumb dbm even if slower
-                    raise ImportError('pass')
-                d = shelve.open(filename=self.filename, flag='c', protocol=PICKLE_HIGHEST_PROTOCOL, writeback=self.writeback)
-                self.usedumbdbm = False
-            except (ImportError, IOError) as exc:
-                if 'pass' in str(exc).lower() or '_bsddb' in str(exc).lower() or 'permission denied' in str(exc).lower():
-                    # Pypy error, we workaround by using a fallback to anydbm: dumbdbm
-                    if PY3:  # pragma: no cover
-                        from dbm import dumb
-                        db = dumb.open(self.filename, 'c')
-                    else:
-                        import dumbdbm
-                        db = dumbdbm.open(self.filename, 'c')
-                    # Open the dumb db as a shelf
-                    d = shelve.Shelf(db, protocol=PICKLE_HIGHEST_PROTOCOL, writeback=self.writeback)
-                    self.usedumbdbm = True
-                else:  # pragma: no cover
-                    raise
+            d = self._open_db()
+            newdb = not len(d)
+            merged = len(self.d) > 0
 
             # Initialize the shelve with the internal dict preprocessed by the parent class fdict
             d.update(self.d)
@@ -952,32 +3237,377 @@ class sfdict(fdict):
 
         # Call compatibility layer
         self._viewkeys, self._viewvalues, self._viewitems = self._getitermethods(self.d)
+        self._ordered = callable(getattr(self.d, 'iterprefix', None))
+        self._keyfirst = not isinstance(self.d, dict)
+
+        if not self.rootpath:
+            # Check that the nodes metadata stored in the database was built in the same mode and is consistent, else rebuild it
+            try:
+                self._check_metadata(newdb)
+            except BaseException:
+                # Close the database (the progress of an interrupted rebuild is already committed), else an unclosed dbm can overwrite the index of the database later on
+                self.d.close()
+                raise
+            if merged:
+                # The leaves supplied to the constructor were stored without updating the counters of the header
+                self._countsloaded = False
+            # Rebuild the sorted index and the trie from the shelve, since it can contain items from a previous session
+            if self.index is not None:
+                self.index = sortedkeys(self._viewkeys())
+            if self.trie is not None:
+                self.trie = keytrie(self._viewkeys(), delimiter=self.delimiter)
+            if self.counts is not None and not self._countsloaded:
+                self._build_counts()
+                if self._metastate is not None:
+                    # Store the recounted counters, so that they are loaded when reopening
+                    self._metastate['clean'] = False
+                    self._set_clean()
+                    self.d.sync()
+            if streamd:
+                # Stream the supplied dict by batches into the database
+                self.update_iter(streamd)
+                self.sync()
+
+    def _open_db(self):
+        '''Open the out-of-core database file(s) and return it as a dict-like object'''
+        if self.shards and self.shards > 1:
+            return shardedshelf([self._open_shelf(filename) for filename in self._shard_filenames()], delimiter=self.delimiter, level=self.shardlevel, readonly=self.readonly)
+        return self._open_shelf(self.filename)
+
+    def _shard_filenames(self):
+        '''Filenames of the shards of the database'''
+        return ['%s.%i' % (self.filename, i) for i in _range(self.shards)]
+
+    def _open_shelf(self, filename):
+        '''Open one out-of-core database file and return it as a dict-like object'''
+        db = self._open_dbm(filename)
+        # Open the db as a shelf, with a bounded LRU cache instead of shelve's unbounded writeback cache, and with the chosen codec
+        if _OrderedDict is not None:
+            db = lrushelf(db, protocol=PICKLE_HIGHEST_PROTOCOL, cachesize=self.cachesize, cachebytes=self.cachebytes, writeback=self.writeback,
+                          codec=self.codec, compression=self.compression, compressthreshold=self.compressthreshold, readonly=self.readonly)
+            if self._lock is not None:
+                # Threadsafe mode: concurrent readers of the sfdict share the cache, so the accesses to the shelf are serialized
+                db._lock = rwlock()
+                db.__class__ = _lockedclass(lrushelf)
+            return db
+        else:  # pragma: no cover
+            return shelve.Shelf(db, protocol=PICKLE_HIGHEST_PROTOCOL, writeback=self.writeback)
+
+    def _open_dbm(self, filename):
+        '''Open one dbm database file with the best available backend'''
+        try:
+            if self.forcedumbdbm:
+                # Force the use of dumb dbm even if slower
+                raise ImportError('pass')
+            if PY3:  # pragma: no cover
+                import dbm as anydbm
+            else:
+                import anydbm
+            if self._lock is not None and PY3 and anydbm.whichdb(filename) in (None, 'dbm.sqlite3'):  # pragma: no cover
+                # Threadsafe mode: the SQLite backend of Python >= 3.13 (the default one) can only be used by the thread which opened it, so use the next best backend
+                if anydbm.whichdb(filename) == 'dbm.sqlite3':
+                    raise ValueError('The dbm.sqlite3 database %s cannot be shared by threads, use sqlfdict instead' % filename)
+                db = None
+                for name in ('gnu', 'ndbm'):
+                    try:
+                        db = getattr(__import__('dbm.'+name), name).open(filename, 'r' if self.readonly else 'c')
+                        break
+                    except ImportError:
+                        pass
+                if db is None:
+                    raise ImportError('pass')
+            else:
+                db = anydbm.open(filename, 'r' if self.readonly else 'c')
+            self.usedumbdbm = 'dumb' in db.__class__.__module__  # anydbm falls back to dumbdbm if no other implementation is available (__class__ since it is an old-style instance on Python 2)
+        except (ImportError, IOError) as exc:
+            if 'pass' in str(exc).lower() or '_bsddb' in str(exc).lower() or 'permission denied' in str(exc).lower():
+                # Pypy error, we workaround by using a fallback to anydbm: dumbdbm
+                if PY3:  # pragma: no cover
+                    from dbm import dumb
+                    db = dumb.open(filename, 'r' if self.readonly else 'c')
+                else:
+                    import dumbdbm
+                    db = dumbdbm.open(filename, 'r' if self.readonly else 'c')
+                self.usedumbdbm = True
+            else:  # pragma: no cover
+                raise
+        return db
+
+    def _check_metadata(self, newdb=False):
+        '''Check the metadata header of the database: mode (fastview, nodel or none) and delimiter the nodes metadata was built with, and whether it is consistent (the database was synced or closed after the last change).
+        In counting mode, the leaves counters stored in the header when the database was last synced are loaded if they are still consistent, else they are recounted by the caller. A database opened without counting mode drops the stored counters, since it will not keep them up to date.
+        This is O(1) when the metadata is valid (O(number of nodes) to load the counters). Else, the metadata is rebuilt: all the nodes are removed, then the metadata of the new mode is built by batches of leaves, and the progress is recorded in the header and committed after each batch, so that an interrupted rebuild resumes where it stopped when reopening (it restarts from the beginning if the database was modified meanwhile).'''
+        d = self.d
+        if not callable(getattr(d, 'get_header', None)):  # pragma: no cover
+            # Shelf without header (Python 2.6)
+            return
+        mode = 'fastview' if self.fastview else 'nodel' if self.nodel else None
+        header = d.get_header()
+        meta = header.get('metadata')
+        if meta is None:
+            # New database, or database built without header so the mode is unknown
+            meta = header['metadata'] = {'version': 1, 'delimiter': self.delimiter, 'mode': mode, 'state': 'clean' if newdb else 'unknown'}
+        elif meta['delimiter'] != self.delimiter:
+            raise ValueError('The database was built with the delimiter %r, it cannot be reopened with the delimiter %r' % (meta['delimiter'], self.delimiter))
+        if self.counts is not None:
+            # The counters are only stored when they are consistent (see _set_dirty())
+            if header.get('counts') is not None:
+                self.counts = header['counts']
+                self._countsloaded = True
+        elif not self.readonly:
+            header.pop('counts', None)
+
+        if self.readonly:
+            # Read-only: the nodes metadata cannot be rebuilt, and it will stay consistent
+            if (meta['mode'] != mode or meta['state'] != 'clean') and not newdb:
+                raise ValueError('The nodes metadata of the database was built in %s mode and is %s, it cannot be opened read-only in %s mode' % (meta['mode'] or 'normal', meta['state'], mode or 'normal'))
+            return
+        if meta['mode'] != mode or meta['state'] != 'clean':
+            self._rebuild_metadata(header, mode)
+        else:
+            d.set_header(header)
+            d.sync()
+        self._metastate = {'clean': True} if mode is not None or self.counts is not None else None
+
+    def _rebuild_metadata(self, header, mode):
+        '''Rebuild the nodes metadata for the mode, resuming an interrupted rebuild if any. See _check_metadata()'''
+        d = self.d
+        delimiter = self.delimiter
+        meta = header['metadata']
+        if meta['mode'] != mode or meta['state'] != 'building' or meta.get('total') != len(d):
+            # Remove all the nodes of the previous metadata, whatever its state (removing is idempotent, so this step just restarts if interrupted)
+            meta.update(mode=mode, state='clearing')
+            d.set_header(header)
+            d.sync()
+            for k in [k for k in self._viewkeys() if k[-1:] == delimiter]:
+                d.__delitem__(k)
+            if mode is None:
+                meta['state'] = 'clean'
+                d.set_header(header)
+                d.sync()
+                return
+            meta.update(state='building', done=0, lastkey=None)
+
+        # Build the metadata by batches of leaves, with a checkpoint after each batch
+        build = self._build_metadata if mode == 'fastview' else self._build_metadata_nodel
+        batchsize = self._metadatabatchsize
+        if self._ordered:
+            # Sorted database: resume after the last processed leaf
+            def batches():
+                while True:
+                    keys = d.iterafter(meta['lastkey'], batchsize)
+                    if not keys:
+                        return
+                    meta['lastkey'] = keys[-1]
+                    yield [k for k in keys if not k[-1:] == delimiter]
+        else:
+            # Resume after the last processed leaf in sorted order, since the iteration order of the database is not stable across the inserts of the nodes
+            def batches():
+                leaves = sorted(k for k in self._viewkeys() if not k[-1:] == delimiter)
+                start = bisect.bisect_right(leaves, meta['lastkey']) if meta['lastkey'] is not None else 0
+                for i in _range(start, len(leaves), batchsize):
+                    batch = leaves[i:i+batchsize]
+                    meta['lastkey'] = batch[-1]
+                    yield batch
+        for batch in batches():
+            build(batch)
+            meta['done'] += len(batch)
+            meta['total'] = len(d)
+            d.set_header(header)
+            d.sync()
+        meta['state'] = 'clean'
+        for k in ('done', 'lastkey', 'total'):
+            meta.pop(k, None)
+        d.set_header(header)
+        d.sync()
+
+    def _set_dirty(self, sync=True):
+        '''Record in the header that the metadata is being changed and remove the stored counters, until the next sync. Called before any change, the header is committed before the change reaches the database, unless sync is False because the change is committed with the header right after (autosync), so that there is a single sync per write'''
+        metastate = self._metastate
+        if metastate is not None and metastate['clean']:
+            metastate['clean'] = False
+            header = self.d.get_header()
+            if header['metadata']['mode'] is not None:
+                header['metadata']['state'] = 'dirty'
+            header.pop('counts', None)
+            self.d.set_header(header)
+            if sync:
+                self.d.sync()
+
+    def _set_clean(self):
+        '''Record in the header that the metadata is consistent, and store the counters in counting mode, to be committed with the next sync'''
+        metastate = self._metastate
+        if metastate is not None and not metastate['clean']:
+            header = self.d.get_header()
+            if header['metadata']['mode'] is not None:
+                header['metadata']['state'] = 'clean'
+            if self.counts is not None:
+                header['counts'] = self.counts
+            self.d.set_header(header)
+            metastate['clean'] = True
 
     def __setitem__(self, key, value):
+        self._set_dirty(sync=not self.autosync)
         super(sfdict, self).__setitem__(key, value)
         if self.autosync:
             # Commit pending changes everytime we set an item
             self.sync()
 
+    def __delitem__(self, key, fullpath=False):
+        self._set_dirty()
+        super(sfdict, self).__delitem__(key, fullpath=fullpath)
+
+    def update(self, d2):
+        self._set_dirty()
+        return super(sfdict, self).update(d2)
+
+    def _bulk_set(self, items):
+        self._set_dirty()
+        return super(sfdict, self)._bulk_set(items)
+
+    def pop(self, k, d=None, fullpath=True):
+        self._set_dirty()
+        return super(sfdict, self).pop(k, d=d, fullpath=fullpath)
+
+    def popitem(self):
+        self._set_dirty()
+        return super(sfdict, self).popitem()
+
+    def setmany(self, items):
+        self._set_dirty(sync=not self.autosync)
+        count = super(sfdict, self).setmany(items)
+        if self.autosync:
+            self.sync()
+        return count
+
     def get_filename(self):
         return self.filename
 
+    def load_json(self, *args, **kwargs):
+        '''Import a JSON document or a JSON Lines file by batches, then commit to file. See fdict.load_json()'''
+        stats = super(sfdict, self).load_json(*args, **kwargs)
+        self.sync()
+        return stats
+
+    def _share_db(self):
+        '''Sync the database and make it readable by other processes, in the way its dbm backend guarantees (see _dbm_sharing()). Return False if it cannot be read by other processes while it is open here.'''
+        self.sync()
+        if self.readonly:
+            # Readers can always share the database (gdbm readers share their lock)
+            return True
+        if self.shards and self.shards > 1:
+            shelves, filenames = self.d.shards, self._shard_filenames()
+        else:
+            shelves, filenames = [self.d], [self.filename]
+        for shelf, filename in _zip(shelves, filenames):
+            sharing = _dbm_sharing(shelf.dict)
+            if sharing is None or (sharing == 'reopen' and not callable(getattr(shelf, 'reopen', None))):
+                return False
+            if sharing == 'reopen':
+                shelf.reopen(functools.partial(self._open_dbm, filename))
+        return True
+
+    def _mapreduce_spec(self):
+        '''The worker processes of map_reduce() open their own read-only handle to the database, once it is shared (see _share_db()), else the leaves are mapped in the current process'''
+        if not self._share_db():
+            return None
+        kwargs = dict(self.kwargs, filename=self.filename, delimiter=self.delimiter, fastview=self.fastview, nodel=self.nodel, readonly=True)
+        return ('db', (self.__class__.__dict__.get('_lockedbase') or self.__class__, kwargs))
+
+    def get_cache_stats(self):
+        '''Return the counters of the writeback cache (hits, misses, evictions, entries and bytes), or None if there is no bounded cache'''
+        stats = getattr(self.d, 'stats', None)
+        return stats() if stats is not None else None
+
     def sync(self):
-        '''Commit pending changes to file'''
-        self.d.sync()
+        '''Commit pending changes to file. With the bounded writeback cache, only the leaves that were modified in place are written back, and the number of keys and bytes written back is returned.'''
+        self._set_clean()
+        return self.d.sync()
 
     def close(self, delete=False):
         '''Commit pending changes to file and close it'''
+        self._set_clean()
+        self.d.close()
+        if delete:
+            filenames = self._shard_filenames() if self.shards and self.shards > 1 else [self.get_filename()]
+            for filename in filenames:
+                try:
+                    if not self.usedumbdbm:
+                        os.remove(filename)
+                    else:
+                        os.remove(filename+'.dat')
+                        os.remove(filename+'.dir')
+                        if os.path.exists(filename+'.bak'):  # pragma: no cover
+                            os.remove(filename+'.bak')
+                except Exception:  # pragma: no cover
+                    pass
+
+
+class sqlfdict(sfdict):
+    '''
+    A nested dict with flattened internal representation, stored in a SQLite database (with the standard sqlite3 module) instead of shelve.
+    Keys are stored sorted on disk, so that operations on nodes (view*, contains and delitem on nodes) are range queries in O(log n + m) where m is the number of items under the node, instead of walking the whole database.
+    Writes are grouped in a transaction which is committed at every sync() (and close()), so sync() regularly when building a big database.
+    Leaves are pickled like with shelve without writeback: if you change leaf items (eg, list.append), you need to assign them again to store the change.
+    Like with sfdict, keys must be strings: storing a root-level key that is not a string (eg, an int) raises a TypeError, instead of silently storing it as a string.
+    '''
+    _tmpsuffix = '.sqlite'
+
+    def __init__(self, *args, **kwargs):
+        '''
+        Parameters
+        ----------
+        d  : dict, optional
+            Initialize with a pre-existing dict.
+            Also used internally to pass a reference to parent fdict.
+        rootpath : str, optional
+            Internal variable, define the nested level.
+        delimiter  : str, optional
+            Internal delimiter for nested levels. Can also be used for
+            getitem direct access (e.g. ``x['a/b/c']``).
+            [default : '/']
+        fastview, nodel, sortedindex, trie, counting : bool, optional
+            Same modes as sfdict. They are usually not needed, since
+            operations on nodes already use range queries.
+            [default : False]
+        threadsafe  : bool, optional
+            Lock all methods with a reader-writer lock, so that
+            the sqlfdict can be shared by threads.
+            [default : False]
+        readonly : bool, optional
+            Open an existing database in read-only mode, eg, to read
+            it from several processes at once.
+            [default : False]
+        filename : str, optional
+            Path and filename where to store the database.
+            [default : random temporary file]
+        autosync : bool, optional
+            Commit (sync) to file at every setitem (assignment).
+            Drawback: every assignment is then a transaction, which
+            is a lot slower, so it is advised to rather sync()
+            manually at regular intervals.
+            [default : False]
+        Returns
+        -------
+        out  : dict-like object.
+        '''
+        super(sqlfdict, self).__init__(*args, **kwargs)
+
+    def _open_db(self):
+        '''Open the SQLite database file and return it as a dict-like object'''
+        return sqlshelf(self.filename, protocol=PICKLE_HIGHEST_PROTOCOL, threadsafe=(self._lock is not None), readonly=self.readonly)
+
+    def _share_db(self):
+        '''Commit the database: SQLite lets other processes read it meanwhile'''
+        self.sync()
+        return True
+
+    def close(self, delete=False):
+        '''Commit pending changes to file and close it'''
+        self._set_clean()
         self.d.close()
         if delete:
             try:
-                filename = self.get_filename()
-                if not self.usedumbdbm:
-                    os.remove(filename)
-                else:
-                    os.remove(filename+'.dat')
-                    os.remove(filename+'.dir')
-                    if os.path.exists(filename+'.bak'):  # pragma: no cover
-                        os.remove(filename+'.bak')
+                os.remove(self.get_filename())
             except Exception:  # pragma: no cover
                 pass
@@ -1,8 +1,37 @@
 # Unit testing of fdict
-from fdict import fdict, sfdict
+from fdict import fdict, sfdict, sqlfdict
 
 import ast
+import array
+import io
+import json
+import operator
+import os
+import shelve
 import sys
+import threading
+import unittest
+
+try:  # pragma: no cover
+    _unicode = unicode
+except NameError:
+    _unicode = str
+
+# Classes and modes which must give the same results: (class, kwargs)
+_modes = [(fdict, {}), (fdict, {'fastview': True}), (fdict, {'nodel': True}), (fdict, {'sortedindex': True}), (fdict, {'sortedindex': True, 'nodel': True}), (fdict, {'trie': True}),
+          (fdict, {'sortedindex': True, 'counting': True}), (sfdict, {}), (sfdict, {'fastview': True}), (sqlfdict, {}), (sqlfdict, {'fastview': True})]
+# Modes supporting root-level keys that are not strings (eg, ints)
+_mixedkeymodes = [(fdict, {}), (fdict, {'sortedindex': True}), (fdict, {'trie': True}), (fdict, {'sortedindex': True, 'counting': True})]
+
+def _each_mode(modes, *args, **kwargs):
+    '''Build a dict with the supplied arguments in each of the modes, and close it (and delete its files) after use if it is out-of-core'''
+    for dclass, modekwargs in modes:
+        a = dclass(*args, **dict(kwargs, **modekwargs))
+        try:
+            yield a
+        finally:
+            if hasattr(a, 'close'):
+                a.close(delete=True)
 
 
 ### FDICT
@@ -585,6 +614,199 @@ def test_fdict_get_root_parent_node():
     rootpath='a/b'
     assert fdict._get_root_parent_node(path, delimiter='/', rootpath=rootpath) == 'a/b/c'
 
+def test_fdict_flatkeys_iter():
+    '''Test fdict lazy flattening'''
+    nested = {1: 42, 'a': {'b': 1, 'c': {'d': 2, 3: 4}}, 'e': {}}
+    it = fdict.flatkeys_iter(nested)
+    assert not isinstance(it, dict)
+    assert dict(it) == fdict.flatkeys(nested) == {1: 42, 'a/b': 1, 'a/c/d': 2, 'a/c/3': 4}
+    assert dict(fdict.flatkeys_iter({'a': {'b': 1}}, sep='.', prefix='x.')) == {'x.a.b': 1}
+
+def test_fdict_update_iter():
+    '''Test fdict update by batches, in all modes'''
+    nested = {'a': {'b': 1, 'c': {'d': 2, 'e': 3}}, 'f': 4, 'g': {'h': {'i': 5}}}
+    for kwargs in [{}, {'fastview': True}, {'nodel': True}, {'trie': True}, {'sortedindex': True, 'counting': True}]:
+        a = fdict({'a': {'x': 0}}, **kwargs)
+        b = fdict({'a': {'x': 0}}, **kwargs)
+        assert a.update_iter(nested, batchsize=2) == 5
+        b.update(nested)
+        assert a == b and a.d == b.d
+        assert a.to_dict_nested() == {'a': {'x': 0, 'b': 1, 'c': {'d': 2, 'e': 3}}, 'f': 4, 'g': {'h': {'i': 5}}}
+        assert len(a['a']) == 4 and 'g/h' in a
+        if kwargs.get('fastview'):
+            assert a.d['a/'] == set(['a/x', 'a/b', 'a/c/'])
+        # Iterable of pairs, on a nested fdict
+        assert a['g'].update_iter(iter([('j', 6), ('k', {'l': 7})]), batchsize=1) == 2
+        assert a['g'].to_dict_nested() == {'h': {'i': 5}, 'j': 6, 'k': {'l': 7}}
+        assert len(a) == 8
+        # Empty input, and a batch size that would store nothing
+        assert a.update_iter({}) == 0 and a.update_iter(iter([])) == 0 and len(a) == 8
+        try:
+            a.update_iter({'y': 1}, batchsize=0)
+            assert False
+        except ValueError:
+            pass
+        assert not 'y' in a
+
+def test_fdict_update_iter_conflicts():
+    '''Test that fastview update by batches replaces a leaf by a node and inversely, like setitem'''
+    for a in _each_mode([(fdict, {'fastview': True}), (fdict, {'fastview': True, 'trie': True, 'counting': True}), (sfdict, {'fastview': True})]):
+        a.update_iter([('a/b', 1), ('c', 2)])
+        a.update({'a': 5, 'c': {'d': 3}})
+        assert a.to_dict() == {'a': 5, 'c/d': 3}
+        assert sorted(a.d.keys()) == ['a', 'c/', 'c/d']
+        # Conflicts inside a batch: the last leaf wins
+        assert a.update_iter([('x', 1), ('x/y', 2), ('z/w', 3), ('z', 4)], batchsize=10) == 4
+        assert a.to_dict() == {'a': 5, 'c/d': 3, 'x/y': 2, 'z': 4}
+        assert sorted(a.d.keys()) == ['a', 'c/', 'c/d', 'x/', 'x/y', 'z']
+        assert len(a) == 4
+        # Update with another fdict
+        a.update(fdict({'a': {'y': 6}, 'x': 7}))
+        assert a.to_dict() == {'a/y': 6, 'c/d': 3, 'x': 7, 'z': 4}
+        assert sorted(a.d.keys()) == ['a/', 'a/y', 'c/', 'c/d', 'x', 'z'] and len(a) == 4
+
+def test_fdict_load_json():
+    '''Test fdict streaming import of JSON and JSON Lines, with chunks cut anywhere'''
+    doc = {'a': {'b': 1, 'c': {'d': [1, {'x': 2}], 'e': u'str\u00e9"\\'}, 'f': None, 'g': True, 'h': -1.5e3, 'k': {}}, 'z': 123456789}
+    expected = {'a': {'b': 1, 'c': {'d': [1, {'x': 2}], 'e': u'str\u00e9"\\'}, 'f': None, 'g': True, 'h': -1.5e3}, 'z': 123456789}
+    text = json.dumps(doc, indent=2)
+    for chunksize in [1, 3, 7, 65536]:
+        for fp in [io.BytesIO(text.encode('utf-8')), io.StringIO(_unicode(text))]:
+            a = fdict({'y': 0}, sortedindex=True)
+            stats = a['n'].load_json(fp, batchsize=2, chunksize=chunksize)
+            assert a['n'].to_dict_nested() == expected
+            assert a['n/a/c/d'] == [1, {'x': 2}] and a['y'] == 0
+            assert stats['leaves'] == 7 and stats['objects'] == 1
+    # JSON Lines, from a file
+    with open('testjson.jsonl', 'w') as f:
+        f.write('{"a": {"b": 1}}\n{"a": {"c": 2}, "d": 3}\n\n{"a": {"b": 4}}\n')
+    try:
+        a = fdict()
+        stats = a.load_json('testjson.jsonl')
+        assert a.to_dict_nested() == {'a': {'b': 4, 'c': 2}, 'd': 3}
+        assert stats['leaves'] == 4 and stats['objects'] == 3 and stats['bytes'] == os.path.getsize('testjson.jsonl')
+    finally:
+        os.remove('testjson.jsonl')
+    # Invalid JSON
+    for text in ['[1, 2]', '{"a": 1,}', '{"a": 1', '{"a": tru}', '{"a" 1}']:
+        try:
+            fdict().load_json(io.StringIO(_unicode(text)), chunksize=2)
+            assert False
+        except ValueError:
+            pass
+
+def test_fdict_export_json():
+    '''Test fdict streaming export to nested JSON and JSON Lines, from sorted or unsorted dicts'''
+    nested = {'a': {'b': 1, 'c': {'d': [1, {'x': 2}], 'e': u'str\u00e9'}, 'a.b': {'f': None}}, 'a-': 2, 'z': {'y': True}}
+    for kwargs in [{}, {'fastview': True}, {'nodel': True}, {'sortedindex': True}, {'trie': True}]:
+        a = fdict(nested, **kwargs)
+        for node, expected in [(a, nested), (a['a'], nested['a']), (a['a/c'], nested['a']['c'])]:
+            fp = io.StringIO()
+            assert node.export_json(fp) == len(node)
+            assert json.loads(fp.getvalue()) == expected
+            fp = io.StringIO()
+            node.export_json(fp, jsonlines=True)
+            lines = fp.getvalue().splitlines()
+            assert len(lines) == len(expected)
+            assert dict((k, v) for line in lines for k, v in json.loads(line).items()) == expected
+    fp = io.StringIO()
+    assert fdict().export_json(fp) == 0 and fp.getvalue() == '{}'
+    # Leaves that are not JSON serializable
+    fp = io.StringIO()
+    fdict({'a': {'b': set([1])}}).export_json(fp, default=sorted)
+    assert json.loads(fp.getvalue()) == {'a': {'b': [1]}}
+    # Root-level keys that are not strings are converted like json.dumps() does, and written last
+    for kwargs in [{}, {'sortedindex': True}, {'trie': True}]:
+        fp = io.StringIO()
+        a = fdict({1: 'x', 'a': {'b': 'y'}, 0: 'z'}, **kwargs)
+        assert a.export_json(fp) == 3
+        assert fp.getvalue() == '{"a": {"b": "y"}, "0": "z", "1": "x"}'
+        fp = io.StringIO()
+        a.export_json(fp, jsonlines=True)
+        assert fp.getvalue().splitlines() == ['{"a": {"b": "y"}}', '{"0": "z"}', '{"1": "x"}']
+
+def test_fdict_counting():
+    '''Test fdict counting mode, len() on nodes must be the same as without the counters'''
+    for kwargs in [{}, {'fastview': True}, {'nodel': True}, {'trie': True}, {'sortedindex': True}]:
+        a = fdict({'a': {'b': 1, 'c': {'d': 2, 'e': 3}}, 'f': 4}, counting=True, **kwargs)
+        def check(a):
+            for node in ['a', 'a/c', 'a/x']:
+                if node in a:
+                    assert len(a[node]) == a._count_iter_items(a[node].viewkeys())
+            assert len(a) == a._count_iter_items(a.viewkeys())
+        assert len(a) == 4 and len(a['a']) == 3 and len(a['a']['c']) == 2
+        check(a)
+        a['a/c/d'] = 5  # replace a leaf
+        assert len(a['a/c']) == 2
+        a['a/c/g'] = 6
+        assert len(a['a']) == 4
+        a.update({'a': {'b': 7, 'h': 8}})
+        assert len(a['a']) == 5 and len(a) == 6
+        check(a)
+        a['a'].update(fdict({'i': {'j': 9}}))
+        assert len(a['a/i']) == 1 and len(a['a']) == 6
+        if not kwargs.get('nodel'):
+            del a['a/c']
+            assert len(a['a']) == 3 and len(a) == 4
+            a.pop('a/b')
+            a.popitem()
+            assert len(a) == 2
+            check(a)
+        a['a'] = {'x': {'y': 1, 'z': 2}}  # replace a node
+        check(a)
+        assert len(a['a/x']) == 2
+        b = a.copy()
+        b['a/x/w'] = 3
+        assert len(b['a/x']) == 3 and len(a['a/x']) == 2
+    # Trie mode: leaves and nodes replacing each other
+    a = fdict({'a': {'b': 1, 'c': 2}}, counting=True, trie=True)
+    a['a'] = 1
+    assert len(a) == 1
+    a['a/b/c'] = 2
+    assert len(a) == 1 and len(a['a']) == 1
+
+def test_fdict_viewcache():
+    '''Test fdict cache of nested fdicts'''
+    a = fdict({'a': {'b': {'c': 1}, 'd': 2}})
+    assert a['a'] is a['a']
+    assert a['a']['b'] is a['a/b']
+    assert a['a']['b']['c'] == 1
+    # Changing the rootpath of a nested fdict does not change the next ones
+    asub = a['a']
+    asub.rootpath = 'a/b'
+    assert asub.to_dict() == {'c': 1} and a['a'] is not asub and a['a'].to_dict() == {'b/c': 1, 'd': 2}
+    assert a['a'] is a['a'] and asub.rootpath == 'a/b'
+    # Cached nested fdicts are evicted on delete and stay consistent
+    del a['a/b']
+    assert a['a'].to_dict() == {'d': 2}
+    a['a/b'] = {'e': 3}
+    assert a['a']['b'].to_dict() == {'e': 3}
+    # Cache is bounded
+    b = fdict(dict(('k%i' % i, {'x': i}) for i in range(10)), viewcache=4)
+    assert [b['k%i' % i]['x'] for i in range(10)] == list(range(10))
+    assert len(b._viewcache) <= 4
+    # Cache can be disabled
+    c = fdict({'a': {'b': 1}}, viewcache=0)
+    assert c['a'] is not c['a']
+    assert c['a']['b'] == 1
+    # Views of a copy do not reuse the original internal dict
+    d = a.copy()
+    d['a/d'] = 4
+    assert a['a']['d'] == 2 and d['a']['d'] == 4
+
+def test_fdict_build_path():
+    '''Test fdict full path building with non-string keys and rootpath changes'''
+    a = fdict({1: 'x', 'a': {2: 'y', 'b': {3: 'z'}}})
+    assert a.d == {1: 'x', 'a/2': 'y', 'a/b/3': 'z'}  # root-level keys keep their type
+    assert a[1] == 'x' and a['a'][2] == 'y' and a['a']['b'][3] == 'z'
+    # Root-level keys that are not strings are under no node
+    assert dict(a['a'].items()) == {'2': 'y', 'b/3': 'z'} and 'a/b' in a and not 'x' in a
+    asub = a['a']
+    assert asub._build_path('c') == 'a/c'
+    asub.rootpath = 'd'
+    asub[4] = 'w'
+    assert a.d['d/4'] == 'w'
+
 def test_fdict_viewrestrict():
     '''Test fdict view*_restrict methods'''
     a = fdict({'a': {'b': {'c': 1, 'd': 2}, 'e': 3}, 'f': 4})
@@ -606,6 +828,413 @@ def test_fdict_viewrestrict():
     res = list(a['a'].viewvalues_restrict(fullpath=True))
     assert {'c': 1, 'd': 2} in res and 3 in res
 
+def test_fdict_viewrestrict_modes():
+    '''Test view*_restrict methods return each direct child exactly once, in all modes'''
+    nested = {'a': {'b': {'c': 1, 'd': 2}, 'b.': 3, 'e': 4, 'f': {'g': {'h': 5}}}, 'i': 6, 'a.': {'j': 7}}
+    for a in _each_mode(_modes, nested):
+        keys = list(a.viewkeys_restrict())
+        assert len(keys) == 3 and set(keys) == set(['a', 'i', 'a.'])
+        keys = list(a['a'].viewkeys_restrict())
+        assert len(keys) == 4 and set(keys) == set(['b', 'b.', 'e', 'f'])
+        assert set(a['a'].viewkeys_restrict(fullpath=True)) == set(['a/b', 'a/b.', 'a/e', 'a/f'])
+        assert set(a.viewkeys_restrict(rootpath='a/f')) == set(['g'])
+        items = dict(a['a'].viewitems_restrict())
+        assert items['e'] == 4 and items['b'].to_dict_nested() == {'c': 1, 'd': 2} and items['f']['g/h'] == 5
+        assert a['a/f'].firstkey() == 'g' and a['a/f/g'].firstitem() == ('h', 5) and a['a/f/g'].firstvalue() == 5
+        # Empty node, and a leaf which has no children
+        assert list(a['missing'].viewkeys_restrict()) == [] and list(a['missing'].viewitems_restrict()) == []
+        assert list(a.viewkeys_restrict(rootpath='a/e')) == []
+        try:
+            a['missing'].firstkey()
+            assert False
+        except StopIteration:
+            pass
+    # A leaf and a node with the same key (possible without fastview nor trie) are returned once, as a leaf like getitem, also when other leaves sort between them
+    for kwargs in [{}, {'sortedindex': True}]:
+        a = fdict({'a': {'b': {'c': 1}, 'b!': 3}}, **kwargs)
+        a.d['a/b'] = 2
+        if kwargs:
+            a.index.add('a/b')
+        assert sorted(a['a'].viewitems_restrict()) == [('b', 2), ('b!', 3)]
+    # Root-level keys that are not strings are direct children
+    for a in _each_mode(_mixedkeymodes, {1: 'x', 'a': {'b': 'y'}}):
+        assert sorted(a.viewkeys_restrict(), key=str) == [1, 'a'] and dict(a.viewitems_restrict())[1] == 'x'
+        assert a.firstkey() in (1, 'a') and len(list(a.viewitems_restrict())) == 2
+
+def test_fdict_glob():
+    '''Test fdict glob and match with wildcards and **, with the same results in all modes'''
+    nested = {'users': dict(('u%i' % i, {'stats': {'latency': i, 'hits': i*2}, 'name': 'n%i' % i, 'deep': {'x': {'latency': -i}}}) for i in range(3)), 'latency': 9, 'other': {'stats': {'latency': 1}}}
+    expected = {
+        'users/*/stats/latency': ['users/u0/stats/latency', 'users/u1/stats/latency', 'users/u2/stats/latency'],
+        'users/u[01]/name': ['users/u0/name', 'users/u1/name'],
+        'users/u[!0]/stats': ['users/u1/stats', 'users/u2/stats'],
+        '**/latency': ['latency', 'other/stats/latency', 'users/u0/deep/x/latency', 'users/u0/stats/latency', 'users/u1/deep/x/latency', 'users/u1/stats/latency', 'users/u2/deep/x/latency', 'users/u2/stats/latency'],
+        'users/**/x/latency': ['users/u0/deep/x/latency', 'users/u1/deep/x/latency', 'users/u2/deep/x/latency'],
+        'users/u1/**': ['users/u1/deep', 'users/u1/deep/x', 'users/u1/deep/x/latency', 'users/u1/name', 'users/u1/stats', 'users/u1/stats/hits', 'users/u1/stats/latency'],
+        '*': ['latency', 'other', 'users'],
+        'users/u?/*/latency': ['users/u0/stats/latency', 'users/u1/stats/latency', 'users/u2/stats/latency'],
+        '**/**/hits': ['users/u0/stats/hits', 'users/u1/stats/hits', 'users/u2/stats/hits'],
+        'users/u1/stats': ['users/u1/stats'],
+        'users/u1/name/x': [],
+        'nope/*': [],
+        '': [],
+    }
+    for a in _each_mode(_modes, nested):
+        for pattern, keys in expected.items():
+            assert sorted(a.glob(pattern)) == keys
+        assert sorted(a['users'].glob('*/stats/l*')) == ['u0/stats/latency', 'u1/stats/latency', 'u2/stats/latency']
+        assert sorted(a['users'].glob('*/stats/l*', fullpath=True)) == ['users/u0/stats/latency', 'users/u1/stats/latency', 'users/u2/stats/latency']
+        assert sorted(a['users'].match('u*/stats/hits')) == [('u0/stats/hits', 0), ('u1/stats/hits', 2), ('u2/stats/hits', 4)]
+        assert dict(a.match('users/u2/deep'))['users/u2/deep'].to_dict_nested() == {'x': {'latency': -2}}
+    # Root-level keys that are not strings cannot be matched by wildcards
+    for a in _each_mode(_mixedkeymodes, {1: 'x', 'a': {'b': 'y'}}):
+        assert list(a.glob('a/*')) == ['a/b'] and list(a.glob('1')) == []
+        for pattern in ['*', '**', '**/b', '?']:
+            try:
+                list(a.glob(pattern))
+                assert False
+            except TypeError:
+                pass
+
+def test_fdict_irange_page():
+    '''Test fdict sorted range queries and pagination with a cursor, with the same results in all modes'''
+    nested = {'events': dict(('e%03i' % i, {'v': i} if i % 3 == 0 else i) for i in range(50)), 'a': 1, 'z': {'y': 2}}
+    for a in _each_mode(_modes, nested):
+        ev = a['events']
+        assert list(ev.irange()) == sorted(ev.keys())
+        assert list(ev.irange('e010', 'e014')) == ['e010', 'e011', 'e012/v', 'e013']
+        assert list(ev.irange(limit=3, fullpath=True)) == ['events/e000/v', 'events/e001', 'events/e002']
+        assert list(ev.irangeitems('e047')) == [('e047', 47), ('e048/v', 48), ('e049', 49)]
+        assert list(a.irange(limit=2)) == ['a', 'events/e000/v'] and list(a.irange('f')) == ['z/y']
+        # Empty ranges
+        assert list(ev.irange('e030', 'e030')) == [] and list(ev.irange('e040', 'e030')) == [] and list(ev.irange('x')) == []
+        assert list(ev.irange(limit=0)) == [] and list(a['missing'].irange()) == []
+        # Pagination
+        page, cursor = ev.page(20)
+        assert len(page) == 20 and page[0] == ('e000/v', 0) and cursor is not None
+        ev['e025'] = 'new'  # pages stay consistent when the dict is modified meanwhile
+        page, cursor = ev.page(20, cursor)
+        assert page[0] == ('e020', 20) and ('e025', 'new') in page
+        page, cursor = ev.page(20, cursor)
+        assert len(page) == 10 and page[-1] == ('e049', 49) and cursor is None
+        page, cursor = ev.page(5, start='e046', stop='e049')
+        assert [k for k, _ in page] == ['e046', 'e047', 'e048/v'] and cursor is None
+        # Empty pages, and invalid limits
+        assert ev.page(5, start='x') == ([], None) and a['missing'].page(1) == ([], None)
+        for limit in (0, -1):
+            try:
+                ev.page(limit)
+                assert False
+            except ValueError:
+                pass
+    # Root-level keys that are not strings cannot be ordered with the others
+    for a in _each_mode(_mixedkeymodes, {'a': {'b': 1}, 1: 2}):
+        assert list(a['a'].irange()) == ['b'] and a['a'].page(10) == ([('b', 1)], None)
+        for method in (a.irange, a.irangeitems, a.page):
+            try:
+                list(method())
+                assert False
+            except TypeError:
+                pass
+        del a[1]
+        assert list(a.irange()) == ['a/b'] and a.page(10) == ([('a/b', 1)], None)
+
+def test_fdict_getmany_setmany():
+    '''Test fdict batched getmany and setmany, in all modes'''
+    modes = _modes + [(sfdict, {'cachesize': 1}), (sfdict, {'counting': True})]
+    for a in _each_mode(modes, {'a': {'x': 0}}):
+        b = fdict({'a': {'x': 0}})
+        assert a['a'].setmany([('c', 3), ('b', {'d': 1, 'e': [2]})]) == 3
+        assert a.setmany({'f': 4}) == 1
+        b['a']['c'] = 3
+        b['a']['b'] = {'d': 1, 'e': [2]}
+        b['f'] = 4
+        assert a.to_dict_nested() == b.to_dict_nested() and len(a) == len(b) == 5
+        if a.fastview:
+            assert a.d['a/'] == set(['a/x', 'a/c', 'a/b/'])
+        res = a['a'].getmany(['c', 'b/e', 'b', 'missing', 'c'])
+        assert res[0] == 3 and res[1] == [2] and res[2].to_dict_nested() == {'d': 1, 'e': [2]} and res[3].to_dict_nested() == {} and res[4] == 3
+        assert a.getmany(['f', 'a/x']) == [4, 0]
+        # Empty input
+        assert a.getmany([]) == [] and a['missing'].getmany([]) == []
+        assert a.setmany([]) == 0 and a.setmany({}) == 0 and len(a) == 5
+        # A leaf under a former leaf: replaced like with setitem in fastview and trie modes, else both are stored and getitem returns the leaf
+        assert a.setmany({'f/g': 1}) == 1 and a['f/g'] == 1
+        if a.fastview or a.trie is not None:
+            assert a.getmany(['f'])[0].to_dict_nested() == {'g': 1} and len(a) == 5
+        else:
+            assert a.getmany(['f', 'f/g']) == [4, 1] and len(a) == 6
+        # Keys that are not strings cannot be stored out-of-core
+        if isinstance(a, sfdict):
+            try:
+                a.setmany({1: 2})
+                assert False
+            except TypeError:
+                pass
+    for a in _each_mode(_mixedkeymodes, {'a': {'b': 1}, 1: 2}):
+        assert a.getmany([1, 'a/b']) == [2, 1] and a.setmany({2: 3, 'c': 4}) == 2 and a[2] == 3 and a['c'] == 4
+    # Dumb dbm backend, and the shelf alone
+    from fdict.fdict import lrushelf
+    a = sfdict({'a': {'b': 1, 'c': [2]}}, forcedumbdbm=True, cachesize=1)
+    try:
+        a.sync()
+        assert a['a'].getmany(['c', 'b']) == [[2], 1]
+    finally:
+        a.close(delete=True)
+    shelf = lrushelf({}, cachesize=1)
+    shelf['a/b'] = 1
+    shelf['a/c'] = [2]
+    assert shelf.getmany(['a/c', 'a/b', 'a/x']) == {'a/b': 1, 'a/c': [2]}
+    # Fastview mode: a leaf replaces a node and inversely, like setitem
+    for a in _each_mode([(fdict, {'fastview': True}), (sfdict, {'fastview': True}), (sqlfdict, {'fastview': True})]):
+        a.setmany({'a/b': 1})
+        a.setmany({'a': 5})
+        assert a.to_dict() == {'a': 5} and sorted(a.d.keys()) == ['a']
+        a.setmany([('a/c', 2), ('d', 3)])
+        assert a.to_dict() == {'a/c': 2, 'd': 3} and sorted(a.d.keys()) == ['a/', 'a/c', 'd']
+        # Inside a batch, the last leaf wins
+        assert a.setmany([('e', 1), ('e/f', 2)]) == 2
+        assert a['e/f'] == 2 and not 'e' in a.d and len(a) == 3
+
+def test_fdict_array():
+    '''Test fdict to_array and from_array with numpy (optional)'''
+    try:
+        import numpy
+    except ImportError:
+        raise unittest.SkipTest('numpy is not installed')
+    for a in _each_mode(_modes, {'metrics': {'h1': {'x': 1}}}):
+        arr = numpy.arange(12, dtype=float) / 2
+        assert a['metrics'].from_array('h2', arr) == 12
+        assert sorted(a['metrics/h2'].keys())[:3] == ['00', '01', '02']
+        assert isinstance(a['metrics/h2/05'], float)
+        res = a['metrics/h2'].to_array()
+        assert res.dtype == numpy.float64 and res.flags['C_CONTIGUOUS'] and (res == arr).all()
+        keys, res = a['metrics'].to_array(keys=['h1/x', 'h2/11'], dtype=numpy.int32, return_keys=True)
+        assert keys == ['h1/x', 'h2/11'] and res.tolist() == [1, 5]
+        a.from_array('', [7, 8], keys=['y', 'z'])
+        assert a['y'] == 7 and a['z'] == 8
+        try:
+            a.from_array('m', numpy.zeros((2, 2)))
+            assert False
+        except ValueError:
+            pass
+    # Root-level keys that are not strings cannot be ordered with the others (see irange())
+    for a in _each_mode(_mixedkeymodes, {'metrics': {'h1': 1, 'h2': 2}, 1: 3}):
+        assert a['metrics'].to_array().tolist() == [1, 2] and a.to_array(keys=[1, 'metrics/h2']).tolist() == [3, 2]
+        try:
+            a.to_array()
+            assert False
+        except TypeError:
+            pass
+
+def test_fdict_columns():
+    '''Test fdict to_columns and iter_columns'''
+    users = dict(('u%i' % i, {'name': 'n%i' % i, 'age': 20+i, 'score': i * 1.5}) for i in range(5))
+    del users['u2']['score']
+    users['u3']['stats'] = {'latency': 3}
+    for a in _each_mode(_modes, {'users': users, 'count': 5}):
+        rowkeys, columns = a['users'].to_columns(use_numpy=False)
+        assert rowkeys == ['u0', 'u1', 'u2', 'u3', 'u4']
+        assert sorted(columns.keys()) == ['age', 'name', 'score', 'stats/latency']
+        assert isinstance(columns['age'], array.array) and list(columns['age']) == [20, 21, 22, 23, 24]
+        assert columns['name'] == ['n0', 'n1', 'n2', 'n3', 'n4']
+        assert columns['score'] == [0.0, 1.5, None, 4.5, 6.0]
+        assert columns['stats/latency'] == [None, None, None, 3, None]
+        # Selected fields, in order, including a missing one
+        rowkeys, columns = a['users'].to_columns(fields=['score', 'foo'], use_numpy=False)
+        assert list(columns.keys()) == ['score', 'foo'] and columns['foo'] == [None] * 5
+        # Chunked mode
+        chunks = list(a['users'].iter_columns(fields=['age', 'score'], chunksize=2, use_numpy=False))
+        assert [c[0] for c in chunks] == [['u0', 'u1'], ['u2', 'u3'], ['u4']]
+        assert list(chunks[0][1]['score']) == [0.0, 1.5] and isinstance(chunks[0][1]['score'], array.array)
+        assert chunks[1][1]['score'] == [None, 4.5]
+        # Leaves directly under the node are not records
+        assert a.to_columns(use_numpy=False)[0] == ['users']
+        assert a['users/u0'].to_columns() == ([], {})
+        # Empty node, no field, and invalid chunk size
+        assert a['missing'].to_columns() == ([], {}) and list(a['missing'].iter_columns()) == []
+        assert a['users'].to_columns(fields=[], use_numpy=False) == (['u0', 'u1', 'u2', 'u3', 'u4'], {})
+        try:
+            list(a['users'].iter_columns(chunksize=0))
+            assert False
+        except ValueError:
+            pass
+    # Root-level keys that are not strings are leaves, not records
+    for a in _each_mode(_mixedkeymodes, {'users': users, 1: 2, 3: {'age': 4}}):
+        assert a.to_columns(fields=['age'], use_numpy=False) == (['3', 'users'], {'age': [4, None]})
+        assert [(r, list(c['age'])) for r, c in a.iter_columns(fields=['age'], chunksize=1, use_numpy=False)] == [(['3'], [4]), (['users'], [None])]
+        assert a['users'].to_columns(fields=['age'], use_numpy=False)[0] == ['u0', 'u1', 'u2', 'u3', 'u4']
+    try:
+        import numpy
+    except ImportError:
+        raise unittest.SkipTest('numpy is not installed')
+    a = fdict({'users': users})
+    rowkeys, columns = a['users'].to_columns(fields=['age'])
+    assert isinstance(columns['age'], numpy.ndarray) and columns['age'].tolist() == [20, 21, 22, 23, 24]
+
+def test_fdict_threadsafe():
+    '''Test fdict threadsafe mode with concurrent writers and readers'''
+    # Nodes are deleted by the writers, which nodel mode does not support
+    for a in _each_mode([m for m in _modes if not m[1].get('nodel')], {'x': 1}, threadsafe=True):
+        errors = []
+        def writer(t):
+            try:
+                for i in range(200):
+                    a['a/%i/%i' % (t, i)] = i
+                    if i in (49, 99, 149):
+                        del a['a/%i' % t]
+            except Exception as exc:
+                errors.append(exc)
+        def reader():
+            try:
+                for _ in range(20):
+                    list(a.viewitems(nodes=True))
+                    list(a['a'].viewkeys_restrict())
+            except Exception as exc:
+                errors.append(exc)
+        threads = [threading.Thread(target=writer, args=(t,)) for t in range(3)] + [threading.Thread(target=reader) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not errors
+        assert sorted(a.keys()) == sorted(['x'] + ['a/%i/%i' % (t, i) for t in range(3) for i in range(150, 200)])
+        assert len(a['a']) == 150 and sorted(a['a'].viewkeys_restrict()) == ['0', '1', '2']
+        if a.fastview:
+            # Nodes metadata is consistent
+            assert set(a.d['a/']) == set(['a/0/', 'a/1/', 'a/2/']) and len(a.d['a/1/']) == 50
+        # Nested fdicts and copies share the mode
+        assert a['a']._lock is a._lock
+        if not hasattr(a, 'close'):
+            assert a.copy()._lock is not None
+        elif getattr(a.d, '_lock', None) is not None:
+            # The shelf is locked for all its accessors, including the ones which do not use the cache
+            for access in (lambda: len(a.d), lambda: 'x' in a.d, lambda: list(a.d)):
+                done = threading.Event()
+                def run():
+                    access()
+                    done.set()
+                a.d._lock.acquire_write()
+                thread = threading.Thread(target=run)
+                thread.start()
+                assert not done.wait(0.05)
+                a.d._lock.release_write()
+                thread.join()
+                assert done.is_set()
+    # Root-level keys that are not strings (eg, ints)
+    for a in _each_mode(_mixedkeymodes, {'a': {'b': 1}, 1: 2}, threadsafe=True):
+        errors = []
+        def worker(t):
+            try:
+                for i in range(100):
+                    a[t] = i
+                    assert sorted(a['a'].keys()) == ['b'] and a[t] == i
+                    list(a.viewitems())
+            except Exception as exc:
+                errors.append(exc)
+        threads = [threading.Thread(target=worker, args=(t,)) for t in range(2, 5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not errors
+        assert sorted(a.items(), key=repr) == [('a/b', 1), (1, 2), (2, 99), (3, 99), (4, 99)]
+
+    # Readers do not block each other, but a writer waits for the open iterators
+    a = fdict({'a': {'b': 1, 'c': 2}, 'd': 3}, threadsafe=True)
+    it = a.viewitems()
+    next(it)
+    done = threading.Event()
+    def reader():
+        assert a['d'] == 3
+        done.set()
+    thread = threading.Thread(target=reader)
+    thread.start()
+    assert done.wait(5)
+    thread.join()
+    done.clear()
+    def writer():
+        a['e'] = 4
+        done.set()
+    thread = threading.Thread(target=writer)
+    thread.start()
+    assert not done.wait(0.1) and not 'e' in a
+    del it
+    assert done.wait(5)
+    thread.join()
+    assert a['e'] == 4
+    # Modifying while iterating in the same thread
+    for k in list(a.viewkeys()):
+        a[k] = 0
+    for k in a.viewkeys():
+        a[k] = 1
+    assert set(a.values()) == set([1])
+
+def _double(k, v):
+    return v * 2
+
+def _listkey(k, v):
+    return [k]
+
+def test_fdict_map_reduce():
+    '''Test fdict map_reduce in the current process and in worker processes'''
+    for a in _each_mode(_modes):
+        a.update_iter(('u/%i/%03i' % (i % 10, i), i) for i in range(300))
+        a['x'] = 1000
+        for workers in (1, 2):
+            assert a.map_reduce(_double, operator.add, workers=workers, chunksize=50) == 2 * (sum(range(300)) + 1000)
+            # Partial results are reduced in key order
+            keys = a['u'].map_reduce(_listkey, operator.add, workers=workers, chunksize=7)
+            assert keys == sorted(a['u'].keys()) and len(keys) == 300
+            assert a['u/3'].map_reduce(_listkey, operator.add, workers=workers, fullpath=True)[0] == 'u/3/003'
+            assert a['u/3'].map_reduce(_double, operator.add, initial=1, workers=workers) == 1 + 2 * sum(range(3, 300, 10))
+            assert a['none'].map_reduce(_double, operator.add, workers=workers) is None
+            assert a['none'].map_reduce(_double, operator.add, initial=5, workers=workers) == 5
+            try:
+                a.map_reduce(_double, operator.add, workers=workers, chunksize=0)
+                assert False
+            except ValueError:
+                pass
+        if hasattr(a, 'close'):
+            # The database is read by the workers once it is synced, and still writable afterwards
+            a['x'] = 2000
+            assert a.map_reduce(_double, operator.add, workers=2, chunksize=50) == 2 * (sum(range(300)) + 2000)
+            a['y'] = 1
+            assert a['y'] == 1 and len(a) == 302
+            # Databases that cannot be read by other processes are mapped in the current process
+            a._share_db = lambda: False
+            assert a.map_reduce(_double, operator.add, workers=2, chunksize=50) == 2 * (sum(range(300)) + 2001)
+    # Non-string root keys are mapped last
+    for a in _each_mode(_mixedkeymodes, {1: 2, 'a': {'b': 3}}):
+        assert a.map_reduce(_double, operator.add, workers=2) == 10
+        assert a.map_reduce(_listkey, operator.add, workers=2, chunksize=1) == ['a/b', 1]
+
+def test_sfdict_map_reduce_dbm():
+    '''Test sfdict map_reduce in worker processes with the default dbm backend when it is not dumb dbm (eg, ndbm, which has no sync(), or gdbm, which cannot be read while it is open for writing)'''
+    from fdict.fdict import _dbm_sharing
+    for kwargs in ({}, {'shards': 2}):
+        a = sfdict(**kwargs)
+        if a.usedumbdbm:
+            a.close(delete=True)
+            raise unittest.SkipTest('dumb dbm is the only dbm backend available')
+        a.update_iter(('u/%i/%03i' % (i % 10, i), i) for i in range(300))
+        for i in range(3):
+            # The changes since the previous map_reduce() are seen by the workers
+            a['x'] = 1000 * i
+            assert a.map_reduce(_double, operator.add, workers=2, chunksize=50) == 2 * (sum(range(300)) + 1000 * i)
+            assert a['u/3'].map_reduce(_listkey, operator.add, workers=2, chunksize=7) == sorted(a['u/3'].keys())
+        a['y'] = 1
+        assert a['y'] == 1 and len(a) == 302
+        shelves = a.d.shards if kwargs else [a.d]
+        assert all(_dbm_sharing(shelf.dict) in ('reopen', None) for shelf in shelves)
+        # A read-only database is shared by the workers whatever its backend
+        a.close()
+        b = sfdict(filename=a.filename, readonly=True, **kwargs)
+        assert b.map_reduce(_double, operator.add, workers=2, chunksize=50) == 2 * (sum(range(300)) + 2001)
+        b.close()
+        a = sfdict(filename=a.filename, **kwargs)
+        a.close(delete=True)
+
 def test_fdict_firstmethods():
     '''Test fdict first*() methods (firstkey, firstitem, firstvalue)'''
     # Test firstkey, firstitem and firstvalue
@@ -702,6 +1331,20 @@ def test_fdict_fastview_metadata_nested_dict():
     a['g'] = {'h': {'i': {'j': 6}, 'k': 7}, 'l': 8}
     assert a.d == {'g/l': 8, 'g/h/i/j': 6, 'g/h/i/': set(['g/h/i/j']), 'a/': set(['a/b', 'a/c']), 'a/c': set([1, 2, 3]), 'a/b': 1, 'g/h/': set(['g/h/k', 'g/h/i/']), 'g/': set(['g/l', 'g/h/']), 'g/h/k': 7, 'd': [1, 2, 3]}
 
+def test_fdict_fastview_metadata_bulk():
+    '''Test fastview bulk metadata building, with nested fdicts and existing nodes'''
+    a = fdict({'a': {'b': {'c': 1}}}, fastview=True)
+    a['a']['b']['d'] = fdict({'e': {'f': 2}, 'g': 3})
+    assert a.d == {'a/b/c': 1, 'a/b/d/e/f': 2, 'a/b/d/g': 3, 'a/': set(['a/b/']), 'a/b/': set(['a/b/c', 'a/b/d/']), 'a/b/d/': set(['a/b/d/e/', 'a/b/d/g']), 'a/b/d/e/': set(['a/b/d/e/f'])}
+    a['a'].update({'b': {'h': 4}, 'i': 5})
+    assert a.d['a/'] == set(['a/b/', 'a/i']) and a.d['a/b/'] == set(['a/b/c', 'a/b/d/', 'a/b/h'])
+    # rebuild from scratch gives the same metadata
+    b = fdict(a.to_dict(), fastview=True)
+    assert b.d == a.d
+    # non-string keys at root are leaves without parents
+    c = fdict({1: 2, 'x': {'y': 3}}, fastview=True)
+    assert c.d == {1: 2, 'x/y': 3, 'x/': set(['x/y'])}
+
 def test_fdict_fastview_setitem_noconflict_delitem():
     '''Test fdict fastview setitem replacement of singleton by nested dict and inversely + delitem'''
     a = fdict({'a/b': 1, 'a/c': set([1,2,3]), 'd': [1, 2, 3]}, fastview=True)
@@ -850,6 +1493,124 @@ def test_fdict_nodel_basic():
     assert not (a == d) and a != d  # test inequality
 
 
+### FDICT TRIE
+
+def test_fdict_trie_basic():
+    '''Test trie mode gives the same results as fastview mode, without storing nodes in the internal dict'''
+    a = fdict({'a': {'b': 1, 'c': {'d': 2, 'e': 3}}, 'f': 4}, trie=True)
+    assert a.d == {'a/b': 1, 'a/c/d': 2, 'a/c/e': 3, 'f': 4}
+    assert a.trie.root == {'a': {'b': None, 'c': {'d': None, 'e': None}}, 'f': None}
+    assert a['a'].trie is a.trie
+    assert set(a.keys()) == set(['a/b', 'a/c/d', 'a/c/e', 'f'])
+    assert set(a['a'].keys()) == set(['b', 'c/d', 'c/e'])
+    assert set(a['a'].keys(nodes=True)) == set(['b', 'c/', 'c/d', 'c/e'])
+    assert set(a['a'].keys(fullpath=True)) == set(['a/b', 'a/c/d', 'a/c/e'])
+    assert dict(a['a']['c'].items()) == {'d': 2, 'e': 3}
+    assert set(a['a'].values()) == set([1, 2, 3])
+    assert len(a) == 4 and len(a['a']) == 3
+    assert 'a' in a and 'c' in a['a'] and 'a/c/d' in a and not 'x' in a and not 'b/x' in a['a']
+    assert set(a['a'].viewkeys_restrict()) == set(['b', 'c'])
+    assert dict(a['a'].viewitems_restrict(fullpath=True)) == {'a/b': 1, 'a/c': {'d': 2, 'e': 3}}
+    # No conflicts: a leaf replaces a node and inversely
+    a['a']['c'] = 5
+    assert a.d == {'a/b': 1, 'a/c': 5, 'f': 4}
+    a['f/g'] = 6
+    assert a.d == {'a/b': 1, 'a/c': 5, 'f/g': 6}
+    a['a'] = {'h': {'i': 7}}
+    assert a == {'a/h/i': 7, 'f/g': 6}
+    assert a.trie.root == {'a': {'h': {'i': None}}, 'f': {'g': None}}
+    # Delete nodes and leaves, empty nodes are pruned
+    a.update({'f': {'j': 8}})
+    del a['a']['h']
+    assert a.d == {'f/g': 6, 'f/j': 8} and not 'a' in a
+    del a['f/g']
+    assert a.trie.root == {'f': {'j': None}}
+    try:
+        del a['x']
+        assert False
+    except KeyError:
+        pass
+    assert a.pop('f/j') == 8 and a == {} and a.trie.root == {}
+    # copy and extract get their own trie
+    a = fdict({'a': {'b': 1, 'c': 2}, 'd': 3}, trie=True)
+    b = a.copy()
+    del b['a']
+    assert 'a' in a and not 'a' in b
+    assert a['a'].extract(fullpath=False).trie.root == {'b': None, 'c': None}
+
+
+
+### FDICT SORTED INDEX
+
+def test_fdict_sortedindex():
+    '''Test fdict with sorted index gives the same results as without'''
+    for kwargs in [{}, {'nodel': True}, {'fastview': True}]:
+        a = fdict({'a': {'b': 1, 'c': {'d': 2, 'e': 3}}, 'ab': 4, 'f': 5}, sortedindex=True, **kwargs)
+        b = fdict({'a': {'b': 1, 'c': {'d': 2, 'e': 3}}, 'ab': 4, 'f': 5}, **kwargs)
+        assert a.index is a['a']['c'].index
+        assert set(a['a'].keys()) == set(b['a'].keys()) == set(['b', 'c/d', 'c/e'])
+        assert dict(a['a'].items()) == dict(b['a'].items())
+        assert set(a['a/c'].values()) == set(b['a/c'].values()) == set([2, 3])
+        assert 'c' in a['a'] and 'a/c' in a and not 'x' in a['a'] and not 'a/x' in a
+        a['a']['c']['g'] = 6
+        a['h'] = {'i': 7}
+        a['a'].update({'j': 8})
+        assert dict(a['a'].items()) == {'b': 1, 'c/d': 2, 'c/e': 3, 'c/g': 6, 'j': 8}
+        assert dict(a['h'].items()) == {'i': 7}
+        assert list(a.index) == sorted(a.d.keys())
+        if not kwargs.get('nodel'):
+            del a['a']['c']
+            assert dict(a['a'].items()) == {'b': 1, 'j': 8}
+            assert not 'a/c' in a
+            assert a.pop('a/b') == 1
+            assert dict(a.pop('h').items()) == {'i': 7}
+            assert list(a.index) == sorted(a.d.keys())
+    # copy and extract have their own index
+    a = fdict({'a': {'b': 1, 'c': 2}, 'd': 3}, sortedindex=True)
+    acopy = a.copy()
+    del acopy['a']
+    assert list(a.index) == ['a/b', 'a/c', 'd'] and list(acopy.index) == ['d']
+    assert list(a['a'].extract().index) == ['a/b', 'a/c']
+    assert list(a['a'].extract(fullpath=False).index) == ['b', 'c']
+    # popitem and non-string keys
+    a = fdict({1: 2, 'a': {'b': 3}}, sortedindex=True)
+    assert list(a.index) == ['a/b'] and a.index.others == set([1])
+    while a:
+        a.popitem()
+    assert list(a.index) == [] and not a.index.others
+
+def test_sortedkeys():
+    '''Test the sorted index used by sortedindex mode'''
+    from fdict.fdict import sortedkeys
+    idx = sortedkeys(load=4)
+    for i in range(50):
+        idx.add('k%02i' % (49 - i))
+    idx.add('k00')  # duplicate is ignored
+    assert len(idx) == 50 and list(idx) == ['k%02i' % i for i in range(50)]
+    assert list(idx.iterprefix('k1')) == ['k%02i' % i for i in range(10, 20)]
+    assert list(idx.iterprefix('x')) == [] and list(idx.iterprefix('')) == list(idx)
+    for i in range(0, 50, 2):
+        idx.discard('k%02i' % i)
+    idx.discard('absent')
+    assert 'k01' in idx and not 'k02' in idx and len(idx) == 25
+    assert list(idx.iterprefix('k1')) == ['k11', 'k13', 'k15', 'k17', 'k19']
+    idx.update(['k%02i' % i for i in range(50)])
+    assert list(idx) == ['k%02i' % i for i in range(50)]
+    # Keys can be deleted or added while iterating, also when whole chunks are removed or split
+    walked = []
+    for k in idx.iterprefix('k'):
+        walked.append(k)
+        idx.discard(k)
+    assert walked == ['k%02i' % i for i in range(50)] and len(idx) == 0
+    idx.update(['k%02i' % i for i in range(0, 20, 2)])
+    walked = []
+    for k in idx.irange('k04'):
+        walked.append(k)
+        for i in range(10):
+            idx.add('j%s%i' % (k, i))
+    assert walked == ['k%02i' % i for i in range(4, 20, 2)] and len(idx) == 90
+
+
 ### SFDICT
 
 def test_sfdict_basic():
@@ -870,6 +1631,514 @@ def test_sfdict_basic():
     g.close()
     h.close(delete=True)
 
+def test_sfdict_sortedindex():
+    '''Test sfdict with sorted index, also when reopening'''
+    g = sfdict(d={'a': {'b': 1, 'c': 2}, 'd': 3}, filename='testshelf_idx', sortedindex=True)
+    assert list(g.index) == ['a/b', 'a/c', 'd']
+    assert dict(g['a'].items()) == {'b': 1, 'c': 2}
+    g.sync()
+    h = sfdict(filename='testshelf_idx', sortedindex=True)
+    assert list(h.index) == ['a/b', 'a/c', 'd']
+    del h['a']
+    assert list(h.index) == ['d'] and not 'a' in h
+    g.close()
+    h.close(delete=True)
+
+def test_sfdict_trie():
+    '''Test sfdict in trie mode, also when reopening'''
+    g = sfdict(d={'a': {'b': 1, 'c': 2}, 'd': 3}, filename='testshelf_trie', trie=True)
+    assert g.trie.root == {'a': {'b': None, 'c': None}, 'd': None}
+    g['d/e'] = 4
+    g.sync()
+    h = sfdict(filename='testshelf_trie', trie=True)
+    assert h.trie.root == {'a': {'b': None, 'c': None}, 'd': {'e': None}}
+    assert dict(h['a'].items()) == {'b': 1, 'c': 2}
+    g.close()
+    h.close(delete=True)
+
+def test_sfdict_counting():
+    '''Test sfdict in counting mode, also when reopening'''
+    g = sfdict(d={'a': {'b': 1, 'c': 2}, 'd': 3}, filename='testshelf_count', counting=True)
+    assert len(g) == 3 and len(g['a']) == 2
+    g['a/e/f'] = 4
+    del g['d']
+    assert len(g) == 3 and len(g['a']) == 3 and len(g['a/e']) == 1
+    g.sync()
+    h = sfdict(filename='testshelf_count', counting=True)
+    assert h.counts == g.counts
+    assert len(h['a']) == 3
+    g.close()
+    h.close(delete=True)
+    # The counters stored in the header are loaded without recounting, unless the database was changed since the last sync or without counting mode
+    for dclass in [sfdict, sqlfdict]:
+        g = dclass({'a': {'b': 1, 'c': 2}}, counting=True, fastview=True)
+        filename = g.get_filename()
+        assert g.d.get_header()['counts'] == g.counts
+        g.close()
+        g = dclass(filename=filename, counting=True, fastview=True)
+        assert g._countsloaded and len(g['a']) == 2
+        g['a/x'] = 5
+        assert not 'counts' in g.d.get_header()
+        g.d.close()  # not synced: the counters are not stored
+        g = dclass(filename=filename, counting=True)
+        assert not g._countsloaded and len(g['a']) == 3
+        g.close()
+        g = dclass(filename=filename)
+        assert not 'counts' in g.d.get_header()
+        g['a/y'] = 6
+        g.close()
+        g = dclass(filename=filename, counting=True)
+        assert not g._countsloaded and len(g['a']) == 4
+        g.close()
+        g = dclass(filename=filename, counting=True, readonly=True)
+        assert g._countsloaded and len(g['a']) == 4 and len(g) == 4
+        g.close(delete=True)
+
+def test_sfdict_keyfirst():
+    '''Test sfdict views only deserialize the values of the matching keys'''
+    accessed = []
+    for kwargs in [{}, {'fastview': True}]:
+        g = sfdict(d={'a': {'b': 1, 'c': {'d': 2}}, 'e': {'f': 3}}, writeback=False, **kwargs)
+        base = g.d.__class__
+        class spyshelf(base):
+            def __getitem__(self, key):
+                accessed.append(key)
+                # Explicit base call, shelve.Shelf is an old-style class on Python 2
+                return base.__getitem__(self, key)
+        g.d.__class__ = spyshelf
+        assert dict(g['a'].items()) == {'b': 1, 'c/d': 2}
+        assert sorted(k for k in accessed if not k.endswith('/')) == ['a/b', 'a/c/d']
+        del accessed[:]
+        assert dict(g['e'].extract().items()) == {'f': 3}
+        assert [k for k in accessed if not k.endswith('/')] == ['e/f']
+        del accessed[:]
+        assert [k for k, _ in g['a'].viewitems_restrict()] in (['b', 'c'], ['c', 'b'])
+        assert [k for k in accessed if not k.endswith('/')] == ['a/b']  # the nested leaf a/c/d is not deserialized
+        del accessed[:]
+        g.close(delete=True)
+
+def test_sfdict_streaminit():
+    '''Test sfdict initialization with a dict streams the leaves to the database without flattening the whole dict in memory'''
+    def noflatkeys(*args, **kwargs):
+        raise AssertionError('flatkeys should not be called')
+    flatkeys = fdict.__dict__['flatkeys']  # the staticmethod itself, to restore it as-is
+    fdict.flatkeys = staticmethod(noflatkeys)
+    try:
+        for kwargs in [{}, {'fastview': True}, {'nodel': True}, {'trie': True, 'counting': True}]:
+            g = sfdict({'a': {'b': 1, 'c': {'d': 2}}, 'e': 3}, **kwargs)
+            assert g.to_dict_nested() == {'a': {'b': 1, 'c': {'d': 2}}, 'e': 3}
+            assert 'a/c' in g and len(g['a']) == 2
+            g.close(delete=True)
+    finally:
+        fdict.flatkeys = flatkeys
+    # Restored as a staticmethod, so that it does not leak into the other tests
+    assert fdict.__dict__['flatkeys'] is flatkeys and fdict.flatkeys({'a': {'b': 1}}) == {'a/b': 1}
+
+def test_sfdict_load_json():
+    '''Test sfdict and sqlfdict streaming import of a JSON document, committed to file'''
+    for dclass in [sfdict, sqlfdict]:
+        g = dclass(counting=True)
+        stats = g.load_json(io.StringIO(_unicode('{"a": {"b": 1, "c": {"d": [2]}}, "e": "f"}')), batchsize=1)
+        assert stats['leaves'] == 3
+        filename = g.get_filename()
+        g.close()
+        g = dclass(filename=filename, counting=True)
+        assert g.to_dict_nested() == {'a': {'b': 1, 'c': {'d': [2]}}, 'e': 'f'}
+        assert len(g) == 3 and len(g['a']) == 2
+        g.close(delete=True)
+
+def test_sfdict_export_json():
+    '''Test sfdict and sqlfdict export to JSON of a node, read back with load_json'''
+    nested = {'a': {'b': 1, 'c': {'d': [2]}}, 'e': 'f'}
+    for dclass in [sfdict, sqlfdict]:
+        g = dclass(nested)
+        g.export_json('testjson.json')
+        try:
+            a = fdict()
+            a.load_json('testjson.json')
+            assert a.to_dict_nested() == nested
+        finally:
+            os.remove('testjson.json')
+        g.close(delete=True)
+
+def test_sfdict_readonly():
+    '''Test sfdict and sqlfdict read-only mode'''
+    for dclass, kwargs in [(sfdict, {}), (sfdict, {'fastview': True}), (sqlfdict, {})]:
+        a = dclass({'a': {'b': 1, 'c': [1, 2]}, 'd': 2}, filename='testshelf_readonly', **kwargs)
+        a.close()
+        b = dclass(filename='testshelf_readonly', readonly=True, **kwargs)
+        c = dclass(filename='testshelf_readonly', readonly=True, **kwargs)
+        assert sorted(b.items()) == sorted(c.items()) == [('a/b', 1), ('a/c', [1, 2]), ('d', 2)]
+        assert sorted(b['a'].keys()) == ['b', 'c']
+        try:
+            b['e'] = 3
+            assert False
+        except Exception:
+            pass
+        b.close()
+        c.close()
+        if kwargs.get('fastview'):
+            # The nodes metadata cannot be rebuilt for another mode
+            try:
+                dclass(filename='testshelf_readonly', readonly=True)
+                assert False
+            except ValueError:
+                pass
+        a = dclass(filename='testshelf_readonly', **kwargs)
+        assert a['d'] == 2
+        a.close(delete=True)
+
+def test_sfdict_aio():
+    '''Test the asyncio facade of fdict, sfdict and sqlfdict (Python >= 3.7)'''
+    if sys.version_info < (3, 7):
+        raise unittest.SkipTest('asyncio interface requires Python >= 3.7')
+    import asyncio
+    from fdict.aio import aiofdict
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    run = loop.run_until_complete
+    def gather(requests):
+        # Start the requests in order (asyncio.gather() does not guarantee it)
+        return asyncio.gather(*[asyncio.ensure_future(r) for r in requests])
+    try:
+        for dclass, kwargs in [(fdict, {}), (sfdict, {'fastview': True}), (sqlfdict, {})]:
+            a = run(aiofdict.open(dclass, {'a': {'b': 1, 'c': 2}, 'd': 3}, batchsize=50, maxpending=20, **kwargs))
+            run(a.aset('e/f', 4))
+            # Concurrent requests are run in order, by batches, with backpressure
+            requests = [a.aget(k) for k in ['a/b', 'd', 'e/f'] * 30] + [a.aset('n/%i' % i, i) for i in range(100)] + [a.aget('n/99')]
+            results = run(gather(requests))
+            assert results[:3] == [1, 3, 4] and len(results) == 191 and results[-1] == 99
+            # Concurrent writes to the same key are applied in order, also when they wait for a slot
+            run(gather(a.aset('x', i) for i in range(200)))
+            assert run(a.aget('x')) == 199
+            results = run(gather(a.aset('x', i) if i % 3 else a.aget('x') for i in range(1, 200)))
+            assert [r for r in results if r is not None] == [i - 1 for i in range(3, 200, 3)]
+            run(a.adel('x'))
+            # Nested fdicts
+            node = run(a.aget('a'))
+            assert isinstance(node, aiofdict) and run(node.aget('c')) == 2
+            # Async iteration, by chunks
+            it = run(a.aget('n')).aitems(chunksize=7)
+            items = []
+            while True:
+                try:
+                    items.append(run(it.__anext__()))
+                except StopAsyncIteration:
+                    break
+            assert sorted(items) == sorted(('%i' % i, i) for i in range(100))
+            run(a.adel('n'))
+            assert run(a.acall(lambda: sorted(a.d.keys()))) == ['a/b', 'a/c', 'd', 'e/f']
+            try:
+                run(a.adel('zzz'))
+                assert False
+            except KeyError:
+                pass
+            run(a.async_sync())
+            run(a.aclose(delete=True))
+        # Consecutive gets of a batch are fetched with one getmany(), and an error only fails its own request
+        calls = []
+        class counted(fdict):
+            def getmany(self, keys):
+                calls.append(len(keys))
+                return super(counted, self).getmany(keys)
+        a = aiofdict(counted({'a': 1, 'b': 2}), batchsize=10)
+        assert run(gather([a.aget('a'), a.aget('b'), a.aget('a')])) == [1, 2, 1] and calls == [3]
+        results = run(asyncio.gather(a.acall(lambda: 1 / 0), a.aget('b'), return_exceptions=True))
+        assert isinstance(results[0], ZeroDivisionError) and results[1] == 2
+        run(a.aclose())
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+
+def test_sfdict_sharded():
+    '''Test sfdict partitioned across several database files'''
+    for kwargs in [{}, {'fastview': True}, {'nodel': True, 'shardlevel': 2}]:
+        a = sfdict({'a': {'b': {'c': 1, 'd': 2}, 'e': 3}, 'f': 4}, filename='testshelf_sharded', shards=3, **kwargs)
+        for i in range(30):
+            a['n%i/x/y' % i] = i
+            a['n%i/z' % i] = -i
+        assert len(a.d.shards) == 3
+        # Every subtree at the sharding level is stored in one shard
+        level = kwargs.get('shardlevel', 1)
+        for i in range(30):
+            prefix = '/'.join(['n%i' % i, 'x', 'y'][:level])
+            assert len(set(id(a.d._shard(k)) for k in a.d if k.startswith(prefix + '/'))) == 1
+        assert a['a/b/c'] == 1 and a['n7/z'] == -7
+        assert sorted(a['a'].items()) == [('b/c', 1), ('b/d', 2), ('e', 3)]
+        assert sorted(a['a/b'].keys()) == ['c', 'd']
+        assert 'a/b' in a and 'n3/x' in a and 'n3/w' not in a
+        assert len(list(a.keys(fullpath=True))) == 64
+        assert sum(v for k, v in a.items() if k.startswith('n')) == 0
+        if not kwargs.get('nodel'):
+            del a['n5']
+            assert 'n5/z' not in a and 'n5' not in a
+        assert a.getmany(['a/e', 'f', 'n6/z']) == [3, 4, -6]
+        assert a.sync() == {'keys': 0, 'bytes': 0}
+        a.close()
+        # Reopen with the same sharding
+        b = sfdict(filename='testshelf_sharded', shards=3, **kwargs)
+        assert b['n9/x/y'] == 9 and sorted(b['a/b'].keys()) == ['c', 'd']
+        assert len(list(b.keys(fullpath=True))) == (64 if kwargs.get('nodel') else 62)
+        b.close()
+        c = sfdict(filename='testshelf_sharded', shards=3, readonly=True, **kwargs)
+        assert c['f'] == 4
+        c.close()
+        # Another number of shards cannot be used with the same database
+        try:
+            sfdict(filename='testshelf_sharded', shards=2, **kwargs)
+            assert False
+        except ValueError:
+            pass
+        b = sfdict(filename='testshelf_sharded', shards=3, **kwargs)
+        b.close(delete=True)
+        assert not [f for f in os.listdir('.') if f.startswith('testshelf_sharded')]
+
+def test_sfdict_metadata_header():
+    '''Test sfdict metadata header: no rebuild when reopening in the same mode, rebuild when the mode changed or the database was not synced, and resume of an interrupted rebuild'''
+    class spysfdict(sfdict):
+        rebuilds = 0
+        def _rebuild_metadata(self, *args, **kwargs):
+            spysfdict.rebuilds += 1
+            return super(spysfdict, self)._rebuild_metadata(*args, **kwargs)
+    nested = {'a': {'b': 1, 'c': {'d': 2, 'e': 3}}, 'f': {'g': 4}, 'h': 5}
+    for dclass in [sfdict, sqlfdict]:
+        spy = type('spy' + dclass.__name__, (spysfdict, dclass), {})
+        g = dclass(nested, fastview=True)
+        filename = g.get_filename()
+        assert g.d.get_header()['metadata'] == {'version': 1, 'delimiter': '/', 'mode': 'fastview', 'state': 'clean'}
+        g['a/x'] = 6
+        assert g.d.get_header()['metadata']['state'] == 'dirty'
+        # The dirty state is committed before the change, so that it is seen even if the process crashes before the next sync
+        try:
+            dclass(filename=filename, fastview=True, readonly=True)
+            assert False
+        except ValueError:
+            pass
+        g.close()
+        # Same mode: O(1)
+        spysfdict.rebuilds = 0
+        g = spy(filename=filename, fastview=True)
+        assert spysfdict.rebuilds == 0 and g.d['a/'] == set(['a/b', 'a/c/', 'a/x'])
+        g.close()
+        # Plain mode: the nodes are removed
+        g = spy(filename=filename)
+        assert spysfdict.rebuilds == 1 and not 'a/' in g.d
+        assert sorted(g.keys()) == ['a/b', 'a/c/d', 'a/c/e', 'a/x', 'f/g', 'h']
+        g.close()
+        # Nodel mode, then not closed cleanly: the header is dirty, so the metadata is rebuilt
+        g = spy(filename=filename, nodel=True)
+        assert spysfdict.rebuilds == 2 and g.d['a/'] is None and 'a/c/' in g.d
+        g['i/j'] = 7
+        g.d.close()
+        g = spy(filename=filename, nodel=True)
+        assert spysfdict.rebuilds == 3 and g.d.get_header()['metadata']['state'] == 'clean'
+        assert 'i/' in g.d and len(list(g.viewkeys())) == 7
+        g.close()
+        # Another delimiter is refused
+        try:
+            dclass(filename=filename, delimiter='.')
+            assert False
+        except ValueError:
+            pass
+        # Interrupted rebuild, resumed when reopening
+        class interrupted(spy):
+            _metadatabatchsize = 2
+            def _build_metadata(self, fullkeys=None):
+                if self.d.get_header()['metadata'].get('done') == 4:
+                    raise KeyboardInterrupt
+                return super(interrupted, self)._build_metadata(fullkeys)
+        try:
+            interrupted(filename=filename, fastview=True)
+            assert False
+        except KeyboardInterrupt:
+            pass
+        built = []
+        class resumed(spy):
+            def _build_metadata(self, fullkeys=None):
+                built.extend(fullkeys)
+                return super(resumed, self)._build_metadata(fullkeys)
+        g = resumed(filename=filename, fastview=True)
+        assert len(built) == 3
+        assert g.d.get_header()['metadata']['state'] == 'clean'
+        assert g.to_dict_nested() == {'a': {'b': 1, 'c': {'d': 2, 'e': 3}, 'x': 6}, 'f': {'g': 4}, 'h': 5, 'i': {'j': 7}}
+        assert g.d['a/'] == set(['a/b', 'a/c/', 'a/x']) and g.d['i/'] == set(['i/j'])
+        g.close(delete=True)
+
+def test_sfdict_lrucache():
+    '''Test sfdict bounded writeback cache'''
+    from fdict.fdict import lrushelf
+    g = sfdict(d=dict(('k%i' % i, [i]) for i in range(10)), cachesize=3)
+    assert isinstance(g.d, lrushelf)
+    before = g.get_cache_stats()
+    for i in range(10):
+        assert g['k%i' % i] == [i]
+    stats = g.get_cache_stats()
+    assert stats['entries'] == 3 and stats['misses'] - before['misses'] == 10 and stats['evictions'] - before['evictions'] == 10
+    # Mutated values are written back when evicted
+    g['k0'].append(1)
+    g['k1'].append(1)
+    for i in range(2, 10):
+        g['k%i' % i]
+    import pickle
+    stored = lambda k: pickle.loads(g.d.dict[g.d._dbkey(k)])  # read directly from the db, bypassing the cache
+    assert stored('k0') == [0, 1] and stored('k1') == [1, 1]
+    # And at sync
+    hits = g.get_cache_stats()['hits']
+    g['k9'].append(1)
+    assert g.get_cache_stats()['hits'] == hits + 1
+    assert stored('k9') == [9]
+    assert g.sync() == {'keys': 1, 'bytes': len(pickle.dumps([9, 1], pickle.HIGHEST_PROTOCOL))}
+    assert stored('k9') == [9, 1]
+    # Unchanged values are not written back
+    writebacks = g.get_cache_stats()['writebacks']
+    for i in range(10):
+        g['k%i' % i]
+    assert g.sync() == {'keys': 0, 'bytes': 0}
+    assert g.get_cache_stats()['writebacks'] == writebacks
+    g['k3'] = [3, 3]  # assignments are written through
+    assert stored('k3') == [3, 3] and g.sync()['keys'] == 0
+    g.close(delete=True)
+    # Limit by size in bytes
+    g = sfdict(d=dict(('k%i' % i, 'x' * 100) for i in range(10)), cachebytes=500)
+    for k in g.keys():
+        g[k]
+    assert 0 < g.get_cache_stats()['bytes'] <= 500
+    g.close(delete=True)
+    # Unbounded cache like shelve's writeback
+    g = sfdict(d=dict(('k%i' % i, [i]) for i in range(100)), cachesize=None)
+    for k in g.keys():
+        g[k]
+    assert g.get_cache_stats()['entries'] == 100 and g.get_cache_stats()['evictions'] == 0
+    g.close(delete=True)
+    # No cache, also with a cache of size 0 (not an unbounded one)
+    for kwargs in ({'writeback': False}, {'cachesize': 0}, {'cachebytes': 0}):
+        g = sfdict(d={'a': [1]}, **kwargs)
+        g['a'].append(2)
+        g['b'] = [3]
+        assert g['a'] == [1] and g['b'] == [3] and g.get_cache_stats()['entries'] == 0
+        g.close(delete=True)
+
+def test_sfdict_codecs():
+    '''Test sfdict codecs and compression, and their persistence in the database header'''
+    from copy import deepcopy
+    values = {'a': {'b': b'bytes' * 200, 'c': u'text\xe9' * 200, 'd': [1, 2.0, {'e': None}], 'f': set([1, 2])}, 'g': 3}
+    for kwargs in [{}, {'codec': 'marshal'}, {'codec': 'raw'}, {'codec': 'raw', 'compression': 'zlib'}, {'codec': 'marshal', 'compression': 'zlib', 'compressthreshold': 10}]:
+        g = sfdict(d=deepcopy(values), filename='testshelf_codec', **kwargs)
+        assert g.to_dict_nested() == values
+        assert len(g) == 5 and sorted(g.keys()) == ['a/b', 'a/c', 'a/d', 'a/f', 'g']  # header is hidden
+        g['a/d'].append(4)
+        g.close()
+        # Reopen without specifying the codec, it is read from the header
+        h = sfdict(filename='testshelf_codec')
+        assert h.d.codec == kwargs.get('codec', 'pickle') and h.d.compression == kwargs.get('compression', False)
+        assert h['a/d'] == [1, 2.0, {'e': None}, 4] and h['a/b'] == values['a']['b']
+        h.close(delete=True)
+        assert not [f for f in os.listdir('.') if f.startswith('testshelf_codec')]  # all the files of the dbm are deleted
+    # Raw values are stored as-is and compressed values are smaller
+    g = sfdict(d=values, codec='raw', compression='zlib')
+    assert g.d.dict[b'a/c' if sys.version_info >= (3, 0) else 'a/c'][:1] == b'\x04'
+    assert len(g.d.dict[b'a/b' if sys.version_info >= (3, 0) else 'a/b']) < 100
+    g.close(delete=True)
+    # Pickle without compression stays readable with shelve
+    g = sfdict(d=values, filename='testshelf_codec')
+    g.close()
+    h = shelve.open('testshelf_codec')
+    assert h['a/b'] == values['a']['b']
+    h.close()
+    g = sfdict(filename='testshelf_codec')
+    g.close(delete=True)
+    # Marshal values cannot be read with another marshal version, even with another codec
+    import marshal
+    g = sfdict(d=values, filename='testshelf_codec', codec='marshal')
+    header = g.d.get_header()
+    assert header['marshalversion'] == marshal.version
+    header['marshalversion'] = marshal.version + 1
+    g.d.set_header(header)
+    g.close()
+    for kwargs in ({}, {'codec': 'pickle'}, {'readonly': True}):
+        try:
+            sfdict(filename='testshelf_codec', **kwargs)
+            assert False
+        except ValueError:
+            pass
+    for filename in os.listdir('.'):
+        if filename.startswith('testshelf_codec'):
+            os.remove(filename)
+    try:
+        sfdict(codec='json')
+        assert False
+    except ValueError:
+        assert True
+
+def test_sqlfdict_basic():
+    '''Test sqlfdict basic operations, in all modes, and when reopening'''
+    from fdict.fdict import sqlshelf
+    for kwargs in [{}, {'fastview': True}, {'trie': True}, {'sortedindex': True, 'counting': True}]:
+        g = sqlfdict(d={'a': {'b': 1, 'c': {'d': 2}}, 'ab': 3}, filename='testshelf_sql', **kwargs)
+        assert isinstance(g.d, sqlshelf)
+        assert dict(g['a'].items()) == {'b': 1, 'c/d': 2}
+        assert 'a/c' in g and 'a' in g and not 'a/x' in g
+        g['a/c/e'] = [1, 2]
+        assert g['a']['c']['e'] == [1, 2]
+        del g['a/c']
+        assert dict(g.items()) == {'a/b': 1, 'ab': 3}
+        assert len(g['a']) == 1
+        g.sync()
+        h = sqlfdict(filename='testshelf_sql', **kwargs)
+        assert dict(h.items()) == {'a/b': 1, 'ab': 3}
+        g.close()
+        h.close(delete=True)
+    # Root-level keys that are not strings are refused, instead of being stored as strings
+    g = sqlfdict({'a': 1})
+    try:
+        g[1] = 2
+        assert False
+    except TypeError:
+        pass
+    assert list(g.keys()) == ['a']
+    g.close(delete=True)
+
+def test_sqlshelf():
+    '''Test sqlshelf range queries and transactions'''
+    from fdict.fdict import sqlshelf
+    d = sqlshelf('testshelf_sql2')
+    d.update({'a/b': 1, 'a/c': 2, 'a0': 3, 'ab': 4, 'a': 5})
+    d['b'] = set([6])
+    assert list(d.iterprefix('a/')) == ['a/b', 'a/c']  # sorted and does not include 'a0', 'ab' nor 'a'
+    assert list(d.iterprefixitems('a/')) == [('a/b', 1), ('a/c', 2)]
+    assert list(d.iterprefix('')) == list(d) == sorted(d)
+    assert d['b'] == set([6]) and 'b' in d and not 'c' in d
+    assert d.delprefix('a/') == 2
+    assert sorted(d) == ['a', 'a0', 'ab', 'b']
+    del d['a']
+    assert len(d) == 3
+    try:
+        del d['a']
+        assert False
+    except KeyError:
+        assert True
+    # Uncommitted changes are lost if not synced
+    d.sync()
+    d['c'] = 7
+    d.conn.rollback()
+    assert not 'c' in d and len(d) == 3
+    # Keys must be strings, SQLite would store 1 as '1'
+    for store in (lambda: d.__setitem__(1, 2), lambda: d.update({'e': 3, 1: 2})):
+        try:
+            store()
+            assert False
+        except TypeError:
+            pass
+    d['1'] = 4
+    assert not 1 in d and '1' in d and d.getmany([1, '1']) == {'1': 4}
+    try:
+        d[1]
+        assert False
+    except KeyError:
+        pass
+    d.close()
+    os.remove('testshelf_sql2')
+
 def test_sfdict_dictinit():
     '''Test sfdict initialization with a dict'''
     g = sfdict(d={'a': {'b': set([1, 2])}})
@@ -894,7 +2163,7 @@ def test_sfdict_autosync():
     '''Test sfdict autosync'''
     # With autosync, updating a nested object is saved to disk
     g = sfdict(d={'a': {'b': set([1, 2])}}, autosync=True)
-    assert 'shelve' in str(type(g.d)) or 'instance' in str(type(g.d))  # check the internal dict is a db shelve
+    assert isinstance(g.d, shelve.Shelf)  # check the internal dict is a db shelve
     g['a']['b'].add(3)
     assert g['a/b'] == set([1, 2, 3])
     g['d'] = 4  # trigger the autosync on setitem
@@ -906,6 +2175,21 @@ def test_sfdict_autosync():
     assert (h['a/b/c'] == 3) == False
     g.close()
     h.close(delete=True)
+    # A single sync per write, which commits the header with the change
+    for kwargs in [{}, {'fastview': True, 'counting': True}]:
+        g = sfdict(autosync=True, **kwargs)
+        syncs = []
+        sync = g.d.sync
+        g.d.sync = lambda: syncs.append(1) or sync()
+        g['a/b'] = 1
+        assert len(syncs) == 1
+        g.setmany({'a/c': 2, 'd': 3})
+        assert len(syncs) == 2
+        if kwargs:
+            header = g.d.get_header()
+            assert header['metadata']['state'] == 'clean' and header['counts'] == {'': 3, 'a/': 2}
+        del g.d.sync
+        g.close(delete=True)
     # Without autosync, the change is lost
     g = sfdict(d={'a': {'b': set([1, 2])}}, autosync=False)
     g['a']['b'].add(3)
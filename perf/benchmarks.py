@@ -1,5 +1,11 @@
+import glob
+import json
+import os
 import re
 import sys
+import tempfile
+import threading
+import time
 import timeit
 
 ### UTILS
@@ -146,6 +152,443 @@ def benchmark_viewitems_fdict(dclass, breadth=5, depth=1000, d=None, args=None,
         di = di[str(breadth)]
     return x
 
+_prebuilt = {}
+
+def _prebuild(build, *params):
+    '''Return build(*params), built only once for the same builder and
+    parameters and then reused, so that the benchmarks calling it only time
+    their operation (what was built is closed or deleted at the end)'''
+    key = (build, repr([sorted(p.items()) if isinstance(p, dict) else p
+                        for p in params]))
+    if key not in _prebuilt:
+        _prebuilt[key] = build(*params)
+    return _prebuilt[key]
+
+def _build_subtree(dclass, nleaves, subtree, args, kwargs):
+    d = dclass(*args, **kwargs)
+    for i in _range(nleaves):
+        d['big/%i/%i' % (i % 100, i)] = i
+    for i in _range(subtree):
+        d['small/%i' % i] = i
+    return d
+
+def benchmark_viewitems_subtree(dclass, nleaves=1000, subtree=10, d=None,
+                                args=None, kwargs=None):
+    '''Test performance of viewitems on a small subtree (of size subtree) of a
+    big fdict (of nleaves leaves). The fdict is built only once and then
+    reused, so that only the subtree exploration is timed'''
+    if args is None:
+        args = []
+    if kwargs is None:
+        kwargs = {}
+
+    if d is None:
+        d = _prebuild(_build_subtree, dclass, nleaves, subtree, args, kwargs)
+    x = 0
+    for _ in d['small'].viewitems():
+        x += 1
+    return x
+
+def _build_restrict(dclass, nleaves, args, kwargs):
+    d = dclass(*args, **kwargs)
+    d.update_iter(('big/%i/%i/%i' % (i % 10, i % 1000, i), i)
+                  for i in _range(nleaves))
+    return d
+
+def benchmark_viewkeys_restrict(dclass, nleaves=10000, d=None, args=None,
+                                kwargs=None):
+    '''Test performance of listing the 10 direct children of a node with
+    nleaves leaves under it (the fdict is built once, then cached)'''
+    if args is None:
+        args = []
+    if kwargs is None:
+        kwargs = {}
+
+    if d is None:
+        d = _prebuild(_build_restrict, dclass, nleaves, args, kwargs)
+    return list(d['big'].viewkeys_restrict())
+
+def _build_glob(dclass, nusers, args, kwargs):
+    d = dclass(*args, **kwargs)
+    leaves = ['name', 'mail', 'stats/latency', 'stats/hits', 'stats/misses',
+              'prefs/a', 'prefs/b', 'prefs/c', 'prefs/d', 'prefs/e']
+    d.update_iter(('users/u%i/%s' % (i, leaf), i)
+                  for i in _range(nusers) for leaf in leaves)
+    return d
+
+def benchmark_glob(dclass, nusers=1000, pattern='users/*/stats/latency',
+                   scan=False, d=None, args=None, kwargs=None):
+    '''Test performance of a glob query over nusers users with 10 leaves each,
+    either with glob() or by walking all the items and matching them (the fdict
+    is built once, then cached)'''
+    if args is None:
+        args = []
+    if kwargs is None:
+        kwargs = {}
+
+    if d is None:
+        d = _prebuild(_build_glob, dclass, nusers, args, kwargs)
+    if scan:
+        import fnmatch
+        return [k for k, v in d['users'].viewitems(fullpath=True)
+                if fnmatch.fnmatchcase(k, pattern)]
+    else:
+        return list(d.glob(pattern))
+
+def _build_page(dclass, nleaves, args, kwargs):
+    d = dclass(*args, **kwargs)
+    d.update_iter(('events/%010i' % i, i) for i in _range(nleaves))
+    return d
+
+def benchmark_page(dclass, nleaves=100000, pagesize=100, npages=10, d=None,
+                   args=None, kwargs=None):
+    '''Test performance of fetching npages pages of pagesize items with a
+    cursor, from the middle of a node of nleaves sorted events (the fdict is
+    built once, then cached)'''
+    if args is None:
+        args = []
+    if kwargs is None:
+        kwargs = {}
+
+    if d is None:
+        d = _prebuild(_build_page, dclass, nleaves, args, kwargs)
+    events = d['events']
+    page, cursor = events.page(pagesize, start='%010i' % (nleaves // 2))
+    for _ in _range(npages-1):
+        page, cursor = events.page(pagesize, cursor)
+    return page
+
+def _build_many(dclass, nleaves, args, kwargs):
+    d = dclass(*args, **kwargs)
+    d.update_iter(('a/%i/%i' % (i % 100, i), i) for i in _range(nleaves))
+    if hasattr(d, 'sync'):
+        d.sync()
+    return d
+
+def benchmark_getmany(dclass, nleaves=10000, nkeys=1000, many=True, d=None,
+                      args=None, kwargs=None):
+    '''Test performance of reading nkeys leaves among nleaves, either with one
+    getmany() or with a getitem per key (the fdict is built once, then cached,
+    with a tiny cache so that values are really read from the database)'''
+    if args is None:
+        args = []
+    if kwargs is None:
+        kwargs = {}
+
+    if d is None:
+        d = _prebuild(_build_many, dclass, nleaves, args, kwargs)
+    d = d['a']
+    keys = ['%i/%i' % (i % 100, i)
+            for i in _range(0, nleaves, nleaves // nkeys)]
+    if many:
+        return d.getmany(keys)
+    else:
+        return [d[k] for k in keys]
+
+def benchmark_setmany(dclass, nkeys=1000, many=True, args=None, kwargs=None):
+    '''Test performance of storing nkeys leaves in a new fdict, either with one
+    setmany() or with a setitem per key'''
+    if args is None:
+        args = []
+    if kwargs is None:
+        kwargs = {}
+
+    d = dclass(*args, **kwargs)
+    items = [('a/%i/%i' % (i % 100, i), i) for i in _range(nkeys)]
+    if many:
+        d.setmany(items)
+    else:
+        for k, v in items:
+            d[k] = v
+    if hasattr(d, 'close'):
+        d.close(delete=True)
+    return d
+
+def _build_columns(dclass, nrows, args, kwargs):
+    d = dclass(*args, **kwargs)
+    d.update_iter(('users/%08i/%s' % (i, f), v)
+                  for i in _range(nrows)
+                  for f, v in (('name', 'user%i' % i), ('age', i % 100),
+                               ('score', i / 3.0)))
+    if hasattr(d, 'sync'):
+        d.sync()
+    return d
+
+def benchmark_columns(dclass, nrows=10000, columnar=True, d=None, args=None,
+                      kwargs=None):
+    '''Test performance of getting nrows records users/<id>/{name,age,score} as
+    columns, either with to_columns() or with to_dict_nested() then a
+    transposition (the fdict is built once, then cached)'''
+    if args is None:
+        args = []
+    if kwargs is None:
+        kwargs = {}
+
+    if d is None:
+        d = _prebuild(_build_columns, dclass, nrows, args, kwargs)
+    users = d['users']
+    if columnar:
+        return users.to_columns()
+    else:
+        nested = users.to_dict_nested()
+        rowkeys = sorted(nested)
+        return rowkeys, dict((f, [nested[k].get(f) for k in rowkeys])
+                             for f in ('name', 'age', 'score'))
+
+def benchmark_threads(dclass, nthreads=4, nops=5000, writeratio=0.1, args=None,
+                      kwargs=None):
+    '''Test throughput of nthreads threads sharing a fdict of 1000 leaves, each
+    doing nops getitem or (in the proportion writeratio) setitem, plus a walk
+    of a subtree every 100 operations'''
+    if args is None:
+        args = []
+    if kwargs is None:
+        kwargs = {}
+
+    d = dclass(*args, **kwargs)
+    d.update_iter(('a/%i/%i' % (i % 10, i), i) for i in _range(1000))
+    every = int(1 / writeratio) if writeratio else 0
+    def work(t):
+        for i in _range(nops):
+            key = 'a/%i/%i' % (i % 10, (i * 7 + t) % 1000)
+            if every and i % every == 0:
+                d[key] = i
+            else:
+                d[key]
+            if i % 100 == 0:
+                list(d['a/%i' % (i % 10)].viewitems())
+    threads = [threading.Thread(target=work, args=(t,))
+               for t in _range(nthreads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if hasattr(d, 'close'):
+        d.close(delete=True)
+    return d
+
+def _cpumapper(k, v):
+    '''A CPU-bound mapper'''
+    return sum(i * i for i in _range(v % 500))
+
+def _add(x, y):
+    return x + y
+
+def _build_map_reduce(dclass, nleaves, args, kwargs):
+    d = dclass(*args, **kwargs)
+    d.update_iter(('n%i/%i' % (i % 100, i), i) for i in _range(nleaves))
+    if hasattr(d, 'sync'):
+        d.sync()
+    return d
+
+def benchmark_map_reduce(dclass, nleaves=20000, workers=None, d=None,
+                         args=None, kwargs=None):
+    '''Test performance of a CPU-bound map/reduce over nleaves leaves under 100
+    top-level nodes, either with map_reduce() in workers processes (by default
+    the number of CPUs), or by walking viewitems() in the current process if
+    workers is 0 (the fdict is built once, then cached)'''
+    if args is None:
+        args = []
+    if kwargs is None:
+        kwargs = {}
+
+    if d is None:
+        d = _prebuild(_build_map_reduce, dclass, nleaves, args, kwargs)
+    if workers == 0:
+        result = 0
+        for k, v in d.viewitems():
+            result = _add(result, _cpumapper(k, v))
+        return result
+    return d.map_reduce(_cpumapper, _add, workers=workers)
+
+def benchmark_aio(dclass, nleaves=10000, nreads=20000, nclients=100,
+                  facade=True, args=None, kwargs=None):
+    '''Test the latency of the event loop while nclients concurrent clients do
+    nreads reads in total of a database of nleaves leaves, either through the
+    asyncio facade (aiofdict) or directly in the event loop, which is then
+    blocked by the I/O and unpickling. Return the maximum and mean delays in ms
+    of a timer ticking every ms, and the total time in s (Python >= 3.7 only)
+    '''
+    import asyncio
+    from fdict.aio import aiofdict
+    if args is None:
+        args = []
+    if kwargs is None:
+        kwargs = {}
+
+    d = dclass(*args, **kwargs)
+    d.update_iter(('a/%i' % i, {'id': i, 'name': 'item %i' % i,
+                                'tags': list(_range(20))})
+                  for i in _range(nleaves))
+    d.close()
+    kwargs = dict(kwargs, filename=d.get_filename(), cachesize=100)
+    keys = ['a/%i/name' % ((i * 7919) % nleaves) for i in _range(nreads)]
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    lags = []
+    def tick(expected):
+        now = loop.time()
+        lags.append(now - expected)
+        if not work.done():
+            loop.call_later(0.001, tick, now + 0.001)
+    if facade:
+        ad = loop.run_until_complete(aiofdict.open(dclass, *args, **kwargs))
+    else:
+        d = dclass(*args, **kwargs)
+    work = loop.create_future()
+    running = [nclients]
+    def client(i, *_):
+        # Each client does its reads one after the other
+        if i >= nreads:
+            running[0] -= 1
+            if not running[0]:
+                work.set_result(None)
+        elif facade:
+            loop.create_task(ad.aget(keys[i])).add_done_callback(
+                lambda f: client(i + nclients))
+        else:
+            d[keys[i]]  # blocks the event loop
+            loop.call_soon(client, i + nclients)
+    start = time.time()
+    for i in _range(nclients):
+        loop.call_soon(client, i)
+    loop.call_soon(tick, loop.time())
+    loop.run_until_complete(work)
+    total = time.time() - start
+    if facade:
+        loop.run_until_complete(ad.aclose(delete=True))
+    else:
+        d.close(delete=True)
+    loop.close()
+    return max(lags) * 1000, sum(lags) / len(lags) * 1000, total
+
+def _sync_leaves(d, nleaves):
+    return [d['n%i/%i' % (i % 100, i)] for i in _range(nleaves)]
+
+def _build_sync(dclass, nleaves, args, kwargs):
+    d = dclass(*args, cachesize=None, **kwargs)
+    d.update_iter(('n%i/%i' % (i % 100, i), [i]) for i in _range(nleaves))
+    d.sync()
+    return d, _sync_leaves(d, nleaves)
+
+def benchmark_sync(dclass, nleaves=10000, d=None, args=None, kwargs=None):
+    '''Test performance of sync() after nleaves list leaves under 100 top-level
+    nodes were all modified in place, so that they are all written back (the
+    database is built once with an unbounded cache, then reused, so that the
+    leaves are read only once)'''
+    if args is None:
+        args = []
+    if kwargs is None:
+        kwargs = {}
+
+    if d is None:
+        d, leaves = _prebuild(_build_sync, dclass, nleaves, args, kwargs)
+    else:
+        leaves = _sync_leaves(d, nleaves)
+    for leaf in leaves:
+        leaf.append(0)
+    return d.sync()
+
+def benchmark_build(dclass, nleaves=1000, args=None, kwargs=None):
+    '''Test performance of building a fdict of nleaves leaves with direct
+    setitem, including the final sync and close (and deletion) for out-of-core
+    databases'''
+    if args is None:
+        args = []
+    if kwargs is None:
+        kwargs = {}
+
+    d = dclass(*args, **kwargs)
+    for i in _range(nleaves):
+        d['big/%i/%i' % (i % 100, i)] = i
+    if hasattr(d, 'close'):
+        d.close(delete=True)
+    return d
+
+_jsonleaf = json.dumps(dict(('field%i' % i, {'name': 'value %i' % i,
+                                              'tags': ['a', 'b', 'c'],
+                                              'score': i * 1.5})
+                             for i in range(20)))
+
+def benchmark_codec(dclass, nleaves=1000, args=None, kwargs=None):
+    '''Test throughput of storing then loading JSON-like text leaves, with a
+    tiny cache so that values are really serialized and read from the database.
+    Return the on-disk size of the database'''
+    if args is None:
+        args = []
+    if kwargs is None:
+        kwargs = {}
+
+    d = dclass(*args, cachesize=1, **kwargs)
+    for i in _range(nleaves):
+        d['a/%i' % i] = _jsonleaf
+    d.sync()
+    for i in _range(nleaves):
+        d['a/%i' % i]
+    size = sum(os.path.getsize(f)
+               for f in glob.glob(d.get_filename() + '*'))
+    d.close(delete=True)
+    return size
+
+def _make_json_file(nleaves=10000):
+    '''Write a nested JSON document of nleaves leaves to a temporary file,
+    return its filename (call it through _prebuild() to write it once)'''
+    doc = {}
+    for i in _range(nleaves):
+        node = doc.setdefault('n%i' % (i % 100), {})
+        node = node.setdefault('m%i' % (i % 1000), {})
+        node['leaf%i' % i] = {'value': i, 'tags': ['a', 'b']}
+    fd, filename = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(doc, f)
+    return filename
+
+def benchmark_load_json(dclass, nleaves=10000, stream=True, args=None,
+                        kwargs=None):
+    '''Test performance of importing a nested JSON document of nleaves objects,
+    either streamed with load_json() or with json.load() then passed to the
+    constructor, including the final sync and close (and deletion) for
+    out-of-core databases'''
+    if args is None:
+        args = []
+    if kwargs is None:
+        kwargs = {}
+
+    filename = _prebuild(_make_json_file, nleaves)
+    if stream:
+        d = dclass(*args, **kwargs)
+        d.load_json(filename)
+    else:
+        with open(filename) as f:
+            d = dclass(json.load(f), *args, **kwargs)
+    if hasattr(d, 'close'):
+        d.close(delete=True)
+    return d
+
+def _build_export(dclass, nleaves, args, kwargs):
+    d = dclass(*args, **kwargs)
+    d.load_json(_prebuild(_make_json_file, nleaves))
+    return d
+
+def benchmark_export_json(dclass, nleaves=10000, stream=True, d=None,
+                          args=None, kwargs=None):
+    '''Test performance of exporting a nested JSON document of nleaves objects
+    (imported beforehand with load_json()), either streamed with export_json()
+    or with to_dict_nested() then json.dump()'''
+    if args is None:
+        args = []
+    if kwargs is None:
+        kwargs = {}
+
+    if d is None:
+        d = _prebuild(_build_export, dclass, nleaves, args, kwargs)
+    with open(os.devnull, 'w') as f:
+        if stream:
+            d.export_json(f)
+        else:
+            json.dump(d.to_dict_nested(), f)
+    return d
+
 ### DEFINE BENCHMARKS
 
 tests = '''
@@ -160,11 +603,16 @@ benchmark_get(dict, depth=100, d=benchmark_set(dict, depth=100))
 benchmark_set(fdict, depth=100)
 # getitem+setitem
 benchmark_get(fdict, depth=100, d=benchmark_set(fdict, depth=100))
-## fdict fastview (skipped because too slow! setitem runs in quadratic time because of metadata building, but can be optimized to run in linear time!)
+## fdict fastview
 # setitem
-#benchmark_set(fdict, depth=100, kwargs={'fastview': True})
+benchmark_set(fdict, depth=100, kwargs={'fastview': True})
 # getitem+setitem
-#benchmark_get(fdict, depth=100, d=benchmark_set(fdict, depth=100, kwargs={'fastview': True}))
+benchmark_get(fdict, depth=100, d=benchmark_set(fdict, depth=100, kwargs={'fastview': True}))
+## fdict trie
+# setitem
+benchmark_set(fdict, depth=100, kwargs={'trie': True})
+# getitem+setitem
+benchmark_get(fdict, depth=100, d=benchmark_set(fdict, depth=100, kwargs={'trie': True}))
 
 ### setitem and getitem direct access, eg, x['a/b/c']
 ## dict
@@ -179,9 +627,14 @@ benchmark_set_direct(fdict, depth=100)
 benchmark_get_direct(fdict, depth=100, d=benchmark_set_direct(fdict, depth=100))
 ## fdict fastview
 # setitem
-#benchmark_set_direct(fdict, depth=100, kwargs={'fastview': True})
+benchmark_set_direct(fdict, depth=100, kwargs={'fastview': True})
+# getitem+setitem
+benchmark_get_direct(fdict, depth=100, d=benchmark_set_direct(fdict, depth=100, kwargs={'fastview': True}))
+## fdict trie
+# setitem
+benchmark_set_direct(fdict, depth=100, kwargs={'trie': True})
 # getitem+setitem
-#benchmark_get_direct(fdict, depth=100, d=benchmark_set_direct(fdict, depth=100, kwargs={'fastview': True}))
+benchmark_get_direct(fdict, depth=100, d=benchmark_set_direct(fdict, depth=100, kwargs={'trie': True}))
 
 ### viewitem
 ## dict
@@ -189,8 +642,190 @@ benchmark_viewitems_dict(dict, breadth=100, depth=5, d=benchmark_set(dict, bread
 ## fdict
 benchmark_viewitems_fdict(fdict, breadth=100, depth=5, d=benchmark_set_direct(fdict, breadth=100, depth=5))
 ## fdict fastview
-#benchmark_viewitems_fdict(fdict, breadth=100, depth=5, d=benchmark_set_direct(fdict, breadth=100, depth=5, kwargs={'fastview': True}))
+benchmark_viewitems_fdict(fdict, breadth=100, depth=5, d=benchmark_set_direct(fdict, breadth=100, depth=5, kwargs={'fastview': True}))
+## fdict trie
+benchmark_viewitems_fdict(fdict, breadth=100, depth=5, d=benchmark_set_direct(fdict, breadth=100, depth=5, kwargs={'trie': True}))
+
+### viewitems on a small subtree of a growing fdict: full scan vs sorted index crossover
+## fdict (scan)
+benchmark_viewitems_subtree(fdict, nleaves=100)
+benchmark_viewitems_subtree(fdict, nleaves=1000)
+benchmark_viewitems_subtree(fdict, nleaves=10000)
+benchmark_viewitems_subtree(fdict, nleaves=100000)
+## fdict fastview
+benchmark_viewitems_subtree(fdict, nleaves=100000, kwargs={'fastview': True})
+## fdict trie
+benchmark_viewitems_subtree(fdict, nleaves=100000, kwargs={'trie': True})
+## fdict sortedindex
+benchmark_viewitems_subtree(fdict, nleaves=100, kwargs={'sortedindex': True})
+benchmark_viewitems_subtree(fdict, nleaves=1000, kwargs={'sortedindex': True})
+benchmark_viewitems_subtree(fdict, nleaves=10000, kwargs={'sortedindex': True})
+benchmark_viewitems_subtree(fdict, nleaves=100000, kwargs={'sortedindex': True})
+
+### viewkeys_restrict: direct children of a node
+## fdict
+benchmark_viewkeys_restrict(fdict)
+## fdict fastview
+benchmark_viewkeys_restrict(fdict, kwargs={'fastview': True})
+## fdict sortedindex
+benchmark_viewkeys_restrict(fdict, kwargs={'sortedindex': True})
+## fdict trie
+benchmark_viewkeys_restrict(fdict, kwargs={'trie': True})
+## sqlfdict
+benchmark_viewkeys_restrict(sqlfdict)
+
+### glob query 'users/*/stats/latency' over 1000 users: walk all the items and match vs glob() pruning the branches
+## fdict viewitems + fnmatch
+benchmark_glob(fdict, scan=True)
+## fdict
+benchmark_glob(fdict)
+## fdict fastview
+benchmark_glob(fdict, kwargs={'fastview': True})
+## fdict sortedindex
+benchmark_glob(fdict, kwargs={'sortedindex': True})
+## fdict trie
+benchmark_glob(fdict, kwargs={'trie': True})
+## sqlfdict viewitems + fnmatch
+benchmark_glob(sqlfdict, scan=True)
+## sqlfdict
+benchmark_glob(sqlfdict)
+
+### pagination: 10 pages of 100 items with a cursor, from the middle of 100k events
+## fdict (heap selection)
+benchmark_page(fdict)
+## fdict sortedindex
+benchmark_page(fdict, kwargs={'sortedindex': True})
+## sqlfdict
+benchmark_page(sqlfdict)
+
+### batched access: getmany/setmany vs one getitem/setitem per key
+## sfdict getitem
+benchmark_getmany(sfdict, many=False, kwargs={'cachesize': 1})
+## sfdict getmany
+benchmark_getmany(sfdict, kwargs={'cachesize': 1})
+## sqlfdict getitem
+benchmark_getmany(sqlfdict, many=False)
+## sqlfdict getmany
+benchmark_getmany(sqlfdict)
+## fdict fastview setitem
+benchmark_setmany(fdict, many=False, kwargs={'fastview': True})
+## fdict fastview setmany
+benchmark_setmany(fdict, kwargs={'fastview': True})
+## sqlfdict setitem
+benchmark_setmany(sqlfdict, many=False)
+## sqlfdict setmany
+benchmark_setmany(sqlfdict)
 
+### columnar export of 10000 records: to_columns() vs to_dict_nested() then transposition
+## fdict to_dict_nested
+benchmark_columns(fdict, columnar=False)
+## fdict to_columns
+benchmark_columns(fdict)
+## fdict sortedindex to_dict_nested
+benchmark_columns(fdict, columnar=False, kwargs={'sortedindex': True})
+## fdict sortedindex to_columns
+benchmark_columns(fdict, kwargs={'sortedindex': True})
+## sqlfdict to_dict_nested
+benchmark_columns(sqlfdict, columnar=False)
+## sqlfdict to_columns
+benchmark_columns(sqlfdict)
+
+### threads: 4 threads x 5000 operations (10% writes) on a shared fdict, the default mode is not threadsafe and is only given as a reference for the locking overhead
+## fdict 1 thread
+benchmark_threads(fdict, nthreads=1)
+## fdict threadsafe 1 thread
+benchmark_threads(fdict, nthreads=1, kwargs={'threadsafe': True})
+## fdict 4 threads (not threadsafe)
+benchmark_threads(fdict)
+## fdict threadsafe 4 threads
+benchmark_threads(fdict, kwargs={'threadsafe': True})
+## fdict threadsafe 4 threads, reads only
+benchmark_threads(fdict, writeratio=0, kwargs={'threadsafe': True})
+## fdict fastview threadsafe 4 threads
+benchmark_threads(fdict, kwargs={'fastview': True, 'threadsafe': True})
+## sfdict threadsafe 4 threads
+benchmark_threads(sfdict, kwargs={'threadsafe': True})
+## sqlfdict threadsafe 4 threads
+benchmark_threads(sqlfdict, kwargs={'threadsafe': True})
+
+### map/reduce: CPU-bound mapper over 20000 leaves, walking viewitems() vs map_reduce() in one worker process per CPU (the speed-up depends on the number of cores)
+## fdict viewitems
+benchmark_map_reduce(fdict, workers=0)
+## fdict map_reduce
+benchmark_map_reduce(fdict)
+## sfdict viewitems
+benchmark_map_reduce(sfdict, workers=0)
+## sfdict map_reduce
+benchmark_map_reduce(sfdict)
+## sqlfdict viewitems
+benchmark_map_reduce(sqlfdict, workers=0)
+## sqlfdict map_reduce
+benchmark_map_reduce(sqlfdict)
+
+### sharded sfdict: database partitioned across 4 files by top-level node (sync() and close() run on the shards in parallel, walking a subtree only reads the keys of its shard)
+## sfdict
+# build
+benchmark_build(sfdict, nleaves=10000)
+# viewitems on a small subtree
+benchmark_viewitems_subtree(sfdict, nleaves=10000)
+# sync of 10000 modified leaves
+benchmark_sync(sfdict)
+## sfdict 4 shards
+# build
+benchmark_build(sfdict, nleaves=10000, kwargs={'shards': 4})
+# viewitems on a small subtree
+benchmark_viewitems_subtree(sfdict, nleaves=10000, kwargs={'shards': 4})
+# sync of 10000 modified leaves
+benchmark_sync(sfdict, kwargs={'shards': 4})
+
+### out-of-core databases: shelve vs sqlite (increase nleaves up to 10000000 to compare on big datasets, but it will take a while with dumbdbm)
+## sfdict dumbdbm
+# build
+benchmark_build(sfdict, nleaves=10000, kwargs={'forcedumbdbm': True})
+# viewitems on a small subtree
+benchmark_viewitems_subtree(sfdict, nleaves=10000, kwargs={'forcedumbdbm': True})
+## sfdict
+# build
+benchmark_build(sfdict, nleaves=10000)
+# viewitems on a small subtree
+benchmark_viewitems_subtree(sfdict, nleaves=10000)
+## sqlfdict
+# build
+benchmark_build(sqlfdict, nleaves=10000)
+# viewitems on a small subtree
+benchmark_viewitems_subtree(sqlfdict, nleaves=10000)
+benchmark_viewitems_subtree(sqlfdict, nleaves=100000)
+
+### sfdict codecs: store and load JSON-like text leaves (on-disk sizes are printed at the end)
+## pickle
+benchmark_codec(sfdict)
+## marshal
+benchmark_codec(sfdict, kwargs={'codec': 'marshal'})
+## raw
+benchmark_codec(sfdict, kwargs={'codec': 'raw'})
+## raw + zlib
+benchmark_codec(sfdict, kwargs={'codec': 'raw', 'compression': 'zlib'})
+## raw + lzma
+benchmark_codec(sfdict, kwargs={'codec': 'raw', 'compression': 'lzma'})
+
+### JSON import: streamed with load_json() vs json.load() then sfdict(d) (peak memory is printed at the end)
+## json.load + sfdict(d)
+benchmark_load_json(sfdict, stream=False)
+## sfdict.load_json
+benchmark_load_json(sfdict)
+## json.load + sqlfdict(d)
+benchmark_load_json(sqlfdict, stream=False)
+## sqlfdict.load_json
+benchmark_load_json(sqlfdict)
+### JSON export: streamed with export_json() vs to_dict_nested() then json.dump()
+## sfdict to_dict_nested + json.dump
+benchmark_export_json(sfdict, stream=False)
+## sfdict.export_json
+benchmark_export_json(sfdict)
+## sqlfdict to_dict_nested + json.dump
+benchmark_export_json(sqlfdict, stream=False)
+## sqlfdict.export_json
+benchmark_export_json(sqlfdict)
 '''
 
 ### RUN BENCHMARKS
@@ -201,7 +836,8 @@ all_benchmarks = ', '.join([s for s in dir() if s.startswith('benchmark_')])
 tests_stmts = [x for x in  re.split(r'\s+(#+.+?\n)(?=[^#])', tests, flags=(re.M | re.S)) if x.strip()]
 
 # Build the setup string (imports etc) for the timeit
-setupstr = 'from fdict import fdict, sfdict\nfrom __main__ import %s' % all_benchmarks
+setupstr = ('from fdict import fdict, sfdict, sqlfdict\n'
+            'from __main__ import %s' % all_benchmarks)
 
 for test in tests_stmts:
     if test[0] == '#':
@@ -213,4 +849,50 @@ for test in tests_stmts:
         num, timing = timeit_auto(setup=setupstr, stmt=test)
         print('%i loops, best of 3: %s' % (num, format_sizeof(timing)))
 
+# On-disk size of the database for each codec
+from fdict import sfdict
+print('### sfdict codecs on-disk size for 1000 JSON-like text leaves')
+for codec_kwargs in [{}, {'codec': 'marshal'}, {'codec': 'raw'},
+                     {'codec': 'raw', 'compression': 'zlib'},
+                     {'codec': 'raw', 'compression': 'lzma'}]:
+    print('%s: %i bytes' % (codec_kwargs or 'pickle',
+                            benchmark_codec(sfdict, kwargs=codec_kwargs)))
+
+# Peak memory of a JSON import, streamed or not
+# (tracemalloc is only available on Python >= 3.4)
+try:
+    import tracemalloc
+    print('### Peak memory when importing a JSON document'
+          ' of 100000 leaves')
+    for stream in [False, True]:
+        tracemalloc.start()
+        benchmark_load_json(sfdict, nleaves=100000, stream=stream)
+        print('%s: %.1f MB' % ('sfdict.load_json' if stream
+                               else 'json.load + sfdict(d)',
+                               tracemalloc.get_traced_memory()[1] / 1e6))
+        tracemalloc.stop()
+except ImportError:
+    pass
+
+# Latency of the event loop while serving concurrent reads (asyncio
+# interface is only available on Python >= 3.7)
+if sys.version_info >= (3, 7):
+    from fdict import sqlfdict
+    print('### Event loop latency while 100 clients do 20000 reads of a '
+          'database (max and mean delay of a 1ms timer, total time)')
+    for dclass in [sfdict, sqlfdict]:
+        for facade in [False, True]:
+            print('%s %s: max %.1f ms, mean %.2f ms, total %.2f s'
+                  % ((dclass.__name__, 'aiofdict' if facade else 'direct')
+                     + benchmark_aio(dclass, facade=facade)))
+
+# Close and delete the prebuilt databases and files
+for built in _prebuilt.values():
+    if isinstance(built, tuple):
+        built = built[0]
+    if isinstance(built, str):
+        os.remove(built)
+    elif hasattr(built, 'close'):
+        built.close(delete=True)
+
 sys.exit(0)
\ No newline at end of file